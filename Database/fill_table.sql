@@ -87,3 +87,5 @@ INSERT INTO user_image (user_id, image_id, rating) VALUES
 (2, 11, 'dislike'),
 (9, 12, 'like'),
 (6, 11, 'dislike');
+
+INSERT INTO collection_image (collection_id, image_id, creation_date) SELECT c.id, i.id, i.creation_date FROM collection c JOIN image i ON i.creation_date BETWEEN c.start_date AND c.end_date;
@@ -3,6 +3,12 @@ DROP TABLE IF EXISTS collection;
 DROP TABLE IF EXISTS user_collection;
 DROP TABLE IF EXISTS image;
 DROP TABLE IF EXISTS user_image;
+DROP TABLE IF EXISTS collection_image;
+DROP TABLE IF EXISTS collection_best_image;
+DROP TABLE IF EXISTS directory;
+DROP TABLE IF EXISTS ingest_directory;
+DROP TABLE IF EXISTS ingest_entry;
+DROP TABLE IF EXISTS ingest_error;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY,
@@ -16,7 +22,7 @@ CREATE TABLE collection (
   name TEXT NOT NULL,
   start_date DATE NOT NULL,
   end_date DATE NOT NULL,
-  best_images TEXT
+  best_images_dirty BOOLEAN NOT NULL DEFAULT 1
 );
 
 CREATE TABLE user_collection (
@@ -31,7 +37,15 @@ CREATE TABLE image (
   id INTEGER PRIMARY KEY,
   file_path TEXT NOT NULL,
   creation_date TIMESTAMP,
-  image_location VARCHAR(255)
+  image_location VARCHAR(255),
+  width INTEGER,
+  height INTEGER,
+  aspect_ratio FLOAT,
+  file_id INTEGER,
+  etag TEXT,
+  size INTEGER,
+  last_modified TIMESTAMP,
+  missing_since TIMESTAMP
 );
 
 CREATE TABLE user_image (
@@ -43,3 +57,57 @@ CREATE TABLE user_image (
   FOREIGN KEY (image_id) REFERENCES image (id),
   PRIMARY KEY (user_id, image_id)
 );
+
+CREATE INDEX image_creation_date ON image (creation_date, id);
+CREATE UNIQUE INDEX image_file_path ON image (file_path) WHERE missing_since IS NULL;
+
+CREATE TABLE collection_image (
+  collection_id INTEGER,
+  image_id INTEGER,
+  creation_date TIMESTAMP,
+  FOREIGN KEY (collection_id) REFERENCES collection (id),
+  FOREIGN KEY (image_id) REFERENCES image (id),
+  PRIMARY KEY (collection_id, image_id)
+);
+
+CREATE INDEX collection_image_creation_date ON collection_image (collection_id, creation_date, image_id);
+CREATE INDEX collection_image_image ON collection_image (image_id, collection_id);
+
+CREATE TABLE collection_best_image (
+  collection_id INTEGER,
+  image_id INTEGER,
+  rank INTEGER NOT NULL,
+  FOREIGN KEY (collection_id) REFERENCES collection (id),
+  FOREIGN KEY (image_id) REFERENCES image (id),
+  PRIMARY KEY (collection_id, image_id)
+);
+
+CREATE TABLE directory (
+  path TEXT PRIMARY KEY,
+  etag TEXT NOT NULL
+);
+
+CREATE TABLE ingest_directory (
+  path TEXT PRIMARY KEY,
+  etag TEXT NOT NULL
+);
+
+CREATE TABLE ingest_entry (
+  directory TEXT NOT NULL,
+  path TEXT NOT NULL,
+  is_dir BOOLEAN NOT NULL,
+  file_id INTEGER,
+  etag TEXT,
+  size INTEGER,
+  last_modified TIMESTAMP,
+  PRIMARY KEY (directory, path)
+);
+
+CREATE TABLE ingest_error (
+  path TEXT PRIMARY KEY,
+  etag TEXT,
+  attempts INTEGER NOT NULL,
+  error TEXT NOT NULL,
+  last_attempt TIMESTAMP NOT NULL,
+  next_attempt TIMESTAMP NOT NULL
+);
@@ -0,0 +1,126 @@
+import sqlite3
+
+
+def add_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str):
+    """Add a column to a table, if the table does not have it yet."""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table});")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+
+def drop_column(cursor: sqlite3.Cursor, table: str, column: str):
+    """Drop a column of a table, if the table still has it."""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table});")]
+    if column in columns:
+        cursor.execute(f"ALTER TABLE {table} DROP COLUMN {column};")
+
+
+def main():
+    """Update an existing Image Sorting database to the current schema."""
+    conn = sqlite3.connect("ImageSorting.sqlite")
+    c = conn.cursor()
+
+    # Dimensions of the images after applying the orientation
+    add_column(c, "image", "width", "INTEGER")
+    add_column(c, "image", "height", "INTEGER")
+    add_column(c, "image", "aspect_ratio", "FLOAT")
+
+    # Materialized collection membership
+    c.execute("CREATE INDEX IF NOT EXISTS image_creation_date ON image (creation_date, id);")
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS collection_image (
+            collection_id INTEGER,
+            image_id INTEGER,
+            creation_date TIMESTAMP,
+            FOREIGN KEY (collection_id) REFERENCES collection (id),
+            FOREIGN KEY (image_id) REFERENCES image (id),
+            PRIMARY KEY (collection_id, image_id)
+        );"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS collection_image_creation_date
+           ON collection_image (collection_id, creation_date, image_id);"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS collection_image_image ON collection_image (image_id, collection_id);")
+    c.execute("DELETE FROM collection_image;")
+    c.execute(
+        """INSERT INTO collection_image (collection_id, image_id, creation_date)
+           SELECT c.id, i.id, i.creation_date
+           FROM collection c JOIN image i ON i.creation_date BETWEEN c.start_date AND c.end_date;"""
+    )
+
+    # Best images in their own table, all collections are recomputed by the next run of the scheduler
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS collection_best_image (
+            collection_id INTEGER,
+            image_id INTEGER,
+            rank INTEGER NOT NULL,
+            FOREIGN KEY (collection_id) REFERENCES collection (id),
+            FOREIGN KEY (image_id) REFERENCES image (id),
+            PRIMARY KEY (collection_id, image_id)
+        );"""
+    )
+    add_column(c, "collection", "best_images_dirty", "BOOLEAN NOT NULL DEFAULT 1")
+    drop_column(c, "collection", "best_images")
+
+    # One row per file, duplicates are merged into the oldest row of the file
+    duplicates = """SELECT d.id, MIN(k.id) AS kept_id
+                    FROM image d JOIN image k ON k.file_path = d.file_path AND k.id < d.id
+                    GROUP BY d.id"""
+    c.execute(f"CREATE TEMP TABLE duplicate_image AS {duplicates};")
+    c.execute(
+        """UPDATE OR IGNORE user_image
+           SET image_id = (SELECT kept_id FROM duplicate_image WHERE id = user_image.image_id)
+           WHERE image_id IN (SELECT id FROM duplicate_image);"""
+    )
+    for table in ["user_image", "collection_image", "collection_best_image"]:
+        c.execute(f"DELETE FROM {table} WHERE image_id IN (SELECT id FROM duplicate_image);")
+    c.execute("DELETE FROM image WHERE id IN (SELECT id FROM duplicate_image);")
+    c.execute("UPDATE collection SET best_images_dirty = 1;")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS image_file_path ON image (file_path);")
+
+    # Nextcloud file information for the incremental scan, the next scan lists every directory once
+    add_column(c, "image", "file_id", "INTEGER")
+    add_column(c, "image", "etag", "TEXT")
+    add_column(c, "image", "size", "INTEGER")
+    add_column(c, "image", "last_modified", "TIMESTAMP")
+    c.execute("CREATE TABLE IF NOT EXISTS directory (path TEXT PRIMARY KEY, etag TEXT NOT NULL);")
+
+    # Journal of the running scan, so an interrupted scan resumes, and the files which failed to be read
+    c.execute("CREATE TABLE IF NOT EXISTS ingest_directory (path TEXT PRIMARY KEY, etag TEXT NOT NULL);")
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS ingest_entry (
+            directory TEXT NOT NULL,
+            path TEXT NOT NULL,
+            is_dir BOOLEAN NOT NULL,
+            file_id INTEGER,
+            etag TEXT,
+            size INTEGER,
+            last_modified TIMESTAMP,
+            PRIMARY KEY (directory, path)
+        );"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS ingest_error (
+            path TEXT PRIMARY KEY,
+            etag TEXT,
+            attempts INTEGER NOT NULL,
+            error TEXT NOT NULL,
+            last_attempt TIMESTAMP NOT NULL,
+            next_attempt TIMESTAMP NOT NULL
+        );"""
+    )
+
+    # Images whose files were not found keep their reviews, a new file may take the path of a missing image
+    add_column(c, "image", "missing_since", "TIMESTAMP")
+    c.execute("DROP INDEX IF EXISTS image_file_path;")
+    c.execute("CREATE UNIQUE INDEX image_file_path ON image (file_path) WHERE missing_since IS NULL;")
+    c.execute("DELETE FROM collection_image WHERE image_id IN (SELECT id FROM image WHERE missing_since IS NOT NULL);")
+
+    conn.commit()
+    conn.close()
+    print("Database updated successfully.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import logging
+import struct
+from datetime import datetime
+from io import BytesIO
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from PIL import Image, UnidentifiedImageError
+from PIL.ExifTags import IFD
+
+from ..caching import download_range
+from .image import ROTATED_ORIENTATIONS, Custom_Image
+
+# Bytes fetched first, enough for the EXIF segment of most JPEGs and the meta box of most HEICs
+HEADER_CHUNK_BYTES = 64 * 1024
+# Bytes of a header at most, the rest of the file is never needed for the metadata
+MAX_HEADER_BYTES = 16 * 1024 * 1024
+ORIENTATION_TAG = 0x0112
+
+
+class _Header:
+    """The beginning of a file, extended by ranged reads when more of it is needed."""
+
+    def __init__(self, image_path: str):
+        self.image_path = image_path
+        self.data = download_range(image_path, 0, HEADER_CHUNK_BYTES)
+        self.complete = len(self.data) < HEADER_CHUNK_BYTES
+
+    def extend(self, size: int) -> bool:
+        """Read the file up to size bytes, False if the file is shorter than the data already read."""
+        if self.complete or len(self.data) >= MAX_HEADER_BYTES:
+            return False
+        size = min(max(size, 2 * len(self.data)), MAX_HEADER_BYTES)
+        chunk = download_range(self.image_path, len(self.data), size - len(self.data))
+        self.data += chunk
+        self.complete = len(self.data) < size
+        return bool(chunk)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read a range of the file, from the header if possible."""
+        if len(self.data) < offset + length and offset <= len(self.data):
+            self.extend(offset + length)
+        if offset + length <= len(self.data) or self.complete:
+            return self.data[offset : offset + length]
+        return download_range(self.image_path, offset, length)
+
+
+def _boxes(data: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """Iterate over the ISO base media boxes in data[start:end] as type, start of the payload and end."""
+    while start + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[start : start + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[start + 8 : start + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield box_type, start + header, start + size
+        start += size
+
+
+def _uint(data: bytes, offset: int, size: int) -> Tuple[int, int]:
+    """Read a big endian unsigned integer of size bytes and return it with the offset behind it."""
+    return int.from_bytes(data[offset : offset + size], "big"), offset + size
+
+
+def _parse_meta(data: bytes) -> Dict[str, Any]:
+    """Read the primary item, the item types, locations and properties of a HEIF meta box payload."""
+    meta = {"primary": None, "types": {}, "locations": {}, "properties": [], "associations": {}}
+    # The meta box and its item boxes are full boxes, with version and flags in front of the payload
+    for box_type, offset, box_end in _boxes(data, 4, len(data)):
+        version = data[offset]
+        if box_type == b"pitm":
+            meta["primary"], _ = _uint(data, offset + 4, 2 if version == 0 else 4)
+        elif box_type == b"iinf":
+            _parse_item_types(data, offset, box_end, meta["types"])
+        elif box_type == b"iloc":
+            _parse_locations(data, offset, meta["locations"])
+        elif box_type == b"iprp":
+            for property_type, property_offset, property_end in _boxes(data, offset, box_end):
+                if property_type == b"ipco":
+                    meta["properties"] = list(_boxes(data, property_offset, property_end))
+                elif property_type == b"ipma":
+                    _parse_associations(data, property_offset, meta["associations"])
+    return meta
+
+
+def _parse_item_types(data: bytes, offset: int, end: int, types: Dict[int, bytes]):
+    """Read the type of every item of an item info box."""
+    version = data[offset]
+    _, entries = _uint(data, offset + 4, 2 if version == 0 else 4)
+    for info_type, info_offset, _ in _boxes(data, entries, end):
+        info_version = data[info_offset]
+        if info_type == b"infe" and info_version >= 2:
+            item_id, item_end = _uint(data, info_offset + 4, 2 if info_version == 2 else 4)
+            # Behind the item id follow the protection index and the item type
+            types[item_id] = data[item_end + 2 : item_end + 6]
+
+
+def _parse_locations(data: bytes, offset: int, locations: Dict[int, List[Tuple[int, int]]]):
+    """Read the extents of the items of an item location box, which are stored in the file."""
+    version = data[offset]
+    sizes = (data[offset + 4] >> 4, data[offset + 4] & 15, data[offset + 5] >> 4, data[offset + 5] & 15)
+    item_count, position = _uint(data, offset + 6, 2 if version < 2 else 4)
+    for _ in range(item_count):
+        item_id, construction_method, extents, position = _parse_location(data, position, version, sizes)
+        # Items stored in the file, not inside the meta box
+        if construction_method == 0:
+            locations[item_id] = extents
+
+
+def _parse_location(
+    data: bytes, offset: int, version: int, sizes: Tuple[int, int, int, int]
+) -> Tuple[int, int, List[Tuple[int, int]], int]:
+    """Read one item of an item location box, returns item id, construction method, extents and the offset behind."""
+    offset_size, length_size, base_offset_size, index_size = sizes
+    item_id, offset = _uint(data, offset, 2 if version < 2 else 4)
+    construction_method = 0
+    if version in (1, 2):
+        construction_method, offset = _uint(data, offset, 2)
+        construction_method &= 15
+    # Skip the data reference index
+    base_offset, offset = _uint(data, offset + 2, base_offset_size)
+    extent_count, offset = _uint(data, offset, 2)
+    extents = []
+    for _ in range(extent_count):
+        if version in (1, 2) and index_size:
+            offset += index_size
+        extent_offset, offset = _uint(data, offset, offset_size)
+        extent_length, offset = _uint(data, offset, length_size)
+        extents.append((base_offset + extent_offset, extent_length))
+    return item_id, construction_method, extents, offset
+
+
+def _parse_associations(data: bytes, offset: int, associations: Dict[int, List[int]]):
+    """Read which properties (1-based indices into ipco) belong to which item."""
+    version, flags = data[offset], data[offset + 3]
+    entry_count, offset = _uint(data, offset + 4, 4)
+    for _ in range(entry_count):
+        item_id, offset = _uint(data, offset, 2 if version < 1 else 4)
+        count, offset = _uint(data, offset, 1)
+        for _ in range(count):
+            index, offset = _uint(data, offset, 2 if flags & 1 else 1)
+            associations.setdefault(item_id, []).append(index & (0x7FFF if flags & 1 else 0x7F))
+
+
+def _find_meta(header: _Header) -> Optional[Tuple[int, int]]:
+    """Find the meta box of a HEIF file, returns the start and the size of its payload."""
+    # Skip the top level boxes in front of the meta box, usually only the file type box
+    offset = 0
+    while True:
+        box = header.read(offset, 16)
+        if len(box) < 16:
+            return None
+        size, box_type = struct.unpack(">I4s", box[:8])
+        header_size = 8
+        if size == 1:
+            size, header_size = struct.unpack(">Q", box[8:])[0], 16
+        if size < header_size:
+            # A box reaching to the end of the file, nothing follows it
+            return None
+        if box_type == b"meta":
+            return offset + header_size, size - header_size
+        offset += size
+
+
+def _primary_size(data: bytes, meta: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """Get the displayed size of the primary image from its properties."""
+    size, rotated = None, False
+    for index in meta["associations"].get(meta["primary"], []):
+        if not 0 < index <= len(meta["properties"]):
+            continue
+        property_type, property_offset, _ = meta["properties"][index - 1]
+        if property_type == b"ispe":
+            size = struct.unpack(">II", data[property_offset + 4 : property_offset + 12])
+        elif property_type == b"irot":
+            # Rotation by 90 or 270 degrees
+            rotated = bool(data[property_offset] & 1)
+    if size and rotated:
+        size = size[::-1]
+    return size
+
+
+def _read_heif(header: _Header) -> Tuple[Optional[Image.Exif], Optional[Tuple[int, int]]]:
+    """Read the EXIF data and the displayed size of the primary image of a HEIF file.
+
+    Only the meta box and the EXIF item are read, the image data is skipped.
+    """
+    location = _find_meta(header)
+    if location is None:
+        return None, None
+    data = header.read(*location)
+    meta = _parse_meta(data)
+
+    exif = None
+    exif_items = [item_id for item_id, item_type in meta["types"].items() if item_type == b"Exif"]
+    if exif_items and exif_items[0] in meta["locations"]:
+        payload = b"".join(header.read(start, length) for start, length in meta["locations"][exif_items[0]])
+        # The item starts with the offset of the TIFF header behind the 4 bytes of the offset
+        tiff_offset = int.from_bytes(payload[:4], "big")
+        exif = Image.Exif()
+        exif.load(payload[4 + tiff_offset :])
+    return exif, _primary_size(data, meta)
+
+
+def _open_header(header: _Header) -> Image.Image:
+    """Open the image from its header, reading more of the file until the header is complete.
+
+    Pillow reads the header only when an image is opened, the pixels are decoded on first access.
+    """
+    while True:
+        try:
+            img = Image.open(BytesIO(header.data))
+            img.getexif()
+            return img
+        except (UnidentifiedImageError, SyntaxError, OSError, EOFError, struct.error):
+            if not header.extend(2 * len(header.data)):
+                raise
+
+
+def _gps_location(exif: Image.Exif) -> Optional[str]:
+    """Format the GPS position of the EXIF data as latitude and longitude in degrees."""
+    gps = exif.get_ifd(IFD.GPSInfo)
+    coordinates = []
+    # Latitude and longitude as degrees, minutes and seconds, each behind its reference
+    for reference, tag, negative in [(1, 2, "S"), (3, 4, "W")]:
+        try:
+            degrees, minutes, seconds = (float(value) for value in gps[tag])
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            return None
+        coordinate = degrees + minutes / 60 + seconds / 3600
+        coordinates.append(-coordinate if gps.get(reference) == negative else coordinate)
+    return f"{coordinates[0]:.6f}, {coordinates[1]:.6f}"
+
+
+def read_header_metadata(image_path: str) -> Custom_Image:
+    """Read date, location and dimensions of an image from the beginning of its file.
+
+    Only the first chunk of the file is fetched, more is read only if the header is larger. The pixels
+    are never decoded. For HEIF files the meta box is parsed directly, so the EXIF item is read
+    without the image data in front of it.
+
+    Args:
+    ----
+        image_path (str): Path to the file on Nextcloud.
+
+    Returns:
+    -------
+        Custom_Image: The image with date, location, width and height, all orientations applied.
+    """
+    header = _Header(image_path)
+    size = None
+    if header.data[4:8] == b"ftyp":
+        exif, size = _read_heif(header)
+    if size is None:
+        img = _open_header(header)
+        exif = img.getexif()
+        size = img.size
+        if img.format != "HEIF" and exif.get(ORIENTATION_TAG, 1) in ROTATED_ORIENTATIONS:
+            size = size[::-1]
+    exif = exif or Image.Exif()
+
+    date = None
+    for tag, ifd in [(0x9003, exif.get_ifd(IFD.Exif)), (0x0132, exif)]:
+        if tag in ifd:
+            try:
+                date = datetime.strptime(str(ifd[tag]).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+                break
+            except ValueError:
+                pass
+    if date is None:
+        logging.warning(f"Could not read data from File {image_path}")
+        date = datetime.today()
+
+    return Custom_Image(
+        image_id=0, path=image_path, location=_gps_location(exif), date=date, width=size[0], height=size[1]
+    )
@@ -8,15 +8,36 @@ from PIL.ExifTags import IFD, TAGS
 from pillow_heif import register_heif_opener
 from typeguard import typechecked
 
-from ..caching import load_image
+from ..caching import image_cache, load_image, original_path
 
 register_heif_opener()
 
+# EXIF orientations which swap width and height
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+# Transposition which corrects every EXIF orientation, 5 and 7 are mirrored along a diagonal
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
 
 class Custom_Image:
     """Class for images stored on Nextcloud."""
 
-    def __init__(self, image_id: int, path: str, location: Optional[str] = None, date: Optional[datetime] = None):
+    def __init__(
+        self,
+        image_id: int,
+        path: str,
+        location: Optional[str] = None,
+        date: Optional[datetime] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+    ):
         """Represent a custom image with metadata and functionality to interact with Nextcloud.
 
         Args:
@@ -25,56 +46,114 @@ class Custom_Image:
             path (str): Path to the file on Nextcloud
             location (str, optional): Location of the image. Defaults to None.
             date (str, optional): Date of the image when taken. Defaults to None.
+            width (int, optional): Width of the image after applying the orientation. Defaults to None.
+            height (int, optional): Height of the image after applying the orientation. Defaults to None.
         """
         self.path: str = path
         self.location: Optional[str] = location
         self.date: Optional[datetime] = date
+        self.width: Optional[int] = width
+        self.height: Optional[int] = height
         self.image: Optional[Image.Image] = None
         self.id: int = image_id
 
-    def _load_image(self):
+    def _load_image(self, cached: bool = True):
+        cached = cached and bool(self.id)
+        if cached:
+            self.image = image_cache.get((self.id, None))
+            if self.image is not None:
+                return
         self.image = load_image(image_id=self.id, image_path=self.path)
         self.image = self._apply_orientation(self.image)
+        if cached:
+            image_cache.put((self.id, None), self.image)
 
-    def _apply_orientation(self, img: Image.Image) -> Image.Image:
-        """Correct image orientation based on EXIF data."""
+    def _load_scaled_image(self, image_size: Tuple[int, int]) -> Image.Image:
+        """Decode the image at reduced resolution and scale it to fit into image_size.
+
+        The thumbnail is created before the image is decoded, so the codec can decode at a reduced
+        scale (JPEG DCT scaling, embedded HEIC thumbnails). If the target is not much smaller than
+        the source the codec decodes the full image.
+        """
+        img = load_image(image_id=self.id, image_path=self.path)
+        box = tuple(image_size)
+        if self._get_orientation(img) in ROTATED_ORIENTATIONS:
+            box = box[::-1]
+        img.thumbnail(box)
+        return self._apply_orientation(img)
+
+    @staticmethod
+    def _get_orientation(img: Image.Image) -> int:
+        """Read the EXIF orientation, without decoding the image."""
         try:
-            exif = img.getexif()
             orientation_tag = next(tag for tag, name in TAGS.items() if name == "Orientation")
-            orientation = exif.get(orientation_tag, 1)  # Default to normal orientation (1)
+            return img.getexif().get(orientation_tag, 1)  # Default to normal orientation (1)
+        except (AttributeError, KeyError, ValueError):
+            logging.warning("Could not determine orientation from EXIF data. Assuming normal orientation.")
+            return 1
 
-            # Apply transformations based on the orientation value
-            if orientation == 3:  # 180 degrees
-                img = img.rotate(180, expand=True)
-            elif orientation == 6:  # 90 degrees clockwise
-                img = img.rotate(270, expand=True)
-            elif orientation == 8:  # 90 degrees counterclockwise
-                img = img.rotate(90, expand=True)
+    def _apply_orientation(self, img: Image.Image) -> Image.Image:
+        """Correct image orientation based on EXIF data."""
+        method = ORIENTATION_TRANSPOSE.get(self._get_orientation(img))
+        return img.transpose(method) if method is not None else img
 
-        except (AttributeError, KeyError, ValueError):
-            logging.warning("Could not determine orientation from EXIF data. Returning original image.")
+    def get_image(self, image_size: Optional[Tuple[int, int]] = None, cached: bool = True) -> Image.Image:
+        """Load and return the image, applying orientation if needed.
 
-        return img
+        Decoded images are shared with other requests through the image cache, don't modify them in place.
 
-    def get_image(self, image_size: Optional[Tuple[int, int]] = None) -> Image.Image:
-        """Load and return the image, applying orientation if needed."""
-        if not self.image:
-            self._load_image()
+        Args:
+        ----
+            image_size (Tuple[int, int], optional): Box to scale the image into. Defaults to the full size.
+            cached (bool, optional): Use the image cache. The cache only knows the image id, images which
+                outlive this request are decoded from the original on disk instead. Defaults to True.
+        """
+        cached = cached and bool(self.id)
         if image_size:
-            img = self.image.copy()
-            img.thumbnail(image_size)
+            key = (self.id, tuple(image_size))
+            img = image_cache.get(key) if cached else None
+            if img is None:
+                if not self.image and cached:
+                    self.image = image_cache.get((self.id, None))
+                if self.image:
+                    img = self.image.copy()
+                    img.thumbnail(image_size)
+                else:
+                    img = self._load_scaled_image(image_size)
+                if cached:
+                    image_cache.put(key, img)
             return img
 
+        if not self.image:
+            self._load_image(cached)
         return self.image
 
+    def get_dimensions(self) -> Tuple[int, int]:
+        """Get width and height of the image after applying the orientation.
+
+        If the dimensions are not known yet the whole original is downloaded, the pixels are not decoded.
+        Use `header.read_header_metadata` to read them with ranged reads of the header only.
+        """
+        if self.width is None or self.height is None:
+            if self.image is not None:
+                self.width, self.height = self.image.size
+            else:
+                img = load_image(image_id=self.id, image_path=self.path)
+                self.width, self.height = img.size
+                if self._get_orientation(img) in ROTATED_ORIENTATIONS:
+                    self.width, self.height = self.height, self.width
+        return self.width, self.height
+
+    def get_original_path(self) -> Path:
+        """Get the path of the unmodified original file, without decoding it."""
+        return original_path(image_path=self.path, image_id=self.id)
+
     @property
     def name(self):
         return Path(self.path).name
 
     def get_preview(self):
-        img = self.get_image().copy()
-        img.thumbnail([512, 512])
-        return img
+        return self.get_image(image_size=(512, 512))
 
     def get_location(self) -> str:
         if self.location:
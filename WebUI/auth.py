@@ -26,7 +26,7 @@ def change_password():
         confirm_new_password = request.form["confirm_new_password"]
         new_password = request.form["new_password"]
         old_password = request.form["old_password"]
-        db = db_wrapper.ImageTinderDatabase()
+        db = db_wrapper.get_db()
         error = None
         user_id = session["user_id"]
         if not confirm_new_password:
@@ -60,7 +60,7 @@ def login():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        db = db_wrapper.ImageTinderDatabase()
+        db = db_wrapper.get_db()
 
         try:
             user = db.get_user_id_from_table(username=username, password=password)
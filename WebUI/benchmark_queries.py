@@ -0,0 +1,132 @@
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .database import ImageTinderDatabase
+
+SCHEMA = Path(Path(__file__).parent.parent, "Database", "schema.sql")
+
+
+class InlinedDatabase(ImageTinderDatabase):
+    """Database wrapper which inlines the parameters into the statement, like the queries built with f-strings.
+
+    Every distinct value creates a distinct statement, so SQLite has to compile it again.
+    """
+
+    def _execute_sql(
+        self, statement: str, get_result: bool = False, parameters: Sequence[Any] = ()
+    ) -> Optional[List[Any]]:
+        for parameter in parameters:
+            literal = f"'{parameter}'" if isinstance(parameter, str) else str(int(parameter))
+            statement = statement.replace("?", literal, 1)
+        return super()._execute_sql(statement, get_result)
+
+
+def create_database(database_name: str, nr_images: int):
+    """Create a database with one user reviewing one collection of nr_images images."""
+    connection = sqlite3.connect(database_name)
+    connection.executescript(SCHEMA.read_text())
+    start = datetime(2024, 1, 1)
+    connection.executemany(
+        "INSERT INTO image (id, file_path, creation_date, image_location) VALUES (?, ?, ?, 'Unknown location');",
+        [(i, f"/Photos/{i}.jpg", str(start + timedelta(minutes=7 * i))) for i in range(1, nr_images + 1)],
+    )
+    connection.execute("INSERT INTO user (id, email, password) VALUES (1, 'user', 'x');")
+    connection.execute(
+        "INSERT INTO collection (id, name, start_date, end_date) VALUES (1, 'all', ?, ?);",
+        (str(start), str(start + timedelta(minutes=7 * nr_images))),
+    )
+    connection.execute("INSERT INTO user_collection (user_id, collection_id) VALUES (1, 1);")
+    connection.executemany(
+        "INSERT INTO user_image (user_id, image_id, rating) VALUES (1, ?, ?);",
+        [(i, random.randint(0, 5)) for i in range(1, nr_images + 1, 2)],
+    )
+    connection.execute(
+        """INSERT INTO collection_image (collection_id, image_id, creation_date)
+           SELECT c.id, i.id, i.creation_date
+           FROM collection c JOIN image i ON i.creation_date BETWEEN c.start_date AND c.end_date;"""
+    )
+    connection.commit()
+    connection.close()
+
+
+def hot_queries(db: ImageTinderDatabase) -> Dict[str, Callable[[int], Any]]:
+    """Get the queries run for every swipe of the review page."""
+    return {
+        "get_next_image_ids": lambda image_id: db.get_next_image_ids(1, 1, image_id, 10),
+        "get_previous_image_id": lambda image_id: db.get_previous_image_id(1, 1, image_id),
+        "get_review": lambda image_id: db.get_review(1, image_id),
+        "can_user_access_image": lambda image_id: db.can_user_access_image(1, image_id),
+        "get_image": db.get_image,
+        "get_adjacent_images": lambda image_id: db.get_adjacent_images(1, 1, image_id, 1, 10),
+        "get_reviews": lambda image_id: db.get_reviews(1, list(range(image_id, image_id + 10))),
+    }
+
+
+def python_best_of_day(
+    db: ImageTinderDatabase, user_id: int, config_id: int, min_rating: int, max_results_per_day: int
+):
+    """Filter like before the filter was fixed, all rated images are fetched and counted per day in Python."""
+    query = """SELECT ci.image_id, ui.rating, ci.creation_date
+               FROM collection_image ci
+               INNER JOIN user_image ui ON ui.image_id = ci.image_id AND ui.user_id = ?
+               WHERE ci.collection_id = ? AND ui.rating >= ?
+               ORDER BY ci.creation_date ASC, ci.image_id ASC"""
+    last_date = datetime(1900, 11, 1)
+    results_per_day = 0
+    images = []
+    for image_id, _, creation_date in db._execute_sql(query, True, (user_id, config_id, min_rating)):
+        image_date = datetime.fromisoformat(creation_date)
+        if image_date > last_date:
+            last_date = image_date
+            results_per_day = 0
+        results_per_day += 1
+        if results_per_day <= max_results_per_day or max_results_per_day == 0:
+            images.append(image_id)
+    return images
+
+
+def measure(query: Callable[[int], Any], image_ids: List[int]) -> float:
+    """Run the query once for every image id and return the mean latency in microseconds."""
+    start = time.perf_counter()
+    for image_id in image_ids:
+        query(image_id)
+    return (time.perf_counter() - start) / len(image_ids) * 1e6
+
+
+def main():
+    """Compare the latency of the review queries with inlined and with bound parameters."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nr-images", "-n", type=int, default=20000)
+    parser.add_argument("--calls", "-c", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_name = str(Path(tmp_dir, "benchmark.sqlite"))
+        create_database(database_name, args.nr_images)
+        image_ids = [random.randint(2, args.nr_images) for _ in range(args.calls)]
+
+        inlined = hot_queries(InlinedDatabase(database_name))
+        bound = hot_queries(ImageTinderDatabase(database_name))
+        print(f"{'query':<24}{'inlined [us]':>14}{'bound [us]':>14}")
+        for name in bound:
+            # Warm up the page cache so both variants read from memory
+            measure(bound[name], image_ids[:100])
+            print(f"{name:<24}{measure(inlined[name], image_ids):>14.1f}{measure(bound[name], image_ids):>14.1f}")
+
+        db = ImageTinderDatabase(database_name)
+        print(f"\n{'best of day':<24}{'before [ms]':>14}{'now [ms]':>14}")
+        for min_rating, max_results_per_day in [(0, 0), (3, 0), (0, 3), (4, 1)]:
+            filters = (1, 1, min_rating, max_results_per_day)
+            before = measure(lambda _, filters=filters: python_best_of_day(db, *filters), [0] * 5)
+            now = measure(lambda _, filters=filters: db.get_images_ids_filtered(*filters), [0] * 5)
+            print(f"{f'min {min_rating}, per day {max_results_per_day}':<24}{before / 1000:>14.1f}{now / 1000:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,48 @@
+import hashlib
 import logging
 import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from io import BytesIO
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, Dict, Hashable, Iterable, Optional, Set, Tuple, TypeVar
+from urllib.parse import quote
 
 from dotenv import load_dotenv
 from nc_py_api import Nextcloud
+from nc_py_api._exceptions import check_error
+from nc_py_api.files._files import dav_get_obj_path
 from PIL import Image
 from pillow_heif import register_heif_opener
 
 load_dotenv(override=True)
 
 register_heif_opener()
+T = TypeVar("T")
 CACHE_DIR = "./Cache/"
-MAX_IMAGES = 200
+ORIGINALS_DIR = Path(CACHE_DIR, "originals").absolute()
+DERIVATIVE_DIR = Path(CACHE_DIR, "derivatives").absolute()
+# Longest edge in pixels of every derivative size class, None keeps the original resolution.
+SIZE_CLASSES: Dict[str, Optional[int]] = {
+    "placeholder": 32,
+    "preview": 512,
+    "view_1280": 1280,
+    "view_1920": 1920,
+    "view_2560": 2560,
+    "view_3840": 3840,
+    "full": None,
+}
+ORIGINAL_NAME = re.compile(r"(\d+)-([0-9a-f]+)\.\w+")
+CACHE_BUDGET_BYTES = int(os.environ.get("IMAGE_SORT_CACHE_MB", "2048")) * 1024 * 1024
+PIN_FILE = "_ignore_.txt"
+MEMORY_CACHE_BUDGET_BYTES = int(os.environ.get("IMAGE_SORT_MEMORY_CACHE_MB", "256")) * 1024 * 1024
 debug = False
 
 # Ensure your download folder exists
-if not os.path.exists(CACHE_DIR):
-    os.makedirs(CACHE_DIR)
+if not os.path.exists(ORIGINALS_DIR):
+    os.makedirs(ORIGINALS_DIR)
 
 try:
     nextcloud_instance = Nextcloud(
@@ -40,11 +64,391 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 
+class SingleFlight:
+    """Run a function only once for concurrent callers of the same key.
+
+    The first caller of a key runs the function, every caller arriving while it runs waits
+    for it and gets the same result or exception.
+    """
+
+    def __init__(self):
+        """Create a group without running calls."""
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], T]) -> T:
+        """Run the function for the key or wait for the already running call of the key."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class DiskCache:
+    """Byte budgeted least recently used cache of the files in the cache directory.
+
+    Sizes and access order of the cached files are held in an in-memory index, which is built by
+    scanning the cache directory once. Afterwards every access or write only updates the index and
+    eviction removes just as many of the least recently used files as needed to get back under the
+    budget. Files of pinned images are never evicted.
+    """
+
+    def __init__(self, cache_dir: str, budget_bytes: int):
+        """Create the cache index, the directory is scanned on first use.
+
+        Args:
+        ----
+            cache_dir (str): Directory with the cached files.
+            budget_bytes (int): Maximum number of bytes of all cached files.
+        """
+        self.cache_dir = Path(cache_dir).absolute()
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()  # least recently used first
+        self._pinned_entries: Dict[str, int] = {}
+        self._pinned_ids: Set[int] = set()
+        self._indexed = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _image_id(path: str) -> Optional[int]:
+        """Get the image id of a cached file, all cached files start with the id of their image."""
+        match = re.match(r"\d+", Path(path).name)
+        return int(match.group()) if match else None
+
+    def _read_pins(self) -> Set[int]:
+        try:
+            with open(Path(self.cache_dir, PIN_FILE), "r") as file:
+                return {image_id for line in file if (image_id := self._image_id(line.strip())) is not None}
+        except FileNotFoundError:
+            return set()
+
+    def _ensure_index(self):
+        if self._indexed:
+            return
+        self._pinned_ids = self._read_pins()
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name == PIN_FILE or name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(files):
+            self._insert(path, size)
+        self._indexed = True
+
+    def _insert(self, key: str, size: int):
+        self._discard(key)
+        if self._image_id(key) in self._pinned_ids:
+            self._pinned_entries[key] = size
+        else:
+            self._entries[key] = size
+        self.total_bytes += size
+
+    def _discard(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is None:
+            size = self._pinned_entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def touch(self, path: os.PathLike):
+        """Mark a cached file as recently used, files written by other processes are added to the index."""
+        key = str(Path(path).absolute())
+        with self._lock:
+            self._ensure_index()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            elif key not in self._pinned_entries:
+                # E.g. a derivative rendered by search_images after the index was built
+                try:
+                    self._insert(key, os.path.getsize(key))
+                except FileNotFoundError:
+                    pass
+
+    def add(self, path: os.PathLike):
+        """Register a newly written file and evict old files if the budget is exceeded."""
+        key = str(Path(path).absolute())
+        size = os.path.getsize(key)
+        with self._lock:
+            self._ensure_index()
+            self._insert(key, size)
+        self.evict()
+
+    def remove(self, path: os.PathLike):
+        """Delete a cached file and remove it from the index."""
+        key = str(Path(path).absolute())
+        with self._lock:
+            self._discard(key)
+        try:
+            os.remove(key)
+        except FileNotFoundError:
+            pass
+
+    def pin(self, image_ids: Iterable[int]):
+        """Replace the pinned images and persist them in the pin file.
+
+        Args:
+        ----
+            image_ids (Iterable[int]): Ids of the images whose cached files must not be evicted.
+        """
+        with self._lock:
+            self._ensure_index()
+            self._pinned_ids = set(image_ids)
+            with open(Path(self.cache_dir, PIN_FILE), "w+") as file:
+                file.writelines([f"{image_id}.jpg\n" for image_id in self._pinned_ids])
+
+            for key, size in list(self._pinned_entries.items()):
+                if self._image_id(key) not in self._pinned_ids:
+                    del self._pinned_entries[key]
+                    self._entries[key] = size
+            for key in [key for key in self._entries if self._image_id(key) in self._pinned_ids]:
+                self._pinned_entries[key] = self._entries.pop(key)
+
+    def evict(self) -> int:
+        """Remove the least recently used files until the cache fits into its budget.
+
+        Returns
+        -------
+            int: The number of removed files.
+        """
+        removed = 0
+        while True:
+            with self._lock:
+                self._ensure_index()
+                if self.total_bytes <= self.budget_bytes or not self._entries:
+                    break
+                key, size = self._entries.popitem(last=False)
+                self.total_bytes -= size
+            try:
+                os.remove(key)
+            except FileNotFoundError:
+                pass
+            logging.debug(f"Evicted {key} from the cache")
+            removed += 1
+        return removed
+
+
+disk_cache = DiskCache(CACHE_DIR, CACHE_BUDGET_BYTES)
+
+
+class ImageMemoryCache:
+    """Thread-safe, byte bounded least recently used cache of decoded images.
+
+    The cache is shared by all request threads and keyed by ``(image_id, size)``, where a size of
+    None is the full image. The cached images are shared, so callers must not modify them in place.
+    """
+
+    def __init__(self, budget_bytes: int):
+        """Create an empty cache.
+
+        Args:
+        ----
+            budget_bytes (int): Maximum number of bytes of all decoded pixels in the cache.
+        """
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[int, Hashable], Tuple[Image.Image, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size_of(image: Image.Image) -> int:
+        return image.width * image.height * len(image.getbands())
+
+    def get(self, key: Tuple[int, Hashable]) -> Optional[Image.Image]:
+        """Get a cached image, None if it is not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Tuple[int, Hashable], image: Image.Image):
+        """Add a decoded image and evict the least recently used images if the budget is exceeded."""
+        size = self._size_of(image)
+        if size > self.budget_bytes:
+            return
+        image.load()
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.total_bytes -= old_entry[1]
+            self._entries[key] = (image, size)
+            self.total_bytes += size
+            while self.total_bytes > self.budget_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def invalidate(self, image_id: int):
+        """Remove all cached sizes of an image, e.g. when its source changed."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == image_id]:
+                self.total_bytes -= self._entries.pop(key)[1]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Get the hit and miss counters and the current usage of the cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.total_bytes}
+
+
+image_cache = ImageMemoryCache(MEMORY_CACHE_BUDGET_BYTES)
+downloads = SingleFlight()
+_originals: Dict[int, Path] = {}
+_originals_scanned = threading.Event()
+_originals_lock = threading.Lock()
+
+
+def temporary_path(path: os.PathLike) -> Path:
+    """Get a unique temporary path next to the path, to write a file before renaming it into place."""
+    path = Path(path)
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _download(image_path: str) -> bytes:
+    if debug:
+        # In debug mode load from local file system
+        with open(image_path, "rb") as file:
+            return file.read()
+    return nextcloud_instance.files.download(image_path)
+
+
+def download_range(image_path: str, start: int, length: int) -> bytes:
+    """Download length bytes of an image from the offset start, fewer at the end of the file.
+
+    Nextcloud is asked for the range only, with an HTTP Range request against WebDAV.
+    In debug mode the range is read from the local file.
+    """
+    if debug:
+        with open(image_path, "rb") as file:
+            file.seek(start)
+            return file.read(length)
+    # nc_py_api only downloads whole files, the range is requested through its WebDAV session. The session
+    # is not part of the public API of nc_py_api, so its version is pinned in requirements.txt.
+    session = nextcloud_instance._session
+    response = session.adapter_dav.get(
+        quote(dav_get_obj_path(session.user, image_path)), headers={"Range": f"bytes={start}-{start + length - 1}"}
+    )
+    if response.status_code == 416:
+        # The range starts behind the end of the file
+        return b""
+    check_error(response, f"download range: user={session.user}, path={image_path}")
+    if response.status_code == 200:
+        # The server ignored the range and sent the whole file
+        return response.content[start : start + length]
+    return response.content
+
+
+def _originals_index() -> Dict[int, Path]:
+    """Get the index of cached originals by image id, the directory is only scanned on first use."""
+    with _originals_lock:
+        if not _originals_scanned.is_set():
+            for path in ORIGINALS_DIR.iterdir():
+                match = ORIGINAL_NAME.fullmatch(path.name)
+                if match:
+                    _originals[int(match.group(1))] = path
+            _originals_scanned.set()
+        return _originals
+
+
+def invalidate_image(image_id: int):
+    """Remove the cached original, the derivatives and the decoded copies of an image whose source changed."""
+    index = _originals_index()
+    with _originals_lock:
+        path = index.pop(image_id, None)
+    if path is not None:
+        disk_cache.remove(path)
+    # Derivatives of all size classes, see derivatives.derivative_path
+    for size_class in SIZE_CLASSES:
+        disk_cache.remove(Path(DERIVATIVE_DIR, f"{image_id}_{size_class}.jpg"))
+    image_cache.invalidate(image_id)
+
+
+def _cache_original(image_path: str, image_id: int) -> Path:
+    """Download the original bytes of an image and write them atomically to the cache."""
+    path = _originals_index().get(image_id)
+    if path is not None and path.exists():
+        # Cached by a concurrent call, which finished after the caller looked the image up
+        return path
+
+    payload = _download(image_path)
+    digest = hashlib.sha256(payload).hexdigest()[:16]
+    path = Path(ORIGINALS_DIR, f"{image_id}-{digest}{Path(image_path).suffix.lower()}")
+    tmp_path = temporary_path(path)
+    try:
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+
+    index = _originals_index()
+    if index.get(image_id, path) != path:
+        # The content of the source changed
+        invalidate_image(image_id)
+    with _originals_lock:
+        index[image_id] = path
+    disk_cache.add(path)
+    return path
+
+
+def original_path(image_path: str, image_id: int) -> Path:
+    """Get the path of the unmodified original of an image, downloading it if it is not cached.
+
+    Originals are stored exactly as delivered by Nextcloud, named by image id and content hash
+    and keeping their original extension. Concurrent misses for the same image share a single
+    download. In debug mode the local file is used directly.
+
+    Args:
+    ----
+        image_path (str): The path to the image on Nextcloud.
+        image_id (int): Identifier of the image.
+
+    Returns:
+    -------
+        Path: Path of the original file.
+    """
+    if debug:
+        return Path(image_path)
+
+    path = _originals_index().get(image_id)
+    if path is not None and path.exists():
+        disk_cache.touch(path)
+        return path
+    return downloads.do(image_id, lambda: _cache_original(image_path, image_id))
+
+
 def load_image(image_path: str, image_id: Optional[int] = None) -> Image.Image:
     """Load image from the cache or from Nextcloud if not cached.
 
-    This function checks if the image is already cached locally. If not, it fetches
-    the image from Nextcloud and saves it to the cache.
+    This function opens the cached original of the image. If it is not cached yet, the
+    original is fetched from Nextcloud and stored unmodified in the cache.
 
     Args:
     ----
@@ -53,26 +457,16 @@ def load_image(image_path: str, image_id: Optional[int] = None) -> Image.Image:
 
     Returns:
     -------
-        Image.Image: The loaded image in RGB mode.
+        Image.Image: The loaded image.
     """
-    # Check if the images is in the cache
-    if image_id and os.path.exists(f"{CACHE_DIR}{image_id}.jpg"):
-        image = Image.open(f"{CACHE_DIR}{image_id}.jpg")
-    else:
-        if debug:
-            # If not in cache or debug mode, load from local file system
-            image = Image.open(image_path)
-        else:
-            rgb_image = nextcloud_instance.files.download(image_path)
-            image = Image.open(BytesIO(rgb_image))
-        if image_id:
-            try:
-                image.save(f"{CACHE_DIR}{image_id}.jpg", exif=image.getexif())
-            except Exception as e:
-                logging.warning(e)
-                logging.warning(f"Error saving exif data of {image_path}")
-                image.save(f"{CACHE_DIR}{image_id}.jpg")
-    return image
+    if not image_id:
+        return Image.open(BytesIO(_download(image_path)))
+
+    try:
+        return Image.open(original_path(image_path, image_id))
+    except FileNotFoundError:
+        # The original was evicted in the meantime
+        return Image.open(original_path(image_path, image_id))
 
 
 def cache_images(image_ids: Dict[int, str]):
@@ -90,46 +484,14 @@ def cache_images(image_ids: Dict[int, str]):
 
 
 def static_cache(image_ids: Dict[int, str]):
-    """Cache the provided images and writes a cache tracking file.
+    """Cache the provided images and pin them in the cache.
 
-    This function caches the images and then creates or updates a file called "_ignore_.txt"
-    in the cache directory, which tracks the images that are cached and should not be deleted.
+    This function pins the images, so they are tracked in the "_ignore_.txt" file in the cache
+    directory and are never evicted, and then caches them.
 
     Args:
     ----
         image_ids (Dict[int, str]): A dictionary mapping image IDs to their Nextcloud paths.
     """
+    disk_cache.pin(image_ids.keys())
     cache_images(image_ids=image_ids)
-    with open(Path(CACHE_DIR, "_ignore_.txt"), "w+") as file:
-        file.writelines([f"{key}.jpg\n" for key in image_ids.keys()])
-
-
-def remove_old_images():
-    """Remove the oldest cached images to keep the cache size within the limit.
-
-    This function checks the number of files in the cache directory and deletes
-    the oldest files if the total number exceeds the `MAX_IMAGES` limit. The files to
-    exclude from deletion are tracked in the "_ignore_.txt" file.
-
-    This function ensures that only the most recent images are kept in the cache
-    and older, unused images are removed automatically.
-    """
-    try:
-        with open(Path(CACHE_DIR, "_ignore_.txt"), "r") as file:
-            exception_list = file.readlines()
-    except FileNotFoundError:
-        exception_list = []
-
-    files = [
-        (f, os.path.getmtime(os.path.join(CACHE_DIR, f)))
-        for f in os.listdir(CACHE_DIR)
-        if os.path.isfile(os.path.join(CACHE_DIR, f)) and f not in exception_list
-    ]
-    num_to_remove = max(0, len(files) - MAX_IMAGES)
-    files.sort(key=lambda x: x[1])  # Sort by the second element, which is the modification time
-
-    for i in range(num_to_remove):
-        file_to_remove = files[i][0]
-        file_path = os.path.join(CACHE_DIR, file_to_remove)
-        print(f"Removing oldest image: {file_to_remove}")
-        os.remove(file_path)
@@ -1,16 +1,20 @@
-import io
 import logging
 import sqlite3
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 from tempfile import gettempdir
-from typing import Dict, Generator, Optional
+from typing import Deque, Dict, Generator, List, Optional
 from zipfile import ZipFile
 
 from flask import Blueprint, jsonify, redirect, render_template, request, send_file, session
 from typeguard import typechecked
 
 from .database import get_db
+from .prefetch import PREFETCH_AHEAD, prefetcher
+
+# Number of image ids the gallery reads from the database at once
+GALLERY_BATCH_SIZE = 100
 
 
 class Backend:
@@ -19,20 +23,25 @@ class Backend:
     def __init__(self):
         """Backend class to manage sessions and generators."""
         self.generators: Dict[int, Generator[None, None, int]] = {}
+        self.lookahead: Dict[str, Deque[int]] = {}
 
     @typechecked
     def add_session(self, session_id: str, config_id: int):
         print(f"-----------\n Adding Session with ID {session_id}")
         self.generators[session_id] = self.image_gallery_generator(config_id=config_id)
+        self.lookahead[session_id] = deque()
 
     @typechecked
     @staticmethod
     def image_gallery_generator(config_id: int) -> Generator[int, None, None]:
-        db = get_db()
-        ids = db.get_all_image_ids(config_id=config_id)
-
-        for image_id in ids:
-            yield image_id
+        cursor = None
+        while True:
+            # The generator is consumed by several requests, use the database handler of the current one
+            ids = get_db().get_collection_page(config_id=config_id, cursor=cursor, count=GALLERY_BATCH_SIZE)
+            yield from ids
+            if len(ids) < GALLERY_BATCH_SIZE:
+                return
+            cursor = ids[-1]
 
     @typechecked
     @staticmethod
@@ -57,9 +66,35 @@ class Backend:
             min_rating=min_rating,
             max_results_per_day=max_results_per_day,
         )
+        self.lookahead[session_id] = deque()
+
+    @typechecked
+    def peek_next_images(self, session_id: str, count: int) -> List[int]:
+        """Get the upcoming image ids of the session without consuming them."""
+        buffered = self.lookahead.setdefault(session_id, deque())
+        while len(buffered) < count:
+            image_id = next(self.generators[session_id], None)
+            if image_id is None:
+                break
+            buffered.append(image_id)
+        return list(buffered)
+
+    @typechecked
+    def get_next_images(self, session_id: str, count: int) -> List[int]:
+        """Consume the next count image ids of the session, fewer if the session runs out of images."""
+        image_ids = []
+        while len(image_ids) < count:
+            image_id = self.get_next_image(session_id)
+            if image_id is None:
+                break
+            image_ids.append(image_id)
+        return image_ids
 
     @typechecked
     def get_next_image(self, session_id: str) -> Optional[int]:
+        buffered = self.lookahead.get(session_id)
+        if buffered:
+            return buffered.popleft()
         try:
             return next(self.generators[session_id])
         except StopIteration:
@@ -68,6 +103,13 @@ class Backend:
 
 customBackend = Backend()
 
+
+def prefetch_gallery():
+    """Render the previews of the next gallery images of the session in the background."""
+    upcoming = customBackend.peek_next_images(session["uuid"], PREFETCH_AHEAD)
+    prefetcher.schedule(session["user_id"], upcoming, "preview")
+
+
 bp = Blueprint("configs", __name__, url_prefix="/configs")
 
 
@@ -78,6 +120,8 @@ def overview():
     db = get_db()
     if "user_id" not in session:
         return redirect("/auth/login")
+    # The user left the review or the gallery
+    prefetcher.cancel(session["user_id"])
     collections = db.get_user_collections(user_id=session["user_id"])
     collections = [col.dict for col in collections]
 
@@ -92,6 +136,7 @@ def overview():
 def gallery(collection_id):
     """Show all images of the collection in a gallery."""
     customBackend.add_session(session["uuid"], int(collection_id))
+    prefetch_gallery()
     return render_template(
         "configs/gallery.html",
     )
@@ -174,6 +219,7 @@ def filter():
                 min_rating=data.get("minRating", 0),
                 max_results_per_day=int(data.get("bestOfDay", 0)),
             )
+        prefetch_gallery()
         return jsonify({"success": True})
 
     return jsonify({"error": "Invalid request method"}), 405
@@ -205,11 +251,7 @@ def download_gallery():
             print(temp_dir)
             for file_id in images:
                 img = db.get_image(file_id)
-                img_buffer = io.BytesIO()
-                img.get_image().save(img_buffer, format="JPEG" if img.name.endswith(".jpg") else "PNG")
-                img_buffer.seek(0)
-
-                zip_file.writestr(img.name, img_buffer.read())
+                zip_file.write(img.get_original_path(), arcname=img.name)
 
         # Return the ZIP file to the client
         return send_file(Path(temp_dir, zip_filename), as_attachment=True)
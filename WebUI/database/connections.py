@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+BUSY_TIMEOUT_MS = 10_000
+CACHE_SIZE_KB = 16_384
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+# Prepared statements kept per connection, enough for all statement templates of the database wrapper
+STATEMENT_CACHE_SIZE = 256
+
+_PRAGMAS = [
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS};",
+    "PRAGMA synchronous = NORMAL;",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KB};",
+    f"PRAGMA mmap_size = {MMAP_SIZE_BYTES};",
+]
+
+
+class ConnectionManager:
+    """Reusable, tuned connections to one SQLite database.
+
+    Every thread reads through its own connection, which lives as long as the thread. All writes of
+    the process go through a single writer connection guarded by a lock. The database runs in WAL
+    mode, so readers never wait for the writer and the writer only waits for other processes.
+    """
+
+    def __init__(self, database_name: str):
+        """Create the manager, connections are opened on first use.
+
+        Args:
+        ----
+            database_name (str): Path of the sqlite file.
+        """
+        self.database_name = database_name
+        self._local = threading.local()
+        self._writer = None
+        self._write_lock = threading.RLock()
+
+    def _connect(self, pragmas: List[str], check_same_thread: bool = True) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self.database_name,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=check_same_thread,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in _PRAGMAS + pragmas:
+            connection.execute(pragma)
+        return connection
+
+    def _open_writer(self):
+        # The writer switches the database to WAL before the first reader connects
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect(["PRAGMA journal_mode = WAL;"], check_same_thread=False)
+
+    def reader(self) -> sqlite3.Connection:
+        """Get the read only connection of the current thread."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self._open_writer()
+            connection = self._connect(["PRAGMA query_only = ON;"])
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """Get exclusive access to the writer connection.
+
+        The transaction is committed when the block is left, or rolled back on an exception.
+        """
+        with self._write_lock:
+            self._open_writer()
+            with self._writer:
+                yield self._writer
+
+    def close(self):
+        """Close the writer and the reader of the current thread."""
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+_managers: Dict[Path, ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_connection_manager(database_name: str) -> ConnectionManager:
+    """Get the connection manager shared by all users of a database file in this process."""
+    key = Path(database_name).absolute()
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = ConnectionManager(database_name=str(key))
+        return _managers[key]
@@ -1,7 +1,11 @@
+import heapq
+import json
 import random
 import sqlite3
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 from flask import g
 from typeguard import typechecked
@@ -9,6 +13,27 @@ from werkzeug.security import check_password_hash, generate_password_hash
 
 from WebUI.Image import Custom_Image
 
+from .connections import get_connection_manager
+from .review_queue import get_review_queue, write_reviews
+
+# Rows of unchanged images are not written, missing images keep their path but leave it to new images
+IMAGE_UPSERT = """INSERT INTO image (file_path, creation_date, image_location, width, height, aspect_ratio)
+                  VALUES (?, ?, ?, ?, ?, ?)
+                  ON CONFLICT (file_path) WHERE missing_since IS NULL DO UPDATE SET
+                      creation_date = excluded.creation_date,
+                      image_location = excluded.image_location,
+                      width = excluded.width,
+                      height = excluded.height,
+                      aspect_ratio = excluded.aspect_ratio
+                  WHERE (creation_date, image_location, width, height, aspect_ratio)
+                      IS NOT (excluded.creation_date, excluded.image_location, excluded.width,
+                              excluded.height, excluded.aspect_ratio);"""
+
+
+def _aspect_ratio(width: Optional[int], height: Optional[int]) -> Optional[float]:
+    """Get the aspect ratio of an image, None if its height is unknown or 0."""
+    return width / height if width is not None and height else None
+
 
 class UserNotExisting(Exception):
     """Exception for non existing user."""
@@ -35,6 +60,7 @@ class Collection:
     ----------
         name (str): The name of the collection.
         images (int): The number of images in the collection.
+        rated_images (int): The number of images in the collection rated by the user.
         start_date (datetime): The start date of the collection, as an ISO-formatted datetime object.
         end_date (datetime): The end date of the collection, as an ISO-formatted datetime object.
         preview_image (Optional[int]): The index of the preview image in the collection. Defaults to None.
@@ -47,7 +73,14 @@ class Collection:
     """
 
     def __init__(
-        self, id: int, name: str, images: int, start_date: str, end_date: str, preview_image: Optional[int] = None
+        self,
+        id: int,
+        name: str,
+        images: int,
+        start_date: str,
+        end_date: str,
+        preview_image: Optional[int] = None,
+        rated_images: int = 0,
     ):
         """Initialize a new instance of the Collection class.
 
@@ -59,10 +92,12 @@ class Collection:
             start_date (str): The start date of the collection as an ISO-formatted string.
             end_date (str): The end date of the collection as an ISO-formatted string.
             preview_image (Optional[int]): The index of the preview image in the collection. Defaults to None.
+            rated_images (int): The number of images in the collection rated by the user. Defaults to 0.
         """
         self.id = id
         self.name = name
         self.images = images
+        self.rated_images = rated_images
         self.start_date = datetime.fromisoformat(start_date)
         self.end_date = datetime.fromisoformat(end_date)
         self.preview_image = preview_image
@@ -88,6 +123,8 @@ class Collection:
             "end_date": self.end_date_str,
             "view_uri": f"/configs/gallery/{self.id}",
             "id": self.id,
+            "images": self.images,
+            "rated_images": self.rated_images,
         }
 
 
@@ -97,24 +134,45 @@ class ImageTinderDatabase:
     def __init__(self, database_name: str = "../ImageSorting.sqlite") -> None:
         """Create the database wrapper.
 
+        The wrapper is cheap to create, all wrappers of a database file share the connections of its
+        connection manager. SELECT statements run on the reader of the current thread, all other
+        statements on the writer. Reviews are queued and written in batches if a review queue is configured.
+
         Parameters
         ----------
         database_name : str, optional
             Name of the sqlite file, by default "ImageSorting.sqlite"
         """
-        self.connection = sqlite3.connect(database_name)
-
-    def _execute_sql(self, statement: str, get_result: bool = False) -> Optional[List[Any]]:
-        with self.connection:
-            cur = self.connection.execute(statement)
+        self.connections = get_connection_manager(database_name)
+        self.review_queue = get_review_queue(self.connections)
+
+    def _execute_sql(
+        self, statement: str, get_result: bool = False, parameters: Sequence[Any] = ()
+    ) -> Optional[List[Any]]:
+        if statement.lstrip().upper().startswith("SELECT"):
+            cur = self.connections.reader().execute(statement, parameters)
+            return list(cur) if get_result else None
+
+        with self.connections.writer() as connection:
+            cur = connection.execute(statement, parameters)
             if get_result:
                 return list(cur)
             else:
                 return None
 
+    def _flush_reviews(self):
+        """Write the queued reviews before a query which aggregates over the reviews."""
+        if self.review_queue:
+            self.review_queue.flush()
+
+    def _queued_rating(self, user_id: int, image_id: int, rating: Optional[float]) -> Optional[float]:
+        """Get the rating of the user for an image from the review queue, if it is newer than the stored rating."""
+        queued = self.review_queue.get(user_id, image_id) if self.review_queue else None
+        return queued[0] if queued else rating
+
     def get_user_id_from_table(self, username: str, password: str) -> int:
-        query = f"SELECT * FROM user WHERE user.email = '{username}';"
-        result = self._execute_sql(query, get_result=True)
+        query = "SELECT * FROM user WHERE user.email = ?;"
+        result = self._execute_sql(query, get_result=True, parameters=(username,))
         if not result:
             raise UserNotExisting
         if not check_password_hash(result[0][2], password):
@@ -123,42 +181,82 @@ class ImageTinderDatabase:
         return result[0][0]
 
     def get_username(self, user_id: int) -> str:
-        query = f"SELECT email FROM user WHERE user.id = '{user_id}';"
-        return self._execute_sql(query, get_result=True)[0][0]
+        query = "SELECT email FROM user WHERE user.id = ?;"
+        return self._execute_sql(query, get_result=True, parameters=(user_id,))[0][0]
 
     def create_user(self, username: str, password: str):
-        query = f"SELECT * FROM user WHERE user.email = '{username}';"
+        query = "SELECT * FROM user WHERE user.email = ?;"
         password_hash = generate_password_hash(password=password)
-        result = self._execute_sql(query, get_result=True)
+        result = self._execute_sql(query, get_result=True, parameters=(username,))
         if result:
             raise UserAlreadyExists
 
-        query = f"INSERT INTO user (email, password) VALUES ('{username}', '{password_hash}');"
-        self._execute_sql(query)
-        self.connection.commit()
+        query = "INSERT INTO user (email, password) VALUES (?, ?);"
+        self._execute_sql(query, parameters=(username, password_hash))
 
     def change_password(self, user_id: int, new_password: str, old_password: str):
-        query = f"SELECT * FROM user WHERE user.id = '{user_id}';"
-        result = self._execute_sql(query, get_result=True)
+        query = "SELECT * FROM user WHERE user.id = ?;"
+        result = self._execute_sql(query, get_result=True, parameters=(user_id,))
         if not result:
             raise UserNotExisting
-        query = f"SELECT password FROM user WHERE user.id = '{user_id}';"
-        result = self._execute_sql(query, get_result=True)
+        query = "SELECT password FROM user WHERE user.id = ?;"
+        result = self._execute_sql(query, get_result=True, parameters=(user_id,))
         old_password_hash = result[0][0]
         if not check_password_hash(old_password_hash, old_password):
             raise WrongPassword
 
         new_password_hash = generate_password_hash(password=new_password)
-        query = f"UPDATE user SET password='{new_password_hash}' WHERE id='{user_id}';"
-        self._execute_sql(query)
-        self.connection.commit()
+        query = "UPDATE user SET password=? WHERE id=?;"
+        self._execute_sql(query, parameters=(new_password_hash, user_id))
+
+    def _get_collections(self, condition: str, parameters: Sequence[Any]) -> List[Collection]:
+        """Get the collections matching the condition with their image counts in one query.
+
+        The first parameter is the user whose rated images are counted, followed by the parameters of the
+        condition. Collections without best images are previewed with their first image.
+        """
+        self._flush_reviews()
+        query = f"""SELECT c.id, c.name, c.start_date, c.end_date,
+                        (SELECT GROUP_CONCAT(b.image_id) FROM collection_best_image b WHERE b.collection_id = c.id),
+                        COUNT(ci.image_id), COUNT(ui.image_id),
+                        (
+                            SELECT first.image_id
+                            FROM collection_image first
+                            WHERE first.collection_id = c.id
+                            ORDER BY first.creation_date, first.image_id
+                            LIMIT 1
+                        )
+                    FROM collection c
+                    LEFT JOIN collection_image ci ON ci.collection_id = c.id
+                    LEFT JOIN user_image ui ON ui.image_id = ci.image_id AND ui.user_id = ?
+                    WHERE {condition}
+                    GROUP BY c.id
+                    ORDER BY c.id;"""
+        collections = []
+        for id, name, start_date, end_date, best_images, images, rated_images, first_image in self._execute_sql(
+            query, True, parameters
+        ):
+            if best_images:
+                preview_image = random.choice([int(x.strip()) for x in best_images.split(",")])
+            else:
+                preview_image = first_image
+            collections.append(
+                Collection(
+                    id=id,
+                    name=name,
+                    images=images,
+                    start_date=start_date,
+                    end_date=end_date,
+                    preview_image=preview_image,
+                    rated_images=rated_images,
+                )
+            )
+        return collections
 
     def get_user_collections(self, user_id: int) -> List[Collection]:
-        query = f"""SELECT collection.id
-                    FROM collection INNER JOIN user_collection ON user_collection.collection_id=collection.id
-                    WHERE user_collection.user_id={user_id};"""
-        data = self._execute_sql(query, get_result=True)
-        return [self.get_collection_info(result[0], 0) for result in data]
+        return self._get_collections(
+            "c.id IN (SELECT collection_id FROM user_collection WHERE user_id = ?)", (user_id, user_id)
+        )
 
     def save_collection(
         self,
@@ -168,113 +266,439 @@ class ImageTinderDatabase:
         id: Optional[int] = None,
     ) -> None:
         if id:
-            query = f"""UPDATE collection SET name='{name}', start_date='{start_date}', end_date='{end_date}'
-                        WHERE id={id};"""
-            self._execute_sql(query)
+            query = "UPDATE collection SET name=?, start_date=?, end_date=? WHERE id=?;"
+            self._execute_sql(query, parameters=(name, str(start_date), str(end_date), id))
         else:
-            query = f"""INSERT INTO collection (name, start_date, end_date)
-                        VALUES ('{name}', '{start_date}', '{end_date}')
+            query = """INSERT INTO collection (name, start_date, end_date)
+                        VALUES (?, ?, ?)
                         RETURNING id;"""
-            self._execute_sql(query, get_result=True)
+            id = self._execute_sql(query, get_result=True, parameters=(name, str(start_date), str(end_date)))[0][0]
 
-        self.connection.commit()
+        self._refresh_collection_images(id)
 
     def add_user_to_collection(self, user_id: int, collection_id: int):
-        query = f"INSERT INTO user_collection (user_id, collection_id) VALUES ({user_id}, {collection_id})"
-        self._execute_sql(query)
+        query = "INSERT INTO user_collection (user_id, collection_id) VALUES (?, ?)"
+        self._execute_sql(query, parameters=(user_id, collection_id))
+        # The ratings of the new user count for the best images
+        self._execute_sql("UPDATE collection SET best_images_dirty = 1 WHERE id = ?;", parameters=(collection_id,))
 
     @typechecked
     def get_collection_info(self, collection_id: int, user_id: int) -> Collection:
-        query = f"""SELECT collection.name, collection.start_date, collection.end_date, collection.best_images
-                    FROM collection
-                    WHERE collection.id={collection_id};"""
-        collection = self._execute_sql(query, get_result=True)
-        start_date = collection[0][1]
-        end_date = collection[0][2]
-        best_images = collection[0][3]
-        query = f"""SELECT i.id AS image_id, i.file_path, i.creation_date, i.image_location,
-                COALESCE(ui.rating, 'no_rating') AS user_rating
-                FROM image i LEFT JOIN user_image ui ON i.id = ui.image_id AND ui.user_id = {user_id}
-                WHERE i.creation_date BETWEEN '{start_date}' AND '{end_date}';"""
-        images = self._execute_sql(query, get_result=True)
-
-        if best_images:
-            preview_image = random.choice([int(x.strip()) for x in best_images.split(",")])
-        else:
-            preview_image = images[0][0]
-
-        collection = Collection(
-            id=collection_id,
-            name=collection[0][0],
-            images=len(images),
-            start_date=start_date,
-            end_date=end_date,
-            preview_image=preview_image,
-        )
-
-        return collection
+        return self._get_collections("c.id = ?", (user_id, collection_id))[0]
 
     def get_image_id(self, img_path: str) -> Optional[int]:
-        query = f"SELECT id FROM image WHERE image.file_path = '{img_path}';"
+        query = "SELECT id FROM image WHERE image.file_path = ? AND missing_since IS NULL;"
 
-        result = self._execute_sql(query, get_result=True)
+        result = self._execute_sql(query, get_result=True, parameters=(img_path,))
         if not result:
             return None
         return result[0][0]
 
     def add_image_to_database(self, image: Custom_Image):
-        date = image.get_date()
-        location = image.get_location()
-
-        query = f"""INSERT INTO image (file_path, creation_date, image_location)
-                    VALUES ('{image.path}', '{date}', '{location}')"""
-        self._execute_sql(query)
+        self.upsert_images([image])
 
     def add_or_update_image(self, image: Custom_Image, update: bool = False):
-        img_id = self.get_image_id(image.path)
+        img_id = self.get_image_id(str(image.path))
         if img_id and not update:
             return
+        self.upsert_images([image])
 
-        date = image.get_date()
-        location = image.get_location()
+    def get_image_ids(self, paths: List[str]) -> Dict[str, int]:
+        """Get the ids of the images with the given file paths."""
+        query = """SELECT file_path, id FROM image
+                    WHERE file_path IN (SELECT value FROM json_each(?)) AND missing_since IS NULL;"""
+        return dict(self._execute_sql(query, True, (json.dumps(paths),)))
 
-        if img_id:
-            query = f"""UPDATE image SET creation_date='{date}', image_location='{location}' WHERE id={img_id};"""
-            self._execute_sql(query)
-        else:
-            query = f"""INSERT INTO image (file_path, creation_date, image_location)
-                        VALUES ('{image.path}', '{date}', '{location}')"""
-            self._execute_sql(query)
+    def get_image_paths(self) -> Dict[str, int]:
+        """Get the ids of all images by their file path."""
+        query = "SELECT id, file_path FROM image WHERE missing_since IS NULL;"
+        return {path: image_id for image_id, path in self._execute_sql(query, True)}
+
+    def upsert_images(self, images: Iterable[Custom_Image]) -> Dict[str, int]:
+        """Add new images and update the changed ones in one transaction.
+
+        The metadata of the images is read before the transaction starts, so the database is only locked
+        for writing. Unchanged images are not written. If a path occurs multiple times, the last image wins.
+
+        Args:
+        ----
+            images (Iterable[Custom_Image]): The images to store, identified by their path.
+
+        Returns:
+        -------
+            Dict[str, int]: The number of "inserted", "updated" and "unchanged" images.
+        """
+        rows = {}
+        for image in images:
+            date = image.get_date()
+            location = image.get_location()
+            width, height = image.get_dimensions()
+            rows[str(image.path)] = (str(image.path), str(date), location, width, height, _aspect_ratio(width, height))
+        if not rows:
+            return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+        query = """SELECT file_path, id, creation_date FROM image
+                    WHERE file_path IN (SELECT value FROM json_each(?)) AND missing_since IS NULL;"""
+        paths = json.dumps(list(rows))
+        with self.connections.writer() as connection:
+            before = {path: (image_id, date) for path, image_id, date in connection.execute(query, (paths,))}
+            written = connection.executemany(IMAGE_UPSERT, rows.values()).rowcount
+            after = {path: (image_id, date) for path, image_id, date in connection.execute(query, (paths,))}
+            # New images and images with a new creation date change their collections
+            moved = [image_id for path, (image_id, date) in after.items() if before.get(path, (None, None))[1] != date]
+            self._update_image_collections(connection, moved)
+
+        inserted = len(after) - len(before)
+        return {"inserted": inserted, "updated": written - inserted, "unchanged": len(rows) - written}
+
+    def get_image_files(self) -> Dict[str, Tuple[int, Optional[int], Optional[str]]]:
+        """Get id, Nextcloud file id and etag of all images by their file path, including the missing images.
+
+        A missing image whose path was taken by a new image is left out.
+        """
+        query = "SELECT file_path, id, file_id, etag FROM image ORDER BY missing_since IS NULL;"
+        return {path: (image_id, file_id, etag) for path, image_id, file_id, etag in self._execute_sql(query, True)}
+
+    def set_file_info(self, files: List[Tuple[str, int, str, int, str]]):
+        """Store Nextcloud file id, etag, size and modification time of images, each given after the file path."""
+        query = """UPDATE image SET file_id=?, etag=?, size=?, last_modified=?
+                    WHERE file_path=? AND missing_since IS NULL;"""
+        with self.connections.writer() as connection:
+            connection.executemany(query, [(*info, path) for path, *info in files])
+
+    def move_images(self, paths: Dict[int, str]) -> int:
+        """Change the file path of images which were moved, keeping their reviews.
+
+        Missing images which are found again, at their path or a new one, are restored to their collections.
+
+        Args:
+        ----
+            paths (Dict[int, str]): The new file path by image id.
+
+        Returns:
+        -------
+            int: The number of restored missing images.
+        """
+        ids = json.dumps(list(paths))
+        with self.connections.writer() as connection:
+            # The images may swap or pass on their paths, so all moved paths are freed first
+            connection.executemany("UPDATE image SET file_path=? WHERE id=?;", [(f"\0{i}", i) for i in paths])
+            connection.executemany("UPDATE image SET file_path=? WHERE id=?;", [(p, i) for i, p in paths.items()])
+            restored = [
+                row[0]
+                for row in connection.execute(
+                    """UPDATE image SET missing_since = NULL
+                       WHERE id IN (SELECT value FROM json_each(?)) AND missing_since IS NOT NULL
+                       RETURNING id;""",
+                    (ids,),
+                )
+            ]
+            self._update_image_collections(connection, restored)
+        return len(restored)
+
+    def _leave_collections(self, connection: sqlite3.Connection, ids: str):
+        """Remove images, given as JSON array, from their collections within the open transaction."""
+        connection.execute(
+            """UPDATE collection SET best_images_dirty = 1
+               WHERE id IN (
+                   SELECT collection_id FROM collection_image WHERE image_id IN (SELECT value FROM json_each(?))
+               );""",
+            (ids,),
+        )
+        for table in ["collection_best_image", "collection_image"]:
+            connection.execute(f"DELETE FROM {table} WHERE image_id IN (SELECT value FROM json_each(?));", (ids,))
+
+    def mark_images_missing(self, image_ids: List[int]) -> int:
+        """Hide images whose files were not found from their collections, keeping their reviews.
+
+        The images are restored by move_images if their files are found again, otherwise they are removed
+        once they are missing for a while, see get_missing_image_ids.
+
+        Args:
+        ----
+            image_ids (List[int]): The images whose files are missing.
+
+        Returns:
+        -------
+            int: The number of images which were not missing before.
+        """
+        if not image_ids:
+            return 0
+        ids = json.dumps(image_ids)
+        with self.connections.writer() as connection:
+            self._leave_collections(connection, ids)
+            return connection.execute(
+                """UPDATE image SET missing_since = ?
+                   WHERE id IN (SELECT value FROM json_each(?)) AND missing_since IS NULL;""",
+                (datetime.now(), ids),
+            ).rowcount
+
+    def get_missing_image_ids(self, before: Optional[datetime] = None) -> List[int]:
+        """Get the ids of the missing images, only those missing since before the given time if it is set."""
+        if before is None:
+            return [row[0] for row in self._execute_sql("SELECT id FROM image WHERE missing_since IS NOT NULL;", True)]
+        query = "SELECT id FROM image WHERE missing_since < ?;"
+        return [row[0] for row in self._execute_sql(query, True, (before,))]
+
+    def remove_images(self, image_ids: List[int]):
+        """Remove images whose files were deleted for good, together with their reviews."""
+        if not image_ids:
+            return
+        ids = json.dumps(image_ids)
+        with self.connections.writer() as connection:
+            self._leave_collections(connection, ids)
+            connection.execute("DELETE FROM user_image WHERE image_id IN (SELECT value FROM json_each(?));", (ids,))
+            connection.execute("DELETE FROM image WHERE id IN (SELECT value FROM json_each(?));", (ids,))
+
+    def get_directory_etags(self) -> Dict[str, str]:
+        """Get the etags of the Nextcloud directories from the last scan."""
+        return dict(self._execute_sql("SELECT path, etag FROM directory;", True))
+
+    def set_directory_etags(self, directories: Dict[str, str], removed: Iterable[str] = ()):
+        """Store the etags of scanned Nextcloud directories and forget removed directories."""
+        with self.connections.writer() as connection:
+            connection.executemany("DELETE FROM directory WHERE path = ?;", [(path,) for path in removed])
+            connection.executemany(
+                """INSERT INTO directory (path, etag) VALUES (?, ?)
+                   ON CONFLICT (path) DO UPDATE SET etag = excluded.etag;""",
+                directories.items(),
+            )
+
+    def get_ingest_journal(self) -> Dict[str, Tuple[str, List[Tuple[str, bool, Optional[int], Optional[str], Any]]]]:
+        """Get the directories listed by an unfinished scan.
+
+        Returns
+        -------
+            Dict[str, Tuple[str, List[Tuple]]]: The etag of each directory at the time it was listed and its
+                entries as path, is directory, file id, etag, size and modification time.
+        """
+        journal = {
+            path: (etag, []) for path, etag in self._execute_sql("SELECT path, etag FROM ingest_directory;", True)
+        }
+        query = "SELECT directory, path, is_dir, file_id, etag, size, last_modified FROM ingest_entry;"
+        for directory, path, is_dir, *info in self._execute_sql(query, True):
+            if directory in journal:
+                journal[directory][1].append((path, bool(is_dir), *info))
+        return journal
+
+    def add_ingest_directories(self, directories: List[Tuple[str, str, List[Tuple]]]):
+        """Record listed directories in the journal of the running scan, each as path, etag and its entries."""
+        with self.connections.writer() as connection:
+            for path, etag, entries in directories:
+                connection.execute("DELETE FROM ingest_entry WHERE directory = ?;", (path,))
+                connection.executemany(
+                    """INSERT INTO ingest_entry (directory, path, is_dir, file_id, etag, size, last_modified)
+                       VALUES (?, ?, ?, ?, ?, ?, ?);""",
+                    [(path, *entry) for entry in entries],
+                )
+                connection.execute(
+                    """INSERT INTO ingest_directory (path, etag) VALUES (?, ?)
+                       ON CONFLICT (path) DO UPDATE SET etag = excluded.etag;""",
+                    (path, etag),
+                )
+
+    def clear_ingest_journal(self):
+        """Forget the journal after the scan finished."""
+        with self.connections.writer() as connection:
+            connection.execute("DELETE FROM ingest_entry;")
+            connection.execute("DELETE FROM ingest_directory;")
+
+    def get_ingest_errors(self) -> List[Dict[str, Any]]:
+        """Get the files which could not be read, with the number of attempts, the last error and the next retry."""
+        query = "SELECT path, etag, attempts, error, last_attempt, next_attempt FROM ingest_error ORDER BY path;"
+        return [
+            {
+                "path": path,
+                "etag": etag,
+                "attempts": attempts,
+                "error": error,
+                "last_attempt": datetime.fromisoformat(last_attempt),
+                "next_attempt": datetime.fromisoformat(next_attempt),
+            }
+            for path, etag, attempts, error, last_attempt, next_attempt in self._execute_sql(query, True)
+        ]
+
+    def set_ingest_errors(self, errors: List[Tuple[str, Optional[str], int, str, datetime, datetime]]):
+        """Store failed files as path, etag, attempts, error, time of the last attempt and of the next retry."""
+        with self.connections.writer() as connection:
+            connection.executemany(
+                """INSERT INTO ingest_error (path, etag, attempts, error, last_attempt, next_attempt)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (path) DO UPDATE SET
+                       etag = excluded.etag,
+                       attempts = excluded.attempts,
+                       error = excluded.error,
+                       last_attempt = excluded.last_attempt,
+                       next_attempt = excluded.next_attempt;""",
+                [
+                    (path, etag, attempts, error, str(last), str(after))
+                    for path, etag, attempts, error, last, after in errors
+                ],
+            )
+
+    def remove_ingest_errors(self, paths: Iterable[str]):
+        """Forget the errors of files which were read or deleted."""
+        with self.connections.writer() as connection:
+            connection.executemany("DELETE FROM ingest_error WHERE path = ?;", [(path,) for path in paths])
+
+    def _update_image_collections(self, connection: sqlite3.Connection, image_ids: List[int]):
+        """Update the collections of images after their creation date changed, within the open transaction."""
+        if not image_ids:
+            return
+        ids = json.dumps(image_ids)
+        # Only rated images can change the best images of the collections they leave or join
+        mark_dirty = """UPDATE collection SET best_images_dirty = 1
+                        WHERE id IN (
+                            SELECT ci.collection_id FROM collection_image ci
+                            WHERE ci.image_id IN (SELECT value FROM json_each(?))
+                            AND EXISTS (SELECT 1 FROM user_image ui WHERE ui.image_id = ci.image_id)
+                        );"""
+        query = """INSERT INTO collection_image (collection_id, image_id, creation_date)
+                    SELECT c.id, i.id, i.creation_date
+                    FROM image i JOIN collection c ON i.creation_date BETWEEN c.start_date AND c.end_date
+                    WHERE i.id IN (SELECT value FROM json_each(?)) AND i.missing_since IS NULL;"""
+        connection.execute(mark_dirty, (ids,))
+        connection.execute("DELETE FROM collection_image WHERE image_id IN (SELECT value FROM json_each(?));", (ids,))
+        connection.execute(query, (ids,))
+        connection.execute(mark_dirty, (ids,))
+
+    def _refresh_collection_images(self, collection_id: int):
+        """Update the images of a collection after its date range changed."""
+        self._execute_sql("DELETE FROM collection_image WHERE collection_id = ?;", parameters=(collection_id,))
+        query = """INSERT INTO collection_image (collection_id, image_id, creation_date)
+                    SELECT c.id, i.id, i.creation_date
+                    FROM collection c JOIN image i ON i.creation_date BETWEEN c.start_date AND c.end_date
+                    WHERE c.id = ? AND i.missing_since IS NULL;"""
+        self._execute_sql(query, parameters=(collection_id,))
+        self._execute_sql("UPDATE collection SET best_images_dirty = 1 WHERE id = ?;", parameters=(collection_id,))
+
+    def update_best_images(self, count: int = 3) -> List[int]:
+        """Recompute the best images of all collections whose ratings or images changed since the last run.
+
+        An image is ranked by its highest rating from the users of the collection, trashed reviews are ignored.
+        Only images inside the date range of the collection are candidates.
+
+        Args:
+        ----
+            count (int, optional): Number of best images per collection. Defaults to 3.
+
+        Returns:
+        -------
+            List[int]: The ids of the recomputed collections.
+        """
+        self._flush_reviews()
+        query = """INSERT INTO collection_best_image (collection_id, image_id, rank)
+                    SELECT collection_id, image_id, rank
+                    FROM (
+                        SELECT ci.collection_id, ci.image_id,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY ci.collection_id
+                                ORDER BY MAX(ui.rating) DESC, ci.creation_date ASC, ci.image_id ASC
+                            ) AS rank
+                        FROM collection_image ci
+                        INNER JOIN user_collection uc ON uc.collection_id = ci.collection_id
+                        INNER JOIN user_image ui ON ui.image_id = ci.image_id AND ui.user_id = uc.user_id
+                        WHERE ci.collection_id IN (SELECT value FROM json_each(?)) AND ui.deleted = 0
+                        GROUP BY ci.collection_id, ci.image_id
+                    )
+                    WHERE rank <= ?;"""
+        with self.connections.writer() as connection:
+            # Claiming the collections in the same transaction keeps reviews written meanwhile for the next run
+            dirty = [
+                row[0]
+                for row in connection.execute(
+                    "UPDATE collection SET best_images_dirty = 0 WHERE best_images_dirty = 1 RETURNING id;"
+                )
+            ]
+            if dirty:
+                connection.execute(
+                    "DELETE FROM collection_best_image WHERE collection_id IN (SELECT value FROM json_each(?));",
+                    (json.dumps(dirty),),
+                )
+                connection.execute(query, (json.dumps(dirty), count))
+        return sorted(dirty)
+
+    def get_best_images(self) -> Dict[int, str]:
+        """Get the paths of the best images of all collections."""
+        query = """SELECT DISTINCT i.id, i.file_path
+                    FROM collection_best_image b
+                    INNER JOIN image i ON i.id = b.image_id;"""
+        return {image_id: path for image_id, path in self._execute_sql(query, True)}
+
+    def set_image_dimensions(self, image_id: int, width: int, height: int):
+        """Store width and height of an image after applying its orientation."""
+        query = "UPDATE image SET width=?, height=?, aspect_ratio=? WHERE id=?;"
+        self._execute_sql(query, parameters=(width, height, _aspect_ratio(width, height), image_id))
+
+    def get_images_without_dimensions(self) -> Dict[int, str]:
+        """Get the paths of all images whose dimensions are not stored yet."""
+        query = "SELECT id, file_path FROM image WHERE (width IS NULL OR height IS NULL) AND missing_since IS NULL;"
+        return {image_id: path for image_id, path in self._execute_sql(query, True)}
 
     def get_image(self, image_id: int) -> Custom_Image:
-        query = f"""SELECT * FROM image WHERE image.id={image_id}"""
-        result = self._execute_sql(query, True)[0]
+        query = """SELECT id, file_path, creation_date, image_location, width, height
+                    FROM image WHERE image.id=?"""
+        result = self._execute_sql(query, True, (image_id,))[0]
 
-        return Custom_Image(image_id=result[0], path=result[1], location=result[3], date=result[2])
+        return Custom_Image(
+            image_id=result[0], path=result[1], location=result[3], date=result[2], width=result[4], height=result[5]
+        )
+
+    @typechecked
+    def get_gallery_images(self, user_id: int, image_ids: List[int]) -> List[Dict[str, Any]]:
+        """Get path, dimensions and the rating of the user for multiple images in the given order."""
+        if not image_ids:
+            return []
+        # The ids are passed as one JSON array, so the statement is the same for every number of ids
+        query = """SELECT i.id, i.file_path, i.width, i.height, ui.rating
+                    FROM image i
+                    LEFT JOIN user_image ui ON ui.image_id = i.id AND ui.user_id = ?
+                    WHERE i.id IN (SELECT value FROM json_each(?));"""
+        rows = self._execute_sql(query, True, (user_id, json.dumps(image_ids)))
+        results = {
+            image_id: {
+                "id": image_id,
+                "path": path,
+                "width": width,
+                "height": height,
+                "rating": self._queued_rating(user_id, image_id, rating),
+            }
+            for image_id, path, width, height, rating in rows
+        }
+        return [results[image_id] for image_id in image_ids if image_id in results]
 
     @typechecked
     def get_review(self, user_id: int, image_id: int) -> Optional[float]:
-        query = f"""SELECT rating
+        query = """SELECT rating
                    FROM user_image
-                   WHERE user_id = {user_id} AND image_id = {image_id};"""
-        return_value = self._execute_sql(query, True)
+                   WHERE user_id = ? AND image_id = ?;"""
+        return_value = self._execute_sql(query, True, (user_id, image_id))
         if return_value:
-            return return_value[0][0]
+            return self._queued_rating(user_id, image_id, return_value[0][0])
         else:
-            return None
+            return self._queued_rating(user_id, image_id, None)
 
     @typechecked
-    def add_or_update_review(self, user_id: int, image_id: int, review: float, trash: bool = False):
-        old_review = self.get_review(user_id=user_id, image_id=image_id)
+    def get_reviews(self, user_id: int, image_ids: List[int]) -> Dict[int, float]:
+        """Get the ratings of the user for multiple images, images without a rating are left out."""
+        query = """SELECT image_id, rating
+                   FROM user_image
+                   WHERE user_id = ? AND image_id IN (SELECT value FROM json_each(?));"""
+        reviews = dict(self._execute_sql(query, True, (user_id, json.dumps(image_ids))))
+        if self.review_queue:
+            for image_id in image_ids:
+                queued = self.review_queue.get(user_id, image_id)
+                if queued:
+                    reviews[image_id] = queued[0]
+        return reviews
 
-        if old_review is not None:
-            query = f"""UPDATE user_image SET rating={review}, deleted={trash}
-                        WHERE user_id={user_id} AND image_ID={image_id};"""
+    @typechecked
+    def add_or_update_review(self, user_id: int, image_id: int, review: float, trash: bool = False):
+        if self.review_queue:
+            self.review_queue.add(user_id, image_id, review, trash)
         else:
-            query = f"""INSERT INTO user_image (user_id, image_id, rating, deleted)
-                        VALUES ({user_id}, {image_id}, {review}, {trash}) ;"""
-
-        self._execute_sql(query)
+            with self.connections.writer() as connection:
+                write_reviews(connection, [(user_id, image_id, review, trash)])
 
     @typechecked
     def get_starting_image_id(
@@ -282,171 +706,244 @@ class ImageTinderDatabase:
         user_id: int,
         config_id: int,
     ) -> Optional[int]:
-        query = f"""WITH images_in_collection AS (
-                SELECT i.id, i.file_path, i.creation_date, i.image_location
-                FROM image i
-                INNER JOIN collection c
-                    ON i.creation_date BETWEEN c.start_date AND c.end_date
-                WHERE c.id = {config_id}
-            ),
-            unreviewed_images AS (
-                SELECT i.id, i.file_path, i.creation_date, i.image_location
-                FROM images_in_collection i
-                LEFT JOIN user_image ui
-                    ON i.id = ui.image_id AND ui.user_id = {user_id}
-                WHERE ui.image_id IS NULL -- Exclude images already reviewed by the user
-            )
-            SELECT *
-            FROM unreviewed_images
-            ORDER BY creation_date ASC
+        query = """SELECT ci.image_id
+            FROM collection_image ci
+            LEFT JOIN user_image ui
+                ON ci.image_id = ui.image_id AND ui.user_id = ?
+            WHERE ci.collection_id = ?
+            AND ui.image_id IS NULL -- Exclude images already reviewed by the user
+            ORDER BY ci.creation_date ASC, ci.image_id ASC
             LIMIT 1;
-
             """
 
-        results = self._execute_sql(query, True)
+        self._flush_reviews()
+        results = self._execute_sql(query, True, (user_id, config_id))
         if not results:
             return None
         return results[0][0]
 
     @typechecked
     def get_all_image_ids(self, config_id: int) -> List[int]:
-        query = f"""SELECT i.id
-                FROM image i
-                INNER JOIN collection c
-                    ON i.creation_date BETWEEN c.start_date AND c.end_date
-                WHERE c.id = {config_id}
-                ORDER BY creation_date ASC
+        query = """SELECT image_id
+                FROM collection_image
+                WHERE collection_id = ?
+                ORDER BY creation_date ASC, image_id ASC
             """
 
-        results = self._execute_sql(query, True)
+        results = self._execute_sql(query, True, (config_id,))
         if not results:
             return []
         return [result[0] for result in results]
 
+    @typechecked
+    def get_collection_page(
+        self, config_id: int, cursor: Optional[int] = None, count: int = 25, backward: bool = False
+    ) -> List[int]:
+        """Get a page of image ids of a collection, ordered by creation date and id.
+
+        Images are paged by their position, not by an offset. Every page is a seek in the index of the collection,
+        and images with the same creation date are neither skipped nor repeated.
+
+        Args:
+        ----
+            config_id (int): The collection to page through.
+            cursor (Optional[int], optional): The image before the page, the page starts at the beginning
+                (or the end when paging backward) of the collection if None. Defaults to None.
+            count (int, optional): Maximum number of images of the page. Defaults to 25.
+            backward (bool, optional): Page towards older images, the closest image first. Defaults to False.
+
+        Returns:
+        -------
+            List[int]: The image ids in the order of paging, continue with the last one as cursor.
+        """
+        operator, order = ("<", "DESC") if backward else (">", "ASC")
+        condition = ""
+        parameters = [config_id]
+        if cursor is not None:
+            condition = (
+                f"AND (ci.creation_date, ci.image_id) {operator} (SELECT creation_date, id FROM image WHERE id = ?)"
+            )
+            parameters.append(cursor)
+        query = f"""SELECT ci.image_id
+                FROM collection_image ci
+                WHERE ci.collection_id = ? {condition}
+                ORDER BY ci.creation_date {order}, ci.image_id {order}
+                LIMIT ?;"""
+        return [result[0] for result in self._execute_sql(query, True, (*parameters, count))]
+
     @typechecked
     def get_images_ids_filtered(
         self, user_id: int, config_id: int, min_rating: int, max_results_per_day: int
     ) -> List[int]:
-        query = f"""SELECT i.id, max_ratings.rating, i.creation_date
-                    FROM image i
-                    INNER JOIN collection c ON i.creation_date BETWEEN c.start_date AND c.end_date
-                    LEFT JOIN (
-                        SELECT image_id, MAX(rating) as rating
-                        FROM user_image
-                        WHERE user_id = {user_id}
-                        GROUP BY image_id
-                        HAVING COUNT(image_id) > 0
-                    ) AS max_ratings ON i.id = max_ratings.image_id
-                    WHERE c.id = {config_id} AND max_ratings.rating >= {min_rating}
-                    AND (
-                        max_ratings.rating IS NOT NULL OR max_ratings.rating IS NOT NULL
-                    )
-                    ORDER BY i.creation_date ASC
-                """
-        results = self._execute_sql(query, True)
-        last_date = datetime(1900, 11, 1)
-        results_per_day = 0
-        images = []
-
-        for row in results:
-            image_date = datetime.fromisoformat(row[2])
-            if image_date > last_date:
-                last_date = image_date
-                results_per_day = 0
-            results_per_day += 1
-            if results_per_day <= max_results_per_day:
-                images.append(row[0])
-            if max_results_per_day == 0:
-                images.append(row[0])
-
-        return images
+        """Get the images of a collection rated at least min_rating by the user, ordered by creation date.
+
+        Args:
+        ----
+            user_id (int): The user whose ratings are filtered.
+            config_id (int): The collection to filter.
+            min_rating (int): Minimal rating of the images.
+            max_results_per_day (int): Keep only the best rated images of every calendar day, 0 keeps all images.
+
+        Returns:
+        -------
+            List[int]: The ids of the remaining images.
+        """
+        self._flush_reviews()
+        if max_results_per_day == 0:
+            query = """SELECT ci.image_id
+                        FROM collection_image ci
+                        INNER JOIN user_image ui ON ui.image_id = ci.image_id AND ui.user_id = ?
+                        WHERE ci.collection_id = ? AND ui.rating >= ?
+                        ORDER BY ci.creation_date ASC, ci.image_id ASC;"""
+            return [result[0] for result in self._execute_sql(query, True, (user_id, config_id, min_rating))]
+
+        # Ranking the days with a window function sorts all rated images, which is slower than picking the
+        # best images of every day while walking the images in chronological order
+        query = """SELECT ci.image_id, ui.rating, ci.creation_date
+                    FROM collection_image ci
+                    INNER JOIN user_image ui ON ui.image_id = ci.image_id AND ui.user_id = ?
+                    WHERE ci.collection_id = ? AND ui.rating >= ?
+                    ORDER BY ci.creation_date ASC, ci.image_id ASC;"""
+        rows = self._execute_sql(query, True, (user_id, config_id, min_rating))
+        image_ids = []
+        for _, group in groupby(rows, key=lambda row: row[2][:10]):
+            day = list(group)
+            if len(day) > max_results_per_day:
+                # Ties go to the earlier image
+                best = {row[0] for row in heapq.nlargest(max_results_per_day, day, key=itemgetter(1))}
+                image_ids.extend(row[0] for row in day if row[0] in best)
+            else:
+                image_ids.extend(row[0] for row in day)
+        return image_ids
 
     @typechecked
     def get_next_image_ids(self, user_id: int, config_id: int, current_id: int, next_images: int = 1) -> List[int]:
         next_images = max(1, next_images)
-        query = f"""WITH user_images_in_config AS (
-                    SELECT i.id AS image_id, i.creation_date
-                    FROM image i
-                    INNER JOIN collection c
-                        ON i.creation_date BETWEEN c.start_date AND c.end_date
-                    INNER JOIN user_collection uc
-                        ON uc.collection_id = c.id
-                    WHERE uc.user_id = {user_id}
-                    AND c.id = {config_id}
-                )
-                SELECT image_id
-                FROM user_images_in_config
-                WHERE creation_date > (
-                    SELECT creation_date
+        query = """SELECT ci.image_id
+                FROM collection_image ci
+                INNER JOIN user_collection uc
+                    ON uc.collection_id = ci.collection_id
+                WHERE uc.user_id = ?
+                AND ci.collection_id = ?
+                AND (ci.creation_date, ci.image_id) > (
+                    SELECT creation_date, id
                     FROM image
-                    WHERE id = {current_id}
+                    WHERE id = ?
                 )
-                ORDER BY creation_date ASC
-                LIMIT {next_images}
-
+                ORDER BY ci.creation_date ASC, ci.image_id ASC
+                LIMIT ?
             """
 
-        results = self._execute_sql(query, True)
+        results = self._execute_sql(query, True, (user_id, config_id, current_id, next_images))
         return [result[0] for result in results]
 
     @typechecked
-    def get_previous_image_id(self, user_id: int, config_id: int, current_id: int):
-        query = f"""WITH user_images_in_config AS (
-                    SELECT i.id AS image_id, i.creation_date
-                    FROM image i
-                    INNER JOIN collection c
-                        ON i.creation_date BETWEEN c.start_date AND c.end_date
-                    INNER JOIN user_collection uc
-                        ON uc.collection_id = c.id
-                    WHERE uc.user_id = {user_id}
-                    AND c.id = {config_id}
-                )
-                SELECT image_id
-                FROM user_images_in_config
-                WHERE creation_date < (
-                    SELECT creation_date
+    def get_previous_image_id(self, user_id: int, config_id: int, current_id: int) -> Optional[int]:
+        query = """SELECT ci.image_id
+                FROM collection_image ci
+                INNER JOIN user_collection uc
+                    ON uc.collection_id = ci.collection_id
+                WHERE uc.user_id = ?
+                AND ci.collection_id = ?
+                AND (ci.creation_date, ci.image_id) < (
+                    SELECT creation_date, id
                     FROM image
-                    WHERE id = {current_id}
+                    WHERE id = ?
                 )
-                ORDER BY creation_date DESC
+                ORDER BY ci.creation_date DESC, ci.image_id DESC
                 LIMIT 1;
                 """
-        results = self._execute_sql(query, True)
+        results = self._execute_sql(query, True, (user_id, config_id, current_id))
+        if not results:
+            return None
         return results[0][0]
 
+    @typechecked
+    def get_adjacent_images(
+        self, user_id: int, config_id: int, current_id: int, previous: int = 1, upcoming: int = 1
+    ) -> Tuple[List[Tuple[int, Optional[float]]], List[Tuple[int, Optional[float]]]]:
+        """Get the previous and upcoming images of the collection with the ratings of the user in one query.
+
+        Args:
+        ----
+            user_id (int): The reviewing user, must have access to the collection.
+            config_id (int): The collection which is reviewed.
+            current_id (int): The image currently shown.
+            previous (int, optional): Maximum number of previous images. Defaults to 1.
+            upcoming (int, optional): Maximum number of upcoming images. Defaults to 1.
+
+        Returns:
+        -------
+            Tuple[List[Tuple[int, Optional[float]]], List[Tuple[int, Optional[float]]]]: The previous images,
+                the closest first, and the upcoming images, each as image id and rating.
+        """
+        query = """SELECT a.upcoming, a.image_id, ui.rating
+                FROM (
+                    SELECT * FROM (
+                        SELECT 0 AS upcoming, ci.image_id, ci.creation_date
+                        FROM collection_image ci
+                        WHERE ci.collection_id = ?
+                        AND (ci.creation_date, ci.image_id) < (SELECT creation_date, id FROM image WHERE id = ?)
+                        ORDER BY ci.creation_date DESC, ci.image_id DESC
+                        LIMIT ?
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT 1 AS upcoming, ci.image_id, ci.creation_date
+                        FROM collection_image ci
+                        WHERE ci.collection_id = ?
+                        AND (ci.creation_date, ci.image_id) > (SELECT creation_date, id FROM image WHERE id = ?)
+                        ORDER BY ci.creation_date ASC, ci.image_id ASC
+                        LIMIT ?
+                    )
+                ) AS a
+                LEFT JOIN user_image ui ON ui.image_id = a.image_id AND ui.user_id = ?
+                WHERE EXISTS (SELECT 1 FROM user_collection WHERE user_id = ? AND collection_id = ?)
+                ORDER BY a.creation_date ASC, a.image_id ASC;"""
+        parameters = (config_id, current_id, previous, config_id, current_id, upcoming, user_id, user_id, config_id)
+        rows = self._execute_sql(query, True, parameters)
+        rows = [
+            (is_upcoming, image_id, self._queued_rating(user_id, image_id, rating))
+            for is_upcoming, image_id, rating in rows
+        ]
+        previous_images = [(image_id, rating) for is_upcoming, image_id, rating in reversed(rows) if not is_upcoming]
+        upcoming_images = [(image_id, rating) for is_upcoming, image_id, rating in rows if is_upcoming]
+        return previous_images, upcoming_images
+
     @typechecked
     def can_user_access_image(self, user_id: int, image_id: int) -> bool:
-        query = f"""SELECT 1
-                FROM user_collection uc
-                JOIN collection c ON uc.collection_id = c.id
-                JOIN image i ON i.creation_date BETWEEN c.start_date AND c.end_date
-                WHERE uc.user_id = {user_id} AND i.id = {image_id};"""
-        if self._execute_sql(query, True):
+        query = """SELECT 1
+                FROM collection_image ci
+                JOIN user_collection uc ON uc.collection_id = ci.collection_id
+                WHERE uc.user_id = ? AND ci.image_id = ?
+                LIMIT 1;"""
+        if self._execute_sql(query, True, (user_id, image_id)):
             return True
         else:
             return False
 
     @typechecked
     def add_collection(self, title: str, start_date: datetime, end_date: datetime, user_id: int) -> int:
-        query = f"""INSERT INTO collection (name, start_date, end_date)
-                VALUES ('{title}', '{start_date}', '{end_date}')
+        query = """INSERT INTO collection (name, start_date, end_date)
+                VALUES (?, ?, ?)
                 RETURNING id;"""
-        results = self._execute_sql(query, True)
+        results = self._execute_sql(query, True, (title, str(start_date), str(end_date)))
+        self._refresh_collection_images(results[0][0])
         self.add_user_to_collection(user_id=user_id, collection_id=results[0][0])
         return results[0][0]
 
     @typechecked
     def can_user_create_collection(self, user_id: int) -> bool:
         """Check if a user is allowed to create a collection."""
-        query = f"""SELECT 1 FROM user WHERE id = {user_id} AND create_collection = 1 LIMIT 1;"""
-        if self._execute_sql(query, True):
+        query = "SELECT 1 FROM user WHERE id = ? AND create_collection = 1 LIMIT 1;"
+        if self._execute_sql(query, True, (user_id,)):
             return True
         else:
             return False
 
     @typechecked
     def get_all_users(self, collection_id: int) -> List[Dict[str, Any]]:
-        query = f"""SELECT
+        query = """SELECT
                         u.email,
                         u.id,
                         CASE
@@ -457,16 +954,16 @@ class ImageTinderDatabase:
                         user u
                     LEFT JOIN
                         user_collection uc
-                        ON u.id = uc.user_id AND uc.collection_id = {collection_id};
+                        ON u.id = uc.user_id AND uc.collection_id = ?;
                 """
-        results = self._execute_sql(query, True)
+        results = self._execute_sql(query, True, (collection_id,))
         users = [{"name": result[0], "id": result[1], "selected": bool(result[2])} for result in results]
         return users
 
     @typechecked
     def is_admin(self, user_id: int) -> bool:
-        query = f"""SELECT 1 FROM user WHERE id = {user_id} AND create_collection = 1 LIMIT 1;"""
-        if self._execute_sql(query, True):
+        query = "SELECT 1 FROM user WHERE id = ? AND create_collection = 1 LIMIT 1;"
+        if self._execute_sql(query, True, (user_id,)):
             return True
         else:
             return False
@@ -0,0 +1,127 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from .connections import ConnectionManager
+
+REVIEW_UPSERT = """INSERT INTO user_image (user_id, image_id, rating, deleted)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT (user_id, image_id) DO UPDATE SET
+                       rating = excluded.rating,
+                       deleted = excluded.deleted;"""
+# The best images of the collections containing a reviewed image are recomputed by the next scheduler run
+MARK_BEST_IMAGES_DIRTY = """UPDATE collection SET best_images_dirty = 1
+                            WHERE best_images_dirty = 0 AND id IN (
+                                SELECT collection_id FROM collection_image
+                                WHERE image_id IN (SELECT value FROM json_each(?))
+                            );"""
+
+# Reviews are written through if no interval is configured
+REVIEW_FLUSH_MS = int(os.environ.get("IMAGE_SORT_REVIEW_FLUSH_MS", "0"))
+# Reviews written at once before the timer runs out
+MAX_BATCH_SIZE = 500
+
+
+def write_reviews(connection: sqlite3.Connection, reviews: List[Tuple[int, int, float, bool]]):
+    """Upsert reviews given as (user_id, image_id, rating, trash) and mark their collections as changed."""
+    connection.executemany(REVIEW_UPSERT, reviews)
+    connection.execute(MARK_BEST_IMAGES_DIRTY, (json.dumps(sorted({review[1] for review in reviews})),))
+
+
+class ReviewQueue:
+    """Write-behind queue which commits the reviews of all users in one transaction per interval.
+
+    Only the latest review of a user for an image is kept. Until a review is written, the database
+    wrapper reads it from the queue, so a user always sees their own reviews. The queue is flushed
+    when the process exits.
+    """
+
+    def __init__(self, connections: ConnectionManager, flush_interval: float):
+        """Create the queue, the flushing thread is started with the first review.
+
+        Args:
+        ----
+            connections (ConnectionManager): Connections of the database the reviews are written to.
+            flush_interval (float): Seconds between two writes of the queued reviews.
+        """
+        self.connections = connections
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[int, int], Tuple[float, bool]] = {}
+        # The batch which is written right now, it stays readable until it is committed
+        self._writing: Dict[Tuple[int, int], Tuple[float, bool]] = {}
+        self._lock = threading.Lock()
+        # Held while a batch is written, so a flush returns only after all earlier reviews are committed
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, name="review-queue", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def add(self, user_id: int, image_id: int, review: float, trash: bool = False):
+        """Queue a review, replacing a queued review of the user for the same image."""
+        with self._lock:
+            self._start()
+            self._pending[(user_id, image_id)] = (review, trash)
+            full = len(self._pending) >= MAX_BATCH_SIZE
+        if full:
+            self.flush()
+
+    def get(self, user_id: int, image_id: int) -> Optional[Tuple[float, bool]]:
+        """Get the queued rating and trash flag of a review, None if no review is queued."""
+        with self._lock:
+            return self._pending.get((user_id, image_id), self._writing.get((user_id, image_id)))
+
+    def flush(self):
+        """Write all queued reviews in one transaction."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._writing = batch
+            if not batch:
+                return
+            try:
+                with self.connections.writer() as connection:
+                    write_reviews(
+                        connection,
+                        [(user_id, image_id, review, trash) for (user_id, image_id), (review, trash) in batch.items()],
+                    )
+            except Exception as e:
+                logging.warning(e)
+                logging.warning(f"Could not write {len(batch)} reviews, retrying with the next flush")
+                with self._lock:
+                    # Reviews queued in the meantime are newer
+                    self._pending = {**batch, **self._pending}
+            finally:
+                with self._lock:
+                    self._writing = {}
+
+    def close(self):
+        """Stop the flushing thread and write the remaining reviews."""
+        self._closed.set()
+        self.flush()
+
+    def _work(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+
+_queues: Dict[ConnectionManager, ReviewQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_review_queue(connections: ConnectionManager) -> Optional[ReviewQueue]:
+    """Get the review queue of a database, None if reviews are written through."""
+    if REVIEW_FLUSH_MS <= 0:
+        return None
+    with _queues_lock:
+        if connections not in _queues:
+            _queues[connections] = ReviewQueue(connections, flush_interval=REVIEW_FLUSH_MS / 1000)
+        return _queues[connections]
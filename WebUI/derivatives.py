@@ -0,0 +1,134 @@
+import logging
+import math
+import os
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Union
+
+from PIL import Image
+
+from .caching import DERIVATIVE_DIR, SIZE_CLASSES, SingleFlight, disk_cache, temporary_path
+from .Image import Custom_Image
+
+JPEG_QUALITY = 85
+VIEWPORT_CLASSES = ["view_1280", "view_1920", "view_2560", "view_3840"]
+renders = SingleFlight()
+
+if not os.path.exists(DERIVATIVE_DIR):
+    os.makedirs(DERIVATIVE_DIR)
+
+
+def size_class_for_viewport(width: Optional[int], height: Optional[int]) -> str:
+    """Get the smallest viewport size class which still covers the given viewport.
+
+    Args:
+    ----
+        width (Optional[int]): Width of the viewport in pixels.
+        height (Optional[int]): Height of the viewport in pixels.
+
+    Returns:
+    -------
+        str: Name of the size class, "full" if no viewport is known or it exceeds all buckets.
+    """
+    if not width or not height:
+        return "full"
+    longest_edge = max(int(width), int(height))
+    for size_class in VIEWPORT_CLASSES:
+        if SIZE_CLASSES[size_class] >= longest_edge:
+            return size_class
+    return "full"
+
+
+def derivative_path(image_id: int, size_class: str) -> Path:
+    """Get the path where the derivative of an image is stored."""
+    return Path(DERIVATIVE_DIR, f"{image_id}_{size_class}.jpg")
+
+
+def _save(img: Image.Image, file: Union[str, os.PathLike, BinaryIO]):
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    img.save(file, format="JPEG", quality=JPEG_QUALITY)
+
+
+def _store(img: Image.Image, path: Path) -> Path:
+    tmp_path = temporary_path(path)
+    _save(img, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _scaled(image: Custom_Image, size_class: str) -> Image.Image:
+    size = SIZE_CLASSES[size_class]
+    # Decoded from the original on disk, the image cache of this process is not invalidated when
+    # search_images replaces the source and the image id may be reused by a new image
+    return image.get_image(image_size=(size, size) if size else None, cached=False)
+
+
+def _render(image: Custom_Image, size_class: str) -> Path:
+    path = _store(_scaled(image, size_class), derivative_path(image.id, size_class))
+    disk_cache.add(path)
+    logging.debug(f"Rendered {size_class} derivative of image {image.id}")
+    return path
+
+
+def render_derivative(image: Custom_Image, size_class: str) -> Path:
+    """Render a derivative of the image and store it encoded on disk.
+
+    The file is written to a temporary name first and moved into place afterwards,
+    so concurrent readers never see a partially written file. Concurrent renders of
+    the same derivative are coalesced into one.
+
+    Args:
+    ----
+        image (Custom_Image): The image to render.
+        size_class (str): One of the keys of `SIZE_CLASSES`.
+
+    Returns:
+    -------
+        Path: The path of the rendered derivative.
+    """
+    return renders.do((image.id, size_class), lambda: _render(image, size_class))
+
+
+def encode_derivative(image: Custom_Image, size_class: str) -> BytesIO:
+    """Encode a derivative of the image in memory, without storing it on disk."""
+    buffer = BytesIO()
+    _save(_scaled(image, size_class), buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def render_derivatives(image_path: str, paths: Dict[str, Path]) -> int:
+    """Render several derivatives of an image from a single download and decode.
+
+    The image is decoded at the largest size class only, the smaller ones are scaled down from it.
+    Meant for worker processes, so neither the original nor the decoded image is cached and the
+    written files are not added to the disk cache, which is left to the caller.
+
+    Args:
+    ----
+        image_path (str): The path to the image on Nextcloud.
+        paths (Dict[str, Path]): The path to write to by size class, see `derivative_path`.
+
+    Returns:
+    -------
+        int: The number of bytes written.
+    """
+    size_classes = sorted(paths, key=lambda size_class: SIZE_CLASSES[size_class] or math.inf, reverse=True)
+    largest = SIZE_CLASSES[size_classes[0]]
+    img = Custom_Image(image_id=0, path=image_path).get_image(image_size=(largest, largest) if largest else None)
+    for size_class in size_classes:
+        size = SIZE_CLASSES[size_class]
+        if size and max(img.size) > size:
+            img = img.copy()
+            img.thumbnail((size, size))
+        _store(img, paths[size_class])
+    return sum(path.stat().st_size for path in paths.values())
+
+
+def get_derivative(image: Custom_Image, size_class: str) -> Path:
+    """Get the path of the derivative, rendering it only if it is not stored yet."""
+    path = derivative_path(image.id, size_class)
+    if path.exists():
+        return path
+    return render_derivative(image, size_class)
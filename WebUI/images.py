@@ -1,15 +1,26 @@
-import io
-import logging
+import os
+from datetime import datetime, timezone
+from typing import BinaryIO, Optional, Tuple
 
-from caching import remove_old_images
-from flask import Blueprint, jsonify, redirect, render_template, request, send_file, session, url_for
+from flask import Blueprint, Response, jsonify, redirect, render_template, request, send_file, session, url_for
 
-from .app import executor
-from .configs import customBackend
+from .caching import disk_cache
+from .configs import customBackend, prefetch_gallery
 from .database import get_db
+from .derivatives import derivative_path, encode_derivative, render_derivative, size_class_for_viewport
+from .Image.header import read_header_metadata
+from .prefetch import PREFETCH_AHEAD, prefetcher
 
 bp = Blueprint("images", __name__, url_prefix="/images")
 
+GALLERY_PAGE_SIZE = 25
+MAX_GALLERY_PAGE_SIZE = 100
+
+# Previews and placeholders do not depend on the session, so browsers may reuse them for a while.
+# Their URL does not change with the source image, so they have to be revalidated afterwards.
+SHARED_SIZE_CLASSES = ("preview", "placeholder")
+SHARED_MAX_AGE = 10 * 60
+
 
 @bp.route("/", methods=("GET", "POST"))
 def overview():
@@ -45,31 +56,25 @@ def review():
         image_id = int(image_id[3:])
         rating = int(request.form.get("rating", 0))  # Default to 0 if no rating
         print(f"Image: {image_id} with rating {rating}")
-        # Save the review in the database
-        db.add_or_update_review(user_id=user_id, image_id=image_id, review=rating)
-
-        # Determine the next image ID based on action
-        if action == "next":
-            next_image_id = db.get_next_image_ids(user_id, int(session["config_id"]), image_id)
-            if next_image_id:
-                next_image_id = next_image_id[0]
-        elif action == "previous":
-            next_image_id = db.get_previous_image_id(user_id, int(session["config_id"]), image_id)
-        elif action == "trash":
-            db.add_or_update_review(user_id, image_id, review=0, trash=True)  # Custom function to mark image as deleted
-            next_image_id = db.get_next_image_ids(user_id, int(session["config_id"]), image_id)
-            if next_image_id:
-                next_image_id = next_image_id[0]
-        else:
+        if action not in ("next", "previous", "trash"):
             return jsonify({"success": False, "message": "Invalid action"})
 
-        if next_image_id:
-            # Fetch the star rating for the next image
-            next_image_rating = db.get_review(user_id, next_image_id)
-            next_image_rating = next_image_rating if next_image_rating else 0
+        # Save the review in the database, trashed images are marked as deleted
+        if action == "trash":
+            db.add_or_update_review(user_id, image_id, review=0, trash=True)
+        else:
+            db.add_or_update_review(user_id=user_id, image_id=image_id, review=rating)
 
+        # Determine the next image and its star rating in one query
+        config_id = int(session["config_id"])
+        if action == "previous":
+            adjacent_images, _ = db.get_adjacent_images(user_id, config_id, image_id, previous=1, upcoming=0)
+        else:
+            _, adjacent_images = db.get_adjacent_images(user_id, config_id, image_id, previous=0, upcoming=1)
+        if adjacent_images:
+            next_image_id, next_image_rating = adjacent_images[0]
             return jsonify(
-                {"success": True, "new_image_path": f"/images/id_{next_image_id}", "rating": next_image_rating}
+                {"success": True, "new_image_path": f"/images/id_{next_image_id}", "rating": next_image_rating or 0}
             )
         else:
             # If no more images, redirect back to overview
@@ -81,30 +86,103 @@ def review():
     return render_template("image_view.html", image_path=f"/images/id_{next_image_id}")
 
 
+def _parse_image_request(image_id: str) -> Tuple[int, str]:
+    """Split the requested image name into the image id and the size class to serve."""
+    if image_id[:3] == "pre":
+        return int(image_id[4:]), "preview"
+    if image_id[:2] == "ph":
+        return int(image_id[3:]), "placeholder"
+    return int(image_id[3:]), size_class_for_viewport(session.get("vp_width"), session.get("vp_height"))
+
+
+def _validators(image_id: int, size_class: str, stat: Optional[os.stat_result] = None) -> Optional[Tuple[str, float]]:
+    """Get the ETag and modification time of a rendered derivative, None if it is not rendered yet.
+
+    The modification time is the time the derivative was rendered. A changed source image gets a
+    new derivative and with it a new ETag once the old derivative was removed. Pass the stat of an
+    opened derivative, so the validators belong to the file which is sent even if it is evicted.
+    """
+    if stat is None:
+        try:
+            stat = derivative_path(image_id, size_class).stat()
+        except FileNotFoundError:
+            return None
+    return f"{image_id}-{size_class}-{stat.st_mtime_ns:x}", stat.st_mtime
+
+
+def _open_derivative(path: os.PathLike) -> Optional[BinaryIO]:
+    """Open a derivative to send it, None if it is not rendered or was evicted."""
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+
+def _is_not_modified(etag: str, modified: float) -> bool:
+    """Check the conditional headers of the request against the validators of the derivative."""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return int(modified) <= request.if_modified_since.timestamp()
+    return False
+
+
+def _set_cache_headers(response: Response, validators: Optional[Tuple[str, float]], size_class: str) -> Response:
+    """Add validators and caching policy to an image response, without validators it must not be reused."""
+    response.cache_control.private = True
+    if validators is None:
+        response.cache_control.no_store = True
+        return response
+    etag, modified = validators
+    response.set_etag(etag)
+    response.last_modified = datetime.fromtimestamp(modified, tz=timezone.utc)
+    if size_class in SHARED_SIZE_CLASSES:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = SHARED_MAX_AGE
+        response.cache_control.must_revalidate = True
+    else:
+        # The viewport size class depends on the session, so the browser has to revalidate.
+        response.cache_control.no_cache = True
+        response.vary.add("Cookie")
+    return response
+
+
 @bp.route("<image_id>")
 def image(image_id: str):
-    """Serve a image."""
+    """Serve a image.
+
+    The image is served as pre-rendered derivative of the requested size class, only the first
+    request for a size class decodes and resizes the image. The access is checked before
+    conditional requests for an unchanged derivative are answered with 304, so the validators
+    do not reveal images to users who are not allowed to view them.
+    """
+    image_id, size_class = _parse_image_request(image_id)
     db = get_db()
-    image_io = io.BytesIO()
     user_id = session.get("user_id", 0)
-    if image_id[:3] == "pre":
-        if not db.can_user_access_image(user_id=user_id, image_id=int(image_id[4:])):
-            print(f"User {user_id} cant access image {int(image_id[4:])}")
-            return "You are not allowed to view or review this image", 401
-        image = db.get_image(image_id=int(image_id[4:]))
-        image.get_preview().save(image_io, format="PNG")
-        image_io.seek(0)
+    if not db.can_user_access_image(user_id=user_id, image_id=image_id):
+        print(f"User {user_id} cant access image {image_id}")
+        return "You are not allowed to view or review this image", 401
+
+    path = derivative_path(image_id, size_class)
+    validators = _validators(image_id, size_class)
+    if validators and _is_not_modified(*validators):
+        disk_cache.touch(path)
+        return _set_cache_headers(Response(status=304), validators, size_class)
+
+    file = _open_derivative(path)
+    if file is None:
+        file = _open_derivative(render_derivative(db.get_image(image_id=image_id), size_class))
+    else:
+        disk_cache.touch(path)
+    if file is None:
+        # Evicted right after it was rendered, so it is sent from memory
+        file, validators = encode_derivative(db.get_image(image_id=image_id), size_class), None
     else:
-        if not db.can_user_access_image(user_id=user_id, image_id=int(image_id[3:])):
-            return "You are not allowed to view or review this image", 401
-        image = db.get_image(image_id=int(image_id[3:]))
-        image.get_image(
-            image_size=(session["vp_width"], session["vp_height"]) if "vp_height" in session else None
-        ).save(image_io, format="PNG")
-        image_io.seek(0)
+        validators = _validators(image_id, size_class, os.fstat(file.fileno()))
 
-    executor.submit(remove_old_images)
-    return send_file(image_io, as_attachment=False, mimetype="image/png")
+    response = send_file(file, as_attachment=False, mimetype="image/jpeg", etag=False, conditional=False)
+    return _set_cache_headers(response, validators, size_class)
 
 
 @bp.route("get_adjacent_images_extended/<current_image_id>", methods=("GET",))
@@ -115,49 +193,50 @@ def get_adjacent_images_extended(current_image_id):
     config_id = int(session["config_id"])
     current_image_id = int(current_image_id[3:])
 
-    # Fetch next and previous images
-    next_image_ids = db.get_next_image_ids(user_id, config_id, current_image_id, next_images=5)
-    previous_image_id = db.get_previous_image_id(user_id, config_id, current_image_id)
-
-    # Fetch ratings for these images
-    next_images = []
-    for next_image_id in next_image_ids:
-        next_image_rating = db.get_review(user_id, next_image_id)
-        next_image_rating = next_image_rating if next_image_rating else 0
-        next_images.append({"image_path": f"/images/id_{next_image_id}", "rating": next_image_rating})
+    # Fetch next and previous images with their ratings, the ones beyond the preloaded ones are only prefetched
+    previous_images, upcoming_images = db.get_adjacent_images(
+        user_id, config_id, current_image_id, previous=1, upcoming=PREFETCH_AHEAD
+    )
+    prefetcher.schedule(
+        user_id,
+        [image_id for image_id, _ in previous_images + upcoming_images],
+        size_class_for_viewport(session.get("vp_width"), session.get("vp_height")),
+    )
 
-    previous_images = []
-    previous_image_rating = db.get_review(user_id, previous_image_id)
-    previous_image_rating = previous_image_rating if previous_image_rating else 0
-    previous_images.append({"image_path": f"/images/id_{previous_image_id}", "rating": previous_image_rating})
+    next_images = [
+        {"image_path": f"/images/id_{image_id}", "rating": rating or 0} for image_id, rating in upcoming_images[:5]
+    ]
+    previous_images = [
+        {"image_path": f"/images/id_{image_id}", "rating": rating or 0} for image_id, rating in previous_images
+    ]
 
     return jsonify({"next": next_images, "previous": previous_images})
 
 
-@bp.route("get_next_gallery_image/<current_image_id>", methods=("GET",))
-def get_next_gallery_image(current_image_id):
-    """Fetch multiple adjacent images for preloading (e.g., next 3, previous 3)."""
+@bp.route("get_gallery_page", methods=("GET",))
+def get_gallery_page():
+    """Fetch the next page of gallery images with their ratings and sizes in a single response."""
     db = get_db()
     user_id = session["user_id"]
-    image_id = customBackend.get_next_image(session["uuid"])
-    if image_id is None:
-        return jsonify({"imagePath": "", "rating": -1, "relativeHeight": -1.0})
-
-    next_image_rating = db.get_review(user_id=user_id, image_id=image_id)
-    try:
-        image = db.get_image(image_id).get_image()
-    except Exception as e:
-        logging.error(e)
-        logging.error(f"Error loading image {image_id}.")
-    next_image_relative_height = image.height / image.width
-    return jsonify(
-        {
-            "imagePath": f"/images/pre_{image_id}",
-            "rating": next_image_rating,
-            "relativeHeight": next_image_relative_height,
-            "id": image_id,
-        }
-    )
+    count = min(max(request.args.get("count", GALLERY_PAGE_SIZE, type=int), 1), MAX_GALLERY_PAGE_SIZE)
+    image_ids = customBackend.get_next_images(session["uuid"], count)
+    prefetch_gallery()
+
+    images = []
+    for entry in db.get_gallery_images(user_id=user_id, image_ids=image_ids):
+        if entry["width"] is None or entry["height"] is None:
+            # Rows ingested before the dimensions were stored, only the header of the file is downloaded
+            entry["width"], entry["height"] = read_header_metadata(entry["path"]).get_dimensions()
+            db.set_image_dimensions(entry["id"], entry["width"], entry["height"])
+        images.append(
+            {
+                "imagePath": f"/images/pre_{entry['id']}",
+                "rating": entry["rating"] if entry["rating"] else 0,
+                "relativeHeight": entry["height"] / entry["width"],
+                "id": entry["id"],
+            }
+        )
+    return jsonify({"images": images, "allImages": len(image_ids) < count})
 
 
 @bp.post("resize-image")
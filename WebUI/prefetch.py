@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict, Iterable, List, Tuple
+
+from .database import ImageTinderDatabase
+from .derivatives import derivative_path, render_derivative
+
+PREFETCH_WORKERS = int(os.environ.get("IMAGE_SORT_PREFETCH_WORKERS", "2"))
+PREFETCH_AHEAD = 10
+PREFETCH_QUEUE_SIZE = 100
+
+
+class Prefetcher:
+    """Render the derivatives of upcoming images in the background, before the user requests them.
+
+    Every user has at most `per_user_limit` queued jobs. Scheduling new images for a user removes
+    all jobs of the user which are still queued, so a user navigating somewhere else never waits
+    behind the prefetching of the previous page and the removed jobs free their place in the queue.
+    """
+
+    def __init__(self, workers: int, queue_size: int, per_user_limit: int):
+        """Create the prefetcher, the worker threads are started with the first scheduled job.
+
+        Args:
+        ----
+            workers (int): Number of worker threads.
+            queue_size (int): Maximum number of queued jobs of all users.
+            per_user_limit (int): Maximum number of queued jobs of a single user.
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.per_user_limit = per_user_limit
+        self._jobs: Deque[Tuple[int, int, str]] = deque()
+        self._pending: Dict[int, int] = defaultdict(int)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._jobs_available = threading.Condition(self._lock)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"prefetch-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def schedule(self, user_id: int, image_ids: Iterable[int], size_class: str) -> int:
+        """Replace the queued jobs of a user with rendering the given images.
+
+        Args:
+        ----
+            user_id (int): The user the images are prefetched for.
+            image_ids (Iterable[int]): Ids of the upcoming images, the most urgent first.
+            size_class (str): The size class of the derivatives to render.
+
+        Returns:
+        -------
+            int: The number of queued images.
+        """
+        self._start()
+        self.cancel(user_id)
+
+        queued = 0
+        for image_id in image_ids:
+            if derivative_path(image_id, size_class).exists():
+                continue
+            with self._lock:
+                if self._pending[user_id] >= self.per_user_limit or len(self._jobs) >= self.queue_size:
+                    break
+                self._pending[user_id] += 1
+                self._jobs.append((user_id, image_id, size_class))
+                self._jobs_available.notify()
+            queued += 1
+        return queued
+
+    def cancel(self, user_id: int):
+        """Cancel all queued jobs of a user, jobs which are already rendered are finished."""
+        with self._lock:
+            if self._pending.pop(user_id, 0):
+                self._jobs = deque(job for job in self._jobs if job[0] != user_id)
+
+    def _work(self):
+        db = None
+        while True:
+            with self._jobs_available:
+                while not self._jobs:
+                    self._jobs_available.wait()
+                user_id, image_id, size_class = self._jobs.popleft()
+                self._pending[user_id] -= 1
+            if derivative_path(image_id, size_class).exists():
+                continue
+
+            try:
+                if db is None:
+                    db = ImageTinderDatabase()
+                render_derivative(db.get_image(image_id), size_class)
+            except Exception as e:
+                logging.warning(e)
+                logging.warning(f"Could not prefetch image {image_id}")
+
+
+prefetcher = Prefetcher(workers=PREFETCH_WORKERS, queue_size=PREFETCH_QUEUE_SIZE, per_user_limit=PREFETCH_AHEAD)
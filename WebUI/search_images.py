@@ -1,63 +1,737 @@
+import argparse
+import logging
+import multiprocessing
 import os
-from concurrent.futures import ThreadPoolExecutor
-from pathlib import Path
-from typing import List
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from pathlib import Path, PurePosixPath
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 from dotenv import load_dotenv
-from nc_py_api import Nextcloud
+from nc_py_api import FsNode, Nextcloud
 
+from .caching import disk_cache, invalidate_image
 from .database import ImageTinderDatabase
+from .derivatives import derivative_path, render_derivatives
 from .Image import Custom_Image
+from .Image.header import read_header_metadata
 
 load_dotenv(override=True)
 
+# Images written to the database in one transaction
+INGEST_BATCH_SIZE = 1000
+IMAGE_SUFFIXES = [".png", ".jpg", ".jpeg", ".heic"]
+# Concurrency of the ingest stages and capacity of the queues between them
+LIST_WORKERS = int(os.environ.get("IMAGE_SORT_LIST_WORKERS", "2"))
+FETCH_WORKERS = int(os.environ.get("IMAGE_SORT_FETCH_WORKERS", "4"))
+INGEST_QUEUE_SIZE = int(os.environ.get("IMAGE_SORT_INGEST_QUEUE_SIZE", "1000"))
+# Seconds between two progress messages
+PROGRESS_INTERVAL = 10.0
+# Attempts to list a directory or read a file within one run, the delay in seconds doubles after every attempt
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+# Files which still fail are tried again by later runs, the delay doubles with every failed run
+FAILED_RETRY_DELAY = timedelta(hours=1)
+FAILED_RETRY_MAX_DELAY = timedelta(days=7)
+# Images whose files are not found keep their reviews for this long, unless a full scan confirms they are gone
+MISSING_GRACE_PERIOD = timedelta(days=int(os.environ.get("IMAGE_SORT_MISSING_DAYS", "30")))
+# Derivatives rendered for new and modified images with --derivatives, so their first review is served from the cache
+DERIVATIVE_CLASSES = ["preview", "placeholder", os.environ.get("IMAGE_SORT_DERIVATIVE_VIEW_CLASS", "view_1920")]
+DERIVATIVE_WORKERS = int(os.environ.get("IMAGE_SORT_DERIVATIVE_WORKERS", "2"))
+# Bytes rendered by one run at most, only for images taken within the last days
+DERIVATIVE_BUDGET_BYTES = int(os.environ.get("IMAGE_SORT_DERIVATIVE_MB", "512")) * 1024 * 1024
+DERIVATIVE_DAYS = int(os.environ.get("IMAGE_SORT_DERIVATIVE_DAYS", "90"))
+# Marks the end of the items of a queue
+_DONE = object()
 
-def get_image_files(dir: str, nextcloud_instance: Nextcloud) -> List[str]:
-    """Find all (recursive) image files in a nextcloud folder.
 
-    Allowed formates are [png, jpg, jpeg, png, heic]
+def read_metadata(image_path: str) -> Custom_Image:
+    """Read date, location and dimensions of an image from the header of its file."""
+    return read_header_metadata(image_path)
+
+
+def _file_info(node: FsNode) -> Tuple[str, int, str, int, str]:
+    return node.user_path, node.info.fileid, node.etag, node.info.size, str(node.info.last_modified)
+
+
+def _journal_entry(node: FsNode) -> Tuple[str, bool, int, str, int, str]:
+    return node.user_path.rstrip("/"), node.is_dir, *_file_info(node)[1:]
+
+
+class IngestPipeline:
+    """Streaming ingest of a nextcloud folder in stages connected by bounded queues.
+
+    The stages run concurrently, so files are fetched while directories are still listed:
+
+    1. list: workers list the directories which changed since the last run.
+    2. classify: one thread compares the listed files with the stored images.
+    3. fetch: workers read the metadata of new and modified files.
+    4. write: a single thread writes the images in batches, the only thread writing to the database.
+    5. render: optionally, one thread renders the derivatives of recent new and modified images in a
+       process pool, until the disk budget of the run is used up.
+
+    A full queue blocks the stage in front of it, so a slow stage slows down the stages before it
+    instead of collecting work in memory.
+
+    Every listed directory is recorded in a journal together with its entries. A run which is interrupted
+    writes what already arrived at the writer, and the next run takes the directories from the journal
+    instead of listing them again, while the images written before are unchanged and not read again.
+    Listing and reading are retried with a growing delay, files which still fail are recorded with their
+    error and retried by later runs.
+    """
+
+    def __init__(
+        self,
+        dir: str,
+        nextcloud_instance: Nextcloud,
+        database: ImageTinderDatabase,
+        *,
+        full: bool = False,
+        list_workers: int = LIST_WORKERS,
+        fetch_workers: int = FETCH_WORKERS,
+        queue_size: int = INGEST_QUEUE_SIZE,
+        batch_size: int = INGEST_BATCH_SIZE,
+        retry_delay: float = RETRY_DELAY,
+        derivatives: bool = False,
+        derivative_workers: int = DERIVATIVE_WORKERS,
+    ):
+        """Create the pipeline, it is started by run.
+
+        Args:
+        ----
+            dir (str): Parent directory where to start the search.
+            nextcloud_instance (Nextcloud): A nextcloud instance to connect to.
+            database (ImageTinderDatabase): The database to update.
+            full (bool, optional): List all directories and read the metadata of all images again.
+                Defaults to False.
+            list_workers (int, optional): Directories listed at the same time. Defaults to LIST_WORKERS.
+            fetch_workers (int, optional): Files read at the same time. Defaults to FETCH_WORKERS.
+            queue_size (int, optional): Capacity of the queues between the stages. Defaults to INGEST_QUEUE_SIZE.
+            batch_size (int, optional): Images written in one transaction. Defaults to INGEST_BATCH_SIZE.
+            retry_delay (float, optional): Seconds before the first retry of a failed listing or read.
+                Defaults to RETRY_DELAY.
+            derivatives (bool, optional): Render the derivatives of new and modified images taken within the
+                last DERIVATIVE_DAYS. Defaults to False.
+            derivative_workers (int, optional): Processes rendering derivatives. Defaults to DERIVATIVE_WORKERS.
+        """
+        self.dir = dir
+        self.nextcloud_instance = nextcloud_instance
+        self.database = database
+        self.full = full
+        self.list_workers = list_workers
+        self.fetch_workers = fetch_workers
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.derivatives = derivatives
+        self.derivative_workers = derivative_workers
+        # Listing a directory adds its subdirectories, so this queue is not bounded
+        self._directories: queue.Queue = queue.Queue()
+        self._files: queue.Queue = queue.Queue(queue_size)
+        self._fetch: queue.Queue = queue.Queue(queue_size)
+        self._write: queue.Queue = queue.Queue(queue_size)
+        self._render: queue.Queue = queue.Queue(queue_size)
+        self._rendered_bytes = 0
+        self.counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._pending_directories = 0
+        self._stored_directories: Dict[str, str] = {}
+        self._listed_directories: Dict[str, str] = {}
+        self._skipped_directories: Set[str] = set()
+        self._journal: Dict[str, Tuple[str, List[Tuple]]] = {}
+        self._errors: Dict[str, Dict[str, Any]] = {}
+        # Files which failed or wait for their retry, the directories above them are listed again
+        self._failed: Set[str] = set()
+        self._path_prefix = ""
+        self._started = datetime.now()
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.counts[key] += value
+
+    def _put(self, target: queue.Queue, item: Any):
+        """Put an item into a queue, waiting while it is full unless the pipeline stopped."""
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, source: queue.Queue, timeout: Optional[float] = None) -> Any:
+        """Get the next item of a queue, _DONE if the pipeline stopped and None after the timeout."""
+        waited = 0.0
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                waited += 0.1
+                if timeout is not None and waited >= timeout:
+                    return None
+        return _DONE
+
+    def _stage(self, function: Callable[[], None]) -> Callable[[], None]:
+        """Wrap a stage, so an error stops all stages and is raised by run."""
+
+        def run_stage():
+            try:
+                function()
+            except BaseException as e:
+                with self._lock:
+                    self._error = self._error or e
+                self._stop.set()
+
+        return run_stage
+
+    def _retry(self, function: Callable[[], Any], description: str) -> Any:
+        """Call a function, retrying it with a doubling delay until it succeeds or all attempts failed."""
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                return function()
+            except Exception as e:
+                if attempt == RETRY_ATTEMPTS - 1 or self._stop.is_set():
+                    raise
+                delay = self.retry_delay * 2**attempt
+                logging.warning(f"Could not {description}, retrying in {delay:.0f}s: {e}")
+                self._stop.wait(delay)
+
+    def _journal_node(self, entry: Tuple[str, bool, Optional[int], Optional[str], Optional[int], str]) -> FsNode:
+        """Rebuild a node which was listed by an interrupted run from its journal entry."""
+        path, is_dir, file_id, etag, size, modified = entry
+        full_path = self._path_prefix + path + ("/" if is_dir else "")
+        return FsNode(full_path, etag=etag, fileid=file_id, size=size, last_modified=datetime.fromisoformat(modified))
+
+    def _add_directory(self, node: FsNode):
+        with self._lock:
+            self._pending_directories += 1
+        self._directories.put(node)
+
+    def _list(self):
+        """List the directories whose etag changed and pass on their image files."""
+        while (directory := self._get(self._directories)) is not _DONE:
+            path = directory.user_path.rstrip("/")
+            # The etag of a directory changes with every change in its subtree
+            if self._stored_directories.get(path) == directory.etag:
+                with self._lock:
+                    self._skipped_directories.add(path)
+            else:
+                with self._lock:
+                    self._listed_directories[path] = directory.etag
+                journal = self._journal.get(path)
+                if journal is not None and journal[0] == directory.etag:
+                    self._count("resumed")
+                    nodes = [self._journal_node(entry) for entry in journal[1]]
+                else:
+                    listing = self._retry(
+                        lambda: self.nextcloud_instance.files.listdir(directory.user_path, depth=1), f"list {path}"
+                    )
+                    nodes = [
+                        node for node in listing if node.is_dir or Path(node.user_path).suffix.lower() in IMAGE_SUFFIXES
+                    ]
+                    self._put(
+                        self._write, ("directory", path, directory.etag, [_journal_entry(node) for node in nodes])
+                    )
+                for node in nodes:
+                    if node.is_dir:
+                        self._add_directory(node)
+                    else:
+                        self._count("listed")
+                        self._put(self._files, node)
+            with self._lock:
+                self._pending_directories -= 1
+                finished = self._pending_directories == 0
+            if finished:
+                for _ in range(self.list_workers):
+                    self._directories.put(_DONE)
+                self._put(self._files, _DONE)
+
+    def _in_skipped(self, path: str) -> bool:
+        return any(str(parent) in self._skipped_directories for parent in PurePosixPath(path).parents)
+
+    def _queue_fetch(self, node: FsNode):
+        """Queue a file to be read, unless it failed before and waits for its retry."""
+        error = self._errors.get(node.user_path)
+        # A failed file which changed since is read right away
+        if error and not self.full and error["etag"] == node.etag and error["next_attempt"] > self._started:
+            self._count("deferred")
+            with self._lock:
+                self._failed.add(node.user_path)
+        else:
+            self._put(self._fetch, node)
+
+    def _classify(self):
+        """Match the listed files to the stored images by their file id, falling back to the path.
+
+        A file found at the path of a stored image with a different file id replaced the stored file, e.g. by
+        renaming b.jpg to c.jpg and a.jpg to b.jpg. The stored image is then missing at its path and the file
+        is matched like a file under a new path. Images which were missing before and are found again are
+        restored like moved images.
+        """
+        known = self.database.get_image_files()
+        known_files = {file_id for _, file_id, _ in known.values() if file_id is not None}
+        missing_before = set(self.database.get_missing_image_ids())
+        listed = set()
+        # Paths of the stored images which are still there
+        found = set()
+        # Files under a new path or replacing a stored file, which are moves if their file id is missing
+        candidates = []
+        while (node := self._get(self._files)) is not _DONE:
+            listed.add(node.user_path)
+            stored = known.get(node.user_path)
+            if stored is not None and stored[1] in (None, node.info.fileid) and stored[0] not in missing_before:
+                found.add(node.user_path)
+                self._queue_known(node, stored[0], stored[2])
+            elif stored is not None or node.info.fileid in known_files:
+                candidates.append(node)
+            else:
+                self._queue_fetch(node)
+        if self._stop.is_set():
+            return
+
+        # All directories are listed, stored images which are neither found nor in an unchanged directory are gone
+        missing = {path: known[path] for path in known if path not in found and not self._in_skipped(path)}
+        # Errors of deleted files are forgotten
+        gone = [path for path in self._errors if path not in listed and not self._in_skipped(path)]
+        self._queue_moves(candidates, missing, gone)
+        for _ in range(self.fetch_workers):
+            self._put(self._fetch, _DONE)
+        self._put(self._write, _DONE)
+
+    def _queue_known(self, node: FsNode, image_id: int, etag: Optional[str]):
+        """Queue a file found at the path of its stored image, if it changed."""
+        if etag is None and not self.full:
+            self._put(self._write, ("file", node))
+        elif self.full or etag != node.etag:
+            if etag != node.etag:
+                # The content changed, the cached original and derivatives are stale
+                invalidate_image(image_id)
+            self._queue_fetch(node)
+
+    def _queue_moves(
+        self,
+        candidates: List[FsNode],
+        missing: Dict[str, Tuple[int, Optional[int], Optional[str]]],
+        gone: List[str],
+    ):
+        """Queue the moves of missing images found under a new path and the removal of the other missing images.
+
+        The removals and moves are queued in front of the candidates, which may take over the freed paths.
+        A full scan removes the missing images, otherwise they are only marked as missing.
+        """
+        missing_files = {file_id: (image_id, etag) for image_id, file_id, etag in missing.values() if file_id}
+        moved = {}
+        new = []
+        for node in candidates:
+            if node.info.fileid in missing_files:
+                image_id, etag = missing_files.pop(node.info.fileid)
+                moved[image_id] = node, etag
+            else:
+                new.append(node)
+        removed = [image_id for image_id, _, _ in missing.values() if image_id not in moved]
+        if self.full:
+            for image_id in removed:
+                # SQLite may give the id of a removed image to a new image
+                invalidate_image(image_id)
+        self._put(self._write, ("remove", removed, gone))
+        if moved:
+            self._put(self._write, ("move", {image_id: node.user_path for image_id, (node, _) in moved.items()}))
+
+        for image_id, (node, etag) in moved.items():
+            if self.full or etag != node.etag:
+                if etag != node.etag:
+                    invalidate_image(image_id)
+                self._queue_fetch(node)
+            else:
+                self._put(self._write, ("file", node))
+        for node in new:
+            self._queue_fetch(node)
+
+    def _fetch_metadata(self):
+        """Read the metadata of new and modified files."""
+        while (node := self._get(self._fetch)) is not _DONE:
+            try:
+                image = self._retry(lambda: read_metadata(node.user_path), f"read {node.user_path}")
+            except Exception as e:
+                if self._stop.is_set():
+                    return
+                logging.warning(f"Could not read {node.user_path}: {e}")
+                self._count("failed")
+                self._put(self._write, ("error", node, f"{type(e).__name__}: {e}"))
+                continue
+            self._count("fetched")
+            self._put(self._write, ("image", node, image))
+        self._put(self._write, _DONE)
+
+    def _write_batches(self):
+        """Write the images in batches, flushing early when no image arrives for a second."""
+        batch = []
+        finished = 0
+        # Every fetch worker and the classify stage mark the end of their items
+        while finished < self.fetch_workers + 1:
+            item = self._get(self._write, timeout=1.0)
+            if item is _DONE:
+                if self._stop.is_set():
+                    self._checkpoint(batch)
+                    return
+                finished += 1
+            elif item is None:
+                self._write_batch(batch)
+                batch = []
+            else:
+                batch = self._handle(item, batch)
+        self._write_batch(batch)
+
+        # Directories are stored last, so the directories of an interrupted run are listed again
+        with self._lock:
+            failed = set(self._failed)
+        withheld = {str(parent) for path in failed for parent in PurePosixPath(path).parents}
+        removed = [
+            path
+            for path in self._stored_directories
+            if path not in self._listed_directories
+            and path not in self._skipped_directories
+            and not self._in_skipped(path)
+        ]
+        listed = {path: etag for path, etag in self._listed_directories.items() if path not in withheld}
+        self.database.set_directory_etags(listed, removed + sorted(withheld))
+        self.database.clear_ingest_journal()
+        self._remove_missing()
+        self._put(self._render, _DONE)
+
+    def _remove_missing(self):
+        """Remove the images which are missing for longer than the grace period, together with their reviews."""
+        expired = self.database.get_missing_image_ids(before=self._started - MISSING_GRACE_PERIOD)
+        for image_id in expired:
+            # SQLite may give the id of a removed image to a new image
+            invalidate_image(image_id)
+        self.database.remove_images(expired)
+        self._count("removed", len(expired))
+
+    def _checkpoint(self, batch: List[Tuple]):
+        """Write everything which already arrived after the pipeline stopped, the next run resumes from there."""
+        while True:
+            try:
+                item = self._write.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _DONE:
+                batch = self._handle(item, batch)
+        self._write_batch(batch)
+
+    def _handle(self, item: Tuple, batch: List[Tuple]) -> List[Tuple]:
+        """Add an item to the batch, writing the batch when it is full or in front of moves and removals."""
+        if item[0] not in ("move", "remove"):
+            batch.append(item)
+            if len(batch) < self.batch_size:
+                return batch
+            self._write_batch(batch)
+            return []
+
+        self._write_batch(batch)
+        if item[0] == "move":
+            restored = self.database.move_images(item[1])
+            self._count("moved", len(item[1]) - restored)
+            self._count("restored", restored)
+        elif self.full:
+            self.database.remove_images(item[1])
+            self.database.remove_ingest_errors(item[2])
+            self._count("removed", len(item[1]))
+        else:
+            self._count("missing", self.database.mark_images_missing(item[1]))
+            self.database.remove_ingest_errors(item[2])
+        return []
+
+    def _error_entry(self, node: FsNode, error: str) -> Tuple[str, str, int, str, datetime, datetime]:
+        """Count a failed read, the delay before the next run retries the file doubles with every failure."""
+        previous = self._errors.get(node.user_path)
+        attempts = previous["attempts"] + 1 if previous and previous["etag"] == node.etag else 1
+        delay = min(FAILED_RETRY_DELAY * 2 ** min(attempts - 1, 16), FAILED_RETRY_MAX_DELAY)
+        now = datetime.now()
+        return node.user_path, node.etag, attempts, error, now, now + delay
+
+    def _write_batch(self, batch: List[Tuple]):
+        if not batch:
+            return
+        files = [item for item in batch if item[0] in ("image", "file")]
+        counts = {}
+        if files:
+            images = [item[2] for item in files if item[0] == "image"]
+            counts = self.database.upsert_images(images)
+            self.database.set_file_info([_file_info(item[1]) for item in files])
+            if self.derivatives:
+                self._queue_renders(images)
+        directories = [item[1:] for item in batch if item[0] == "directory"]
+        if directories:
+            self.database.add_ingest_directories(directories)
+        errors = [self._error_entry(item[1], item[2]) for item in batch if item[0] == "error"]
+        if errors:
+            self.database.set_ingest_errors(errors)
+        retried = [item[1].user_path for item in files if item[1].user_path in self._errors]
+        if retried:
+            self.database.remove_ingest_errors(retried)
+        with self._lock:
+            self.counts.update(counts)
+            self.counts["written"] += len(files)
+            self._failed.update(error[0] for error in errors)
+
+    def _queue_renders(self, images: List[Custom_Image]):
+        """Pass the written images which were taken within the last DERIVATIVE_DAYS on to be rendered."""
+        since = self._started - timedelta(days=DERIVATIVE_DAYS)
+        recent = [image.path for image in images if image.get_date() >= since]
+        if not recent:
+            return
+        for path, image_id in self.database.get_image_ids(recent).items():
+            self._put(self._render, (image_id, path))
+
+    def _render_derivatives(self):
+        """Render the derivatives of the written images in worker processes, within the disk budget of the run."""
+        pool = None
+        pending: Dict[Future, Dict[str, Path]] = {}
+        try:
+            while (item := self._get(self._render)) is not _DONE:
+                if self._rendered_bytes >= DERIVATIVE_BUDGET_BYTES:
+                    self._count("derivatives_skipped")
+                    continue
+                if pool is None:
+                    # Worker processes are spawned, forking the threads of the pipeline is not safe
+                    pool = ProcessPoolExecutor(self.derivative_workers, mp_context=multiprocessing.get_context("spawn"))
+                image_id, path = item
+                paths = {size_class: derivative_path(image_id, size_class) for size_class in DERIVATIVE_CLASSES}
+                pending[pool.submit(render_derivatives, path, paths)] = paths
+                # At most one render per process is in flight, so the budget is checked against finished renders
+                if len(pending) >= self.derivative_workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    if self._finish_renders(done, pending):
+                        # A worker process died, e.g. out of memory, the pool can not be used anymore
+                        self._finish_renders(pending, pending)
+                        pool.shutdown()
+                        pool = None
+            if not self._stop.is_set():
+                self._finish_renders(pending, pending)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    def _finish_renders(self, futures: Iterable[Future], pending: Dict[Future, Dict[str, Path]]) -> bool:
+        """Add the derivatives of finished renders to the disk cache, True if a worker process died."""
+        broken = False
+        for future in list(futures):
+            paths = pending.pop(future)
+            try:
+                size = future.result()
+            except Exception as e:
+                # The derivatives are rendered when the image is requested
+                logging.warning(f"Could not render {', '.join(path.name for path in paths.values())}: {e}")
+                self._count("derivatives_failed")
+                broken = broken or isinstance(e, BrokenProcessPool)
+                continue
+            for path in paths.values():
+                disk_cache.add(path)
+            with self._lock:
+                self.counts["derivatives"] += 1
+                self._rendered_bytes += size
+        return broken
+
+    def stats(self) -> Dict[str, int]:
+        """Get the running counters and the backlog of every queue."""
+        with self._lock:
+            stats = dict(self.counts)
+        stats.update(
+            directories_backlog=self._directories.qsize(),
+            files_backlog=self._files.qsize(),
+            fetch_backlog=self._fetch.qsize(),
+            write_backlog=self._write.qsize(),
+            render_backlog=self._render.qsize(),
+        )
+        return stats
+
+    def run(self, progress_interval: float = PROGRESS_INTERVAL) -> Counter:
+        """Run all stages until every changed image is written, logging the progress.
+
+        Returns
+        -------
+            Counter: The number of inserted, updated, unchanged, moved, restored, missing and removed images, of
+                the files which could not be read, of the failed files which wait for their retry and of the
+                images whose derivatives were rendered, failed or skipped over the budget.
+        """
+        self.counts = Counter(inserted=0, updated=0, unchanged=0, moved=0, removed=0, failed=0, deferred=0)
+        self.counts.update(restored=0, missing=0)
+        self.counts.update(derivatives=0, derivatives_failed=0, derivatives_skipped=0)
+        self._rendered_bytes = 0
+        self._started = datetime.now()
+        self._stored_directories = {} if self.full else self.database.get_directory_etags()
+        self._journal = self.database.get_ingest_journal()
+        self._errors = {error["path"]: error for error in self.database.get_ingest_errors()}
+        if self._journal:
+            logging.info(f"Resuming the interrupted ingest, {len(self._journal)} directories are already listed")
+        root = self.nextcloud_instance.files.by_path(self.dir)
+        self._path_prefix = root.full_path[: len(root.full_path) - len(root.user_path)]
+        self._add_directory(root)
+        stages = [
+            *[("list", self._list)] * self.list_workers,
+            ("classify", self._classify),
+            *[("fetch", self._fetch_metadata)] * self.fetch_workers,
+            ("write", self._write_batches),
+            *([("render", self._render_derivatives)] if self.derivatives else []),
+        ]
+        threads = [
+            threading.Thread(target=self._stage(function), name=f"ingest-{name}", daemon=True)
+            for name, function in stages
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while threads[-1].is_alive():
+                threads[-1].join(progress_interval)
+                if not threads[-1].is_alive():
+                    break
+                stats = self.stats()
+                rate = stats.get("fetched", 0) / max(time.perf_counter() - start, 1e-9)
+                logging.info(
+                    f"Ingest: listed {stats.get('listed', 0)}, fetched {stats.get('fetched', 0)} ({rate:.1f}/s), "
+                    f"written {stats.get('written', 0)}, failed {stats['failed']}, backlog {stats['files_backlog']} "
+                    f"to classify, {stats['fetch_backlog']} to fetch, {stats['write_backlog']} to write, "
+                    f"{stats['render_backlog']} to render"
+                )
+        finally:
+            # The last stage stops on errors of the other stages, the others stop with it. On an interrupt
+            # the writer still records what it received, before the threads are left behind.
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+        keys = ["inserted", "updated", "unchanged", "moved", "restored", "missing", "removed", "failed", "deferred"]
+        keys += ["derivatives", "derivatives_failed", "derivatives_skipped"]
+        return Counter({key: self.counts[key] for key in keys})
+
+
+def sync_images(
+    dir: str,
+    nextcloud_instance: Nextcloud,
+    database: ImageTinderDatabase,
+    full: bool = False,
+    derivatives: bool = False,
+) -> Counter:
+    """Apply the changes of a nextcloud folder since the last scan to the database.
+
+    Directories whose etag did not change are not listed. Files are matched to the stored images by their
+    path, moved files by their Nextcloud file id, so moved images keep their reviews. Images whose files are
+    not found are hidden and keep their reviews for MISSING_GRACE_PERIOD, a full scan removes them at once.
+    An interrupted scan is resumed, files which could not be read are listed by
+    ImageTinderDatabase.get_ingest_errors.
 
     Args:
     ----
         dir (str): Parent directory where to start the search.
         nextcloud_instance (Nextcloud): A nextcloud instance to connect to.
+        database (ImageTinderDatabase): The database to update.
+        full (bool, optional): List all directories and read the metadata of all images again. Defaults to False.
+        derivatives (bool, optional): Render the derivatives of recent new and modified images. Defaults to False.
 
     Returns:
     -------
-        List[str]: A list of all found image files
+        Counter: The number of inserted, updated, unchanged, moved, restored, missing, removed, failed and
+            deferred images and of the images whose derivatives were rendered, failed or skipped.
     """
-    image_files = []
-    for node in nextcloud_instance.files.listdir(dir, depth=100):
-        if node.is_dir:
-            continue
-        elif Path(node.user_path).suffix.lower() in [".png", ".jpg", ".jpeg", ".png", ".heic"]:
-            image_files.append(node.user_path)
+    return IngestPipeline(dir, nextcloud_instance, database, full=full, derivatives=derivatives).run()
+
+
+def read_dimensions(image_id: int, image_path: str) -> Tuple[int, int, int]:
+    """Read the dimensions of an image from its header."""
+    return (image_id, *read_header_metadata(image_path).get_dimensions())
 
-    return image_files
 
+def backfill_dimensions():
+    """Store the dimensions of all images which were added before the dimensions were stored."""
+    database = ImageTinderDatabase(database_name="./ImageSorting.sqlite")
+    images = database.get_images_without_dimensions()
+    failed = 0
+    with ThreadPoolExecutor(4) as executor:
+        futures = {executor.submit(read_dimensions, image_id, path): path for image_id, path in images.items()}
+        for future in as_completed(futures):
+            try:
+                image_id, width, height = future.result()
+            except Exception as e:
+                # The image stays without dimensions and is tried again by the next backfill
+                logging.warning(f"Could not read the dimensions of {futures[future]}: {e}")
+                failed += 1
+                continue
+            database.set_image_dimensions(image_id, width, height)
+    print(f"Stored dimensions of {len(images) - failed} images, {failed} images could not be read.")
 
-def process_image(image):
-    """Process a single image by adding or updating it in the database."""
+
+def print_ingest_errors():
+    """Print the files which could not be read by the last ingest runs."""
     database = ImageTinderDatabase(database_name="./ImageSorting.sqlite")
-    database.add_or_update_image(Custom_Image(image_id=0, path=image))
+    errors = database.get_ingest_errors()
+    for error in errors:
+        print(
+            f"{error['path']}: {error['error']} ({error['attempts']} attempts, "
+            f"next retry {error['next_attempt']:%Y-%m-%d %H:%M})"
+        )
+    print(f"{len(errors)} files could not be read.")
 
 
 def main():
     """Search for images in the nextcloud and add to database."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backfill-dimensions", action="store_true", help="Store the dimensions of already added images."
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="List all directories, read the metadata of all images again and remove the missing images.",
+    )
+    parser.add_argument("--errors", action="store_true", help="List the files which could not be read.")
+    parser.add_argument(
+        "--derivatives",
+        action="store_true",
+        help=f"Render preview, placeholder and review size of new images of the last {DERIVATIVE_DAYS} days.",
+    )
+    args = parser.parse_args()
+    if args.backfill_dimensions:
+        backfill_dimensions()
+        return
+    if args.errors:
+        print_ingest_errors()
+        return
+
     nc = Nextcloud(
         nextcloud_url=os.environ["NEXTCLOUD_URL"],
         nc_auth_user=os.environ["NEXTCLOUD_USER"],
         nc_auth_pass=os.environ["NEXTCLOUD_PASSWORD"],
     )
 
-    images = get_image_files("/Photos/", nc)
-    # Parallelize the add_or_update_image calls
-    with ThreadPoolExecutor(4) as executor:
-        futures = [executor.submit(process_image, image) for image in images]
-
-        # Optionally wait for all tasks to complete (if needed)
-        for future in futures:
-            future.result()
+    database = ImageTinderDatabase(database_name="./ImageSorting.sqlite")
+    counts = sync_images("/Photos/", nc, database, full=args.full, derivatives=args.derivatives)
+    print(
+        f"Inserted {counts['inserted']}, updated {counts['updated']}, moved {counts['moved']} and removed "
+        f"{counts['removed']} images, {counts['unchanged']} modified files had unchanged metadata."
+    )
+    if counts["missing"] or counts["restored"]:
+        print(
+            f"{counts['missing']} images went missing and keep their reviews for {MISSING_GRACE_PERIOD.days} days, "
+            f"{counts['restored']} missing images were found again."
+        )
+    if counts["failed"] or counts["deferred"]:
+        print(
+            f"{counts['failed']} files could not be read, {counts['deferred']} files which failed before wait for "
+            "their retry. List them with --errors."
+        )
+    if args.derivatives:
+        print(
+            f"Rendered the derivatives of {counts['derivatives']} images, {counts['derivatives_failed']} failed and "
+            f"{counts['derivatives_skipped']} were skipped over the budget of {DERIVATIVE_BUDGET_BYTES // 2**20} MB."
+        )
 
 
 if __name__ == "__main__":
@@ -15,6 +15,8 @@ def get_image_files(image_dir: Path) -> List[Path]:
 def add_images_to_database(image_dir: Path, nr_images: int):
     """Add images to the database.
 
+    Every image needs its own file path, so repeated pictures are linked into the "dev_images" folder.
+
     Args:
     ----
         image_dir (Path): The directory where the images are stored.
@@ -22,13 +24,21 @@ def add_images_to_database(image_dir: Path, nr_images: int):
         If there are less images in the directory than nr_images, the images will be added in a loop
     """
     image_files = get_image_files(image_dir)
+    link_dir = Path("dev_images").absolute()
+    link_dir.mkdir(exist_ok=True)
     database = ImageTinderDatabase(database_name="./ImageSorting.sqlite")
     today = datetime.datetime.now()
+    images = []
     for i_id in range(nr_images):
+        image_file = image_files[i_id % len(image_files)]
+        if i_id >= len(image_files):
+            link = Path(link_dir, f"{i_id}{image_file.suffix}")
+            if not link.is_symlink():
+                link.symlink_to(image_file.absolute())
+            image_file = link
         image_date = today - datetime.timedelta(days=i_id)
-        database.add_image_to_database(
-            Custom_Image(image_id=i_id, path=image_files[i_id % len(image_files)], date=image_date)
-        )
+        images.append(Custom_Image(image_id=i_id, path=image_file, date=image_date))
+    database.upsert_images(images)
 
 
 def add_collections_to_database(nr_images):
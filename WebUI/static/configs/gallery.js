@@ -2,17 +2,26 @@
 const preloadImages = 25
 var columnCnt = 0;
 var images = [];
-var lastImageId = NaN
 var columns = [];
 var all_images = false;
 var busyLoading = 0;
-async function fetchImageBatch() {
+function fetchImageBatch() {
     if (!all_images && busyLoading <= 0) {
-        busyLoading = busyLoading + preloadImages;
-        for (let index = 0; index < preloadImages; index++) {
-            await new Promise(r => setTimeout(r, 20));
-            addNewImage();
-        }
+        busyLoading = 1;
+        fetch(`/images/get_gallery_page?count=${preloadImages}`)
+            .then(response => response.json())
+            .then(data => {
+                data.images.forEach(image => {
+                    images.push([image.imagePath, image.relativeHeight, image.rating]);
+                    addImageToColumn(image.imagePath, image.relativeHeight, image.rating)
+                });
+                all_images = data.allImages;
+                busyLoading = 0;
+            })
+            .catch(error => {
+                busyLoading = 0;
+                console.error("Error preloading images:", error);
+            });
     }
 
 }
@@ -32,26 +41,6 @@ function buildWebsite() {
     gallery.replaceChildren(...newChildren)
 }
 
-function addNewImage() {
-    fetch(`/images/get_next_gallery_image/${lastImageId}`)
-        .then(response => response.json())
-        .then(data => {
-            // Preload the next set of images
-            if (data.relativeHeight < 0) {
-                all_images = true;
-            } else {
-                images.push([data.imagePath, data.relativeHeight, data.rating]);
-                addImageToColumn(data.imagePath, data.relativeHeight, data.rating)
-                lastImageId = data.id
-            }
-
-            busyLoading = busyLoading - 1;
-
-        })
-        .catch(error => console.error("Error preloading images:", error));
-
-}
-
 function getRatingOverlay(stars) {
     var overlay = document.createElement("div");
     overlay.className = "image-overlay";
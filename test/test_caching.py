@@ -0,0 +1,197 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from PIL import Image
+
+from WebUI import caching
+from WebUI.caching import PIN_FILE, DiskCache, ImageMemoryCache, SingleFlight
+
+
+class TestDiskCache(unittest.TestCase):
+    """Class to test the byte budgeted disk cache."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.cache_dir = Path(self.tmp_dir.name)
+
+    def write(self, name: str, size: int = 100) -> Path:
+        path = Path(self.cache_dir, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+        return path
+
+    def test_index_existing_files(self):
+        old = self.write("1.jpg")
+        os.utime(old, (1, 1))
+        self.write("derivatives/2_preview.jpg")
+        self.write(PIN_FILE, 5)
+
+        cache = DiskCache(self.cache_dir, budget_bytes=100)
+        self.assertEqual(cache.evict(), 1)
+        self.assertFalse(old.exists())
+        self.assertTrue(Path(self.cache_dir, "derivatives/2_preview.jpg").exists())
+        self.assertTrue(Path(self.cache_dir, PIN_FILE).exists())
+
+    def test_evict_least_recently_used(self):
+        cache = DiskCache(self.cache_dir, budget_bytes=250)
+        first = self.write("1.jpg")
+        cache.add(first)
+        second = self.write("2.jpg")
+        cache.add(second)
+        cache.touch(first)
+
+        cache.add(self.write("3.jpg"))
+        self.assertTrue(first.exists())
+        self.assertFalse(second.exists())
+        self.assertEqual(cache.total_bytes, 200)
+
+    def test_touch_files_of_other_processes(self):
+        cache = DiskCache(self.cache_dir, budget_bytes=250)
+        cache.add(self.write("1.jpg"))
+        # Written after the index was built, e.g. by search_images
+        rendered = self.write("2_preview.jpg")
+        cache.touch(rendered)
+        self.assertEqual(cache.total_bytes, 200)
+        cache.touch(Path(self.cache_dir, "3.jpg"))
+        self.assertEqual(cache.total_bytes, 200)
+
+        cache.add(self.write("4.jpg"))
+        self.assertFalse(Path(self.cache_dir, "1.jpg").exists())
+        self.assertTrue(rendered.exists())
+
+    def test_pinned_images_are_kept(self):
+        self.write(PIN_FILE).write_text("1.jpg\n2.jpg\n")
+        cache = DiskCache(self.cache_dir, budget_bytes=100)
+        pinned = self.write("1.jpg")
+        cache.add(pinned)
+        cache.add(self.write("1_preview.jpg"))
+        cache.add(self.write("3.jpg"))
+        self.assertTrue(pinned.exists())
+        self.assertTrue(Path(self.cache_dir, "1_preview.jpg").exists())
+        self.assertFalse(Path(self.cache_dir, "3.jpg").exists())
+
+        cache.pin([3])
+        cache.add(self.write("4.jpg"))
+        self.assertFalse(pinned.exists())
+        self.assertEqual(Path(self.cache_dir, PIN_FILE).read_text(), "3.jpg\n")
+
+
+class TestImageMemoryCache(unittest.TestCase):
+    """Class to test the in-process cache of decoded images."""
+
+    def test_lru_within_budget(self):
+        cache = ImageMemoryCache(budget_bytes=2 * 10 * 10 * 3)
+        first = Image.new("RGB", (10, 10))
+        cache.put((1, None), first)
+        cache.put((2, None), Image.new("RGB", (10, 10)))
+        self.assertIs(cache.get((1, None)), first)
+
+        cache.put((3, None), Image.new("RGB", (10, 10)))
+        self.assertIsNone(cache.get((2, None)))
+        self.assertIs(cache.get((1, None)), first)
+        self.assertEqual(cache.stats, {"hits": 2, "misses": 1, "entries": 2, "bytes": 600})
+
+        cache.put((4, None), Image.new("RGB", (100, 100)))
+        self.assertEqual(cache.stats["entries"], 2)
+
+    def test_invalidate(self):
+        cache = ImageMemoryCache(budget_bytes=10_000)
+        cache.put((1, None), Image.new("RGB", (10, 10)))
+        cache.put((1, (5, 5)), Image.new("RGB", (5, 5)))
+        cache.put((2, None), Image.new("RGB", (10, 10)))
+        cache.invalidate(1)
+        self.assertIsNone(cache.get((1, None)))
+        self.assertIsNone(cache.get((1, (5, 5))))
+        self.assertIsNotNone(cache.get((2, None)))
+        self.assertEqual(cache.total_bytes, 300)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Class to test the coalescing of concurrent calls."""
+
+    def test_concurrent_calls_share_one_run(self):
+        group = SingleFlight()
+        calls = []
+        results = []
+
+        def download():
+            calls.append(1)
+            time.sleep(0.1)
+            return "image"
+
+        threads = [threading.Thread(target=lambda: results.append(group.do(1, download))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["image"] * 5)
+
+        group.do(1, download)
+        self.assertEqual(len(calls), 2)
+
+    def test_exception_is_raised(self):
+        group = SingleFlight()
+        with self.assertRaises(ValueError):
+            group.do(1, lambda: int("x"))
+        self.assertEqual(group.do(1, lambda: 2), 2)
+
+
+class TestOriginals(unittest.TestCase):
+    """Class to test the cache of original image bytes."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.nextcloud = MagicMock()
+        with open("./test/test.jpg", "rb") as t_img:
+            self.payload = t_img.read()
+        self.nextcloud.files.download.return_value = self.payload
+        for patcher in [
+            patch.object(caching, "debug", False),
+            patch.object(caching, "nextcloud_instance", self.nextcloud),
+            patch.object(caching, "ORIGINALS_DIR", Path(tmp_dir.name)),
+            patch.object(caching, "_originals", {}),
+            patch.object(caching, "_originals_scanned", threading.Event()),
+            patch.object(caching, "disk_cache", DiskCache(tmp_dir.name, budget_bytes=10**9)),
+            patch.object(caching, "DERIVATIVE_DIR", Path(tmp_dir.name)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_original_bytes_are_kept(self):
+        path = caching.original_path("/Photos/test.JPG", 7)
+        self.assertEqual(path.suffix, ".jpg")
+        self.assertTrue(path.name.startswith("7-"))
+        self.assertEqual(path.read_bytes(), self.payload)
+
+        self.assertEqual(caching.original_path("/Photos/test.JPG", 7), path)
+        self.assertEqual(caching.load_image("/Photos/test.JPG", 7).size, (5712, 4284))
+        self.nextcloud.files.download.assert_called_once()
+
+    def test_cached_original_is_not_downloaded_again(self):
+        path = caching.original_path("/Photos/test.JPG", 7)
+        # E.g. a caller which missed the cache before a concurrent download finished
+        self.assertEqual(caching._cache_original("/Photos/test.JPG", 7), path)
+        self.nextcloud.files.download.assert_called_once()
+
+    def test_changed_source_replaces_original(self):
+        old_path = caching.original_path("/Photos/test.png", 7)
+        old_path.unlink()
+        self.nextcloud.files.download.return_value = b"changed"
+        rendered = [Path(caching.DERIVATIVE_DIR, f"{image_id}_preview.jpg") for image_id in (7, 70)]
+        for path in rendered:
+            path.write_bytes(b"x")
+        new_path = caching.original_path("/Photos/test.png", 7)
+        self.assertNotEqual(old_path, new_path)
+        self.assertCountEqual(list(new_path.parent.iterdir()), [new_path, rendered[1]])
+
+
+if __name__ == "__main__":
+    unittest.main()
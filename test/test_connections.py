@@ -0,0 +1,52 @@
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from WebUI.database.connections import ConnectionManager, get_connection_manager
+
+
+class TestConnectionManager(unittest.TestCase):
+    """Class to test the shared SQLite connections."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.manager = ConnectionManager(str(Path(tmp_dir.name, "test.sqlite")))
+        self.addCleanup(self.manager.close)
+        with self.manager.writer() as connection:
+            connection.execute("CREATE TABLE item (id INTEGER PRIMARY KEY);")
+
+    def test_pragmas(self):
+        reader = self.manager.reader()
+        self.assertEqual(reader.execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+        self.assertEqual(reader.execute("PRAGMA synchronous;").fetchone()[0], 1)
+        with self.assertRaises(sqlite3.OperationalError):
+            reader.execute("INSERT INTO item (id) VALUES (1);")
+
+    def test_reader_per_thread(self):
+        self.assertIs(self.manager.reader(), self.manager.reader())
+        readers = []
+        thread = threading.Thread(target=lambda: readers.append(self.manager.reader()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(readers[0], self.manager.reader())
+
+    def test_readers_see_writes(self):
+        reader = self.manager.reader()
+        with self.manager.writer() as connection:
+            connection.execute("INSERT INTO item (id) VALUES (1);")
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM item;").fetchone()[0], 1)
+
+        with self.assertRaises(ValueError), self.manager.writer() as connection:
+            connection.execute("INSERT INTO item (id) VALUES (2);")
+            raise ValueError
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM item;").fetchone()[0], 1)
+
+    def test_shared_manager(self):
+        self.assertIs(get_connection_manager("shared.sqlite"), get_connection_manager("./shared.sqlite"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import sqlite3
+import tempfile
 import unittest
 from datetime import datetime
 from pathlib import Path
@@ -6,19 +7,29 @@ from unittest.mock import MagicMock, patch
 
 from WebUI.database import ImageTinderDatabase as DB
 from WebUI.database import UserAlreadyExists, UserNotExisting, WrongPassword
+from WebUI.Image import Custom_Image
+
+
+def new_image(path: str, date: datetime, location: str = "Park", width: int = 4, height: int = 3) -> Custom_Image:
+    """Create an image with all metadata set, so nothing is read from Nextcloud."""
+    return Custom_Image(image_id=0, path=path, location=location, date=date, width=width, height=height)
 
 
 class TestImageSelector(unittest.TestCase):
     """Test ImageSelector class."""
 
-    def __init__(self, methodName: str = "Test SelectorImage class") -> None:
-        """Set up Testclass."""
-        super().__init__(methodName)
-        connection = sqlite3.connect("test.sqlite")
+    def setUp(self):
+        # A database of its own for every test, so no files are left behind in the working tree
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        database_name = str(Path(tmp_dir.name, "test.sqlite"))
+        connection = sqlite3.connect(database_name)
+        self.addCleanup(connection.close)
         self.cursor = connection.cursor()
         self.set_up_database()
 
-        self.db = DB(database_name="test.sqlite")
+        self.db = DB(database_name=database_name)
+        self.addCleanup(self.db.connections.close)
 
     def set_up_database(self):
         with open(Path(Path(__file__).parent.parent.parent, "ImageSorting/Database/schema.sql")) as sql_file:
@@ -57,6 +68,9 @@ class TestImageSelector(unittest.TestCase):
         with self.assertRaises(UserNotExisting):
             user_id = self.db.get_user_id_from_table("unknow@user.com", "apassword")
 
+        with self.assertRaises(UserNotExisting):
+            user_id = self.db.get_user_id_from_table("' OR '1'='1", "apassword")
+
     @patch("WebUI.database.db_wrapper.check_password_hash")
     def test_get_username(self, check_password: MagicMock):
         check_password.side_effect = self.mock_check_password
@@ -204,6 +218,69 @@ class TestImageSelector(unittest.TestCase):
 
         self.assertDictEqual(result, expectation)
 
+    def test_collection_overview(self):
+        with patch.object(self.db, "_execute_sql", wraps=self.db._execute_sql) as execute_sql:
+            collections = self.db.get_user_collections(1)
+        execute_sql.assert_called_once()
+        self.assertListEqual(
+            [(c.id, c.images, c.rated_images) for c in collections[:3]], [(1, 8, 3), (2, 3, 0), (3, 1, 0)]
+        )
+        self.assertEqual(collections[0].preview_image, 1)
+
+        collection = self.db.get_collection_info(2, 6)
+        self.assertEqual((collection.name, collection.images, collection.rated_images), ("collection2", 3, 1))
+        self.assertEqual(collection.preview_image, 7)
+
+        collection_id = self.db.add_collection("empty", datetime(2020, 1, 1), datetime(2020, 2, 1), user_id=1)
+        collection = self.db.get_collection_info(collection_id, 1)
+        self.assertEqual((collection.images, collection.preview_image), (0, None))
+
+    def test_get_adjacent_images(self):
+        self.db.add_or_update_review(user_id=7, image_id=5, review=4.0)
+        self.db.add_or_update_review(user_id=7, image_id=2, review=2.0)
+        with patch.object(self.db, "_execute_sql", wraps=self.db._execute_sql) as execute_sql:
+            previous, upcoming = self.db.get_adjacent_images(7, 1, 3, previous=2, upcoming=3)
+        execute_sql.assert_called_once()
+        self.assertListEqual(previous, [(6, None), (5, 4.0)])
+        self.assertListEqual(upcoming, [(8, None), (2, 2.0), (9, None)])
+
+        self.assertTupleEqual(self.db.get_adjacent_images(7, 1, 1, previous=1, upcoming=0), ([], []))
+        # User 5 has no access to the collection
+        self.assertTupleEqual(self.db.get_adjacent_images(5, 1, 3), ([], []))
+        self.assertDictEqual(self.db.get_reviews(7, [5, 2, 8]), {5: 4.0, 2: 2.0})
+
+    def test_get_collection_page(self):
+        # Images 2 and 9 are taken at the same time
+        pages = []
+        cursor = None
+        while not pages or len(pages[-1]) == 3:
+            pages.append(self.db.get_collection_page(1, cursor=cursor, count=3))
+            cursor = pages[-1][-1] if pages[-1] else None
+        self.assertListEqual(pages, [[1, 5, 6], [3, 8, 2], [9, 4]])
+        self.assertListEqual(self.db.get_collection_page(1, count=3, backward=True), [4, 9, 2])
+        self.assertListEqual(self.db.get_collection_page(1, cursor=2, count=3, backward=True), [8, 3, 6])
+
+        self.assertListEqual(self.db.get_next_image_ids(1, 1, 2), [9])
+        self.assertEqual(self.db.get_previous_image_id(1, 1, 9), 2)
+        self.assertIsNone(self.db.get_previous_image_id(1, 1, 1))
+
+    def test_get_images_ids_filtered(self):
+        # Images 8, 2 and 9 are taken on the same day
+        for image_id, rating in [(8, 2.0), (2, 5.0), (9, 4.0), (3, 1.0), (4, 3.0)]:
+            self.db.add_or_update_review(user_id=100, image_id=image_id, review=rating)
+
+        def filtered(min_rating, max_results_per_day):
+            return self.db.get_images_ids_filtered(
+                user_id=100, config_id=1, min_rating=min_rating, max_results_per_day=max_results_per_day
+            )
+
+        self.assertListEqual(filtered(0, 0), [3, 8, 2, 9, 4])
+        self.assertListEqual(filtered(2, 0), [8, 2, 9, 4])
+        self.assertListEqual(filtered(0, 1), [3, 2, 4])
+        self.assertListEqual(filtered(0, 2), [3, 2, 9, 4])
+        self.assertListEqual(filtered(5, 1), [2])
+        self.assertListEqual(self.db.get_images_ids_filtered(101, 1, 0, 0), [])
+
     def test_get_image_id(self):
         result_id = self.db.get_image_id("/path/to/image1.jpg")
         self.assertIsNotNone(result_id)
@@ -214,6 +291,147 @@ class TestImageSelector(unittest.TestCase):
         result_id = self.db.get_image_id("/path/to/image01.jpg")
         self.assertIsNone(result_id)
 
+    def test_image_dimensions(self):
+        image_id = self.db.get_image_id("/path/to/image2.jpg")
+        self.assertIn(image_id, self.db.get_images_without_dimensions())
+        self.db.set_image_dimensions(image_id, 300, 400)
+        self.assertNotIn(image_id, self.db.get_images_without_dimensions())
+
+        image = self.db.get_image(image_id)
+        self.assertEqual(image.get_dimensions(), (300, 400))
+        self.cursor.execute(f"SELECT aspect_ratio FROM image WHERE id = {image_id}")
+        self.assertListEqual(list(self.cursor), [(0.75,)])
+
+        # E.g. a broken header
+        self.db.set_image_dimensions(image_id, 300, 0)
+        self.cursor.execute(f"SELECT aspect_ratio FROM image WHERE id = {image_id}")
+        self.assertListEqual(list(self.cursor), [(None,)])
+
+    def test_get_gallery_images(self):
+        self.db.set_image_dimensions(3, 300, 400)
+        result = self.db.get_gallery_images(user_id=4, image_ids=[3, 6, 9999])
+        self.assertListEqual([entry["id"] for entry in result], [3, 6])
+        self.assertEqual(result[0]["rating"], "like")
+        self.assertEqual((result[0]["width"], result[0]["height"]), (300, 400))
+        self.assertIsNone(result[1]["rating"])
+        self.assertListEqual(self.db.get_gallery_images(user_id=4, image_ids=[]), [])
+
+    def test_collection_images(self):
+        collection_id = self.db.add_collection("2019", datetime(2019, 1, 1), datetime(2019, 12, 31), user_id=1)
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [])
+        self.db.save_collection(
+            name="2023", start_date=datetime(2023, 7, 16), end_date=datetime(2023, 7, 18), id=collection_id
+        )
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [6, 3])
+        self.db.save_collection(
+            name="2019", start_date=datetime(2019, 1, 1), end_date=datetime(2019, 12, 31), id=collection_id
+        )
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [])
+
+        self.db.add_image_to_database(new_image("/path/to/new.jpg", datetime(2019, 7, 17, 12), width=400, height=300))
+        new_id = self.db.get_image_id("/path/to/new.jpg")
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [new_id])
+        self.assertTrue(self.db.can_user_access_image(user_id=1, image_id=new_id))
+
+    def test_update_best_images(self):
+        collection_id = self.db.add_collection("2018", datetime(2018, 1, 1), datetime(2018, 12, 31), user_id=10)
+        self.db.add_user_to_collection(user_id=9, collection_id=collection_id)
+        image_ids = []
+        for day in [
+            datetime(2018, 3, 1),
+            datetime(2018, 3, 2),
+            datetime(2018, 3, 3),
+            datetime(2018, 3, 4),
+            datetime(2017, 3, 1),
+        ]:
+            path = f"/path/to/best_{day.date()}.jpg"
+            self.db.add_image_to_database(new_image(path, day))
+            image_ids.append(self.db.get_image_id(path))
+        first, second, third, trashed, outside = image_ids
+
+        def best_images():
+            query = "SELECT image_id FROM collection_best_image WHERE collection_id = ? ORDER BY rank;"
+            return [row[0] for row in self.db._execute_sql(query, True, (collection_id,))]
+
+        self.assertIn(collection_id, self.db.update_best_images())
+        self.assertListEqual(best_images(), [])
+
+        self.db.add_or_update_review(user_id=10, image_id=first, review=5.0)
+        self.db.add_or_update_review(user_id=10, image_id=second, review=3.0)
+        self.db.add_or_update_review(user_id=10, image_id=third, review=1.0)
+        self.db.add_or_update_review(user_id=9, image_id=third, review=4.5)
+        self.db.add_or_update_review(user_id=10, image_id=trashed, review=5.0, trash=True)
+        self.db.add_or_update_review(user_id=10, image_id=outside, review=5.0)
+        # Not a user of the collection
+        self.db.add_or_update_review(user_id=8, image_id=second, review=5.0)
+        self.assertIn(collection_id, self.db.update_best_images())
+        self.assertListEqual(best_images(), [first, third, second])
+        self.assertIn(self.db.get_collection_info(collection_id, 10).preview_image, [first, third, second])
+        self.assertLessEqual({first, second, third}, set(self.db.get_best_images()))
+
+        # Unchanged collections are not recomputed
+        self.assertNotIn(collection_id, self.db.update_best_images())
+        self.db.add_or_update_review(user_id=10, image_id=trashed, review=5.0)
+        self.assertIn(collection_id, self.db.update_best_images())
+        self.assertListEqual(best_images(), [first, trashed, third])
+
+    def test_upsert_images(self):
+        collection_id = self.db.add_collection("2016", datetime(2016, 1, 1), datetime(2016, 12, 31), user_id=10)
+
+        def image(name, date, location="Park"):
+            return new_image(f"/path/to/upsert_{name}.jpg", date, location)
+
+        counts = self.db.upsert_images([image("a", datetime(2016, 5, 1)), image("b", datetime(2016, 5, 2))])
+        self.assertDictEqual(counts, {"inserted": 2, "updated": 0, "unchanged": 0})
+        first, second = self.db.get_image_id("/path/to/upsert_a.jpg"), self.db.get_image_id("/path/to/upsert_b.jpg")
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [first, second])
+
+        counts = self.db.upsert_images([image("a", datetime(2016, 5, 1)), image("b", datetime(2016, 5, 2))])
+        self.assertDictEqual(counts, {"inserted": 0, "updated": 0, "unchanged": 2})
+
+        counts = self.db.upsert_images(
+            [
+                image("a", datetime(2016, 5, 1), "Beach"),
+                image("b", datetime(2015, 5, 2)),
+                image("c", datetime(2016, 5, 3)),
+                image("c", datetime(2016, 5, 3)),
+            ]
+        )
+        self.assertDictEqual(counts, {"inserted": 1, "updated": 2, "unchanged": 0})
+        self.assertEqual(self.db.get_image_id("/path/to/upsert_b.jpg"), second)
+        self.assertEqual(self.db.get_image(first).get_location(), "Beach")
+        self.assertListEqual(
+            self.db.get_all_image_ids(collection_id), [first, self.db.get_image_id("/path/to/upsert_c.jpg")]
+        )
+        self.assertEqual(self.db.get_image_paths()["/path/to/upsert_a.jpg"], first)
+
+    def test_missing_images(self):
+        collection_id = self.db.add_collection("2014", datetime(2014, 1, 1), datetime(2014, 12, 31), user_id=10)
+        path = "/path/to/missing.jpg"
+        self.db.upsert_images([new_image(path, datetime(2014, 5, 1))])
+        image_id = self.db.get_image_id(path)
+        self.db.add_or_update_review(user_id=10, image_id=image_id, review=5.0)
+
+        self.assertEqual(self.db.mark_images_missing([image_id]), 1)
+        self.assertEqual(self.db.mark_images_missing([image_id]), 0)
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [])
+        self.assertFalse(self.db.can_user_access_image(user_id=10, image_id=image_id))
+        self.assertEqual(self.db.get_review(10, image_id), 5.0)
+        self.assertListEqual(self.db.get_missing_image_ids(), [image_id])
+        self.assertListEqual(self.db.get_missing_image_ids(before=datetime(2014, 1, 1)), [])
+
+        # A new file takes the path, the missing image is found again under another path
+        self.db.upsert_images([new_image(path, datetime(2014, 5, 2))])
+        new_id = self.db.get_image_id(path)
+        self.assertNotEqual(new_id, image_id)
+        self.assertEqual(self.db.move_images({image_id: "/path/to/found.jpg"}), 1)
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [image_id, new_id])
+        self.assertListEqual(self.db.get_missing_image_ids(), [])
+
+        self.db.remove_images([image_id])
+        self.assertIsNone(self.db.get_review(10, image_id))
+        self.assertListEqual(self.db.get_all_image_ids(collection_id), [new_id])
+
 
 if __name__ == "__main__":
     unittest.main()
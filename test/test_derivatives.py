@@ -0,0 +1,65 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from PIL import Image
+
+from WebUI.caching import image_cache
+from WebUI.derivatives import get_derivative, size_class_for_viewport
+from WebUI.Image import Custom_Image
+
+
+class TestDerivatives(unittest.TestCase):
+    """Class to test the derivative store."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        patcher = patch("WebUI.derivatives.DERIVATIVE_DIR", Path(self.tmp_dir.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_size_class_for_viewport(self):
+        self.assertEqual(size_class_for_viewport(None, None), "full")
+        self.assertEqual(size_class_for_viewport(800, 600), "view_1280")
+        self.assertEqual(size_class_for_viewport(1080, 1920), "view_1920")
+        self.assertEqual(size_class_for_viewport(5000, 3000), "full")
+
+    def test_render_once(self):
+        image = Custom_Image(image_id=0, path="./test/test.jpg")
+        path = get_derivative(image, "preview")
+        with Image.open(path) as preview:
+            self.assertEqual(max(preview.size), 512)
+            # test.jpg is stored in landscape with orientation 6
+            self.assertGreater(preview.height, preview.width)
+
+        mtime = path.stat().st_mtime_ns
+        with patch("WebUI.derivatives.render_derivative") as render:
+            self.assertEqual(get_derivative(image, "preview"), path)
+            render.assert_not_called()
+        self.assertEqual(path.stat().st_mtime_ns, mtime)
+
+    def test_render_ignores_cached_images(self):
+        # Decoded before search_images replaced the source in another process
+        stale = Image.new("RGB", (40, 30))
+        image_cache.put((5, None), stale)
+        image_cache.put((5, (512, 512)), stale)
+        self.addCleanup(image_cache.invalidate, 5)
+        with patch("WebUI.Image.image.load_image", side_effect=lambda **_: Image.open("./test/test.jpg")):
+            path = get_derivative(Custom_Image(image_id=5, path="/Photos/test.jpg"), "preview")
+        with Image.open(path) as preview:
+            self.assertEqual(max(preview.size), 512)
+            self.assertGreater(preview.height, preview.width)
+
+    def test_scaled_decode_matches_full_decode(self):
+        image = Custom_Image(image_id=0, path="./test/test.jpg")
+        for size in [(512, 512), (1920, 1080)]:
+            full = Custom_Image(image_id=0, path="./test/test.jpg").get_image().copy()
+            full.thumbnail(size)
+            self.assertEqual(image.get_image(image_size=size).size, full.size)
+        self.assertIsNone(image.image)
+
+
+if __name__ == "__main__":
+    unittest.main()
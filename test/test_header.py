@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+from unittest.mock import patch
+
+from PIL import Image
+from PIL.ExifTags import IFD
+
+from WebUI.Image import Custom_Image
+from WebUI.Image.header import HEADER_CHUNK_BYTES, read_header_metadata
+
+
+class TestHeader(unittest.TestCase):
+    """Class to test reading the metadata from the header of image files."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.reads = []
+        patcher = patch("WebUI.Image.header.download_range", self.download_range)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        exif.get_ifd(IFD.Exif)[0x9003] = "2021:05:06 07:08:09"
+        gps = exif.get_ifd(IFD.GPSInfo)
+        gps.update({1: "N", 2: (52.0, 31.0, 12.0), 3: "W", 4: (13.0, 24.0, 0.0)})
+        self.exif = exif.tobytes()
+        self.image = Image.effect_noise((600, 400), 64).convert("RGB")
+
+    def download_range(self, image_path, start, length):
+        self.reads.append(length)
+        with open(image_path, "rb") as file:
+            file.seek(start)
+            return file.read(length)
+
+    def save(self, format, **kwargs):
+        path = str(Path(self.tmp_dir, f"image.{format.lower()}"))
+        self.image.save(path, format, **kwargs)
+        return path
+
+    def test_jpeg(self):
+        image = read_header_metadata(self.save("JPEG", exif=self.exif, quality=100))
+        self.assertEqual(image.get_date(), datetime(2021, 5, 6, 7, 8, 9))
+        self.assertEqual(image.get_dimensions(), (400, 600))
+        self.assertEqual(image.get_location(), "52.520000, -13.400000")
+        self.assertListEqual(self.reads, [HEADER_CHUNK_BYTES])
+
+    def test_large_header(self):
+        # An embedded ICC profile pushes the image header behind the first chunk
+        path = self.save("JPEG", exif=self.exif, icc_profile=bytes(3 * HEADER_CHUNK_BYTES))
+        image = read_header_metadata(path)
+        self.assertEqual(image.get_dimensions(), (400, 600))
+        self.assertLess(sum(self.reads), Path(path).stat().st_size)
+
+    def test_heif(self):
+        path = self.save("HEIF", exif=self.exif)
+        image = read_header_metadata(path)
+        self.assertEqual(image.get_date(), datetime(2021, 5, 6, 7, 8, 9))
+        self.assertEqual(image.get_dimensions(), Custom_Image(image_id=0, path=path).get_dimensions())
+        self.assertEqual(image.get_location(), "52.520000, -13.400000")
+        self.assertLess(sum(self.reads), HEADER_CHUNK_BYTES + 1024)
+
+    def test_without_exif(self):
+        image = read_header_metadata(self.save("PNG"))
+        self.assertEqual(image.get_dimensions(), (600, 400))
+        self.assertEqual(image.get_location(), "Unknown location")
+        self.assertEqual(image.get_date().date(), datetime.today().date())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,8 @@ import unittest
 from datetime import datetime
 from unittest.mock import MagicMock
 
+from PIL import Image
+
 from WebUI.Image import Custom_Image
 
 
@@ -49,5 +51,20 @@ class TestCustomImage(unittest.TestCase):
         self.assertEqual(self.custom_image.get_date(), datetime.strptime("2023:01:01", "%Y:%m:%d"))
 
 
+class TestOrientation(unittest.TestCase):
+    """Class to test the correction of the EXIF orientation."""
+
+    def test_apply_orientation(self):
+        # Pixel at the top left corner of the stored image, the image is 3 wide and 2 high
+        img = Image.new("L", (3, 2))
+        img.putpixel((0, 0), 255)
+        expected = {1: (0, 0), 2: (2, 0), 3: (2, 1), 4: (0, 1), 5: (0, 0), 6: (1, 0), 7: (1, 2), 8: (0, 2)}
+        for orientation, position in expected.items():
+            img.getexif()[0x0112] = orientation
+            oriented = Custom_Image(image_id=0, path="./test/test.jpg")._apply_orientation(img)
+            self.assertEqual(oriented.getpixel(position), 255, orientation)
+            self.assertEqual(oriented.size, (2, 3) if orientation >= 5 else (3, 2))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,56 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from WebUI.prefetch import Prefetcher
+
+
+class TestPrefetcher(unittest.TestCase):
+    """Class to test the background prefetching of derivatives."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = Path(tmp_dir.name)
+        patcher = patch("WebUI.prefetch.derivative_path", lambda image_id, _: Path(self.tmp_dir, f"{image_id}"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_limits(self):
+        prefetcher = Prefetcher(workers=0, queue_size=3, per_user_limit=2)
+        Path(self.tmp_dir, "1").touch()
+        self.assertEqual(prefetcher.schedule(1, [1, 2, 3, 4], "preview"), 2)
+        self.assertEqual(prefetcher.schedule(2, [5, 6], "preview"), 1)
+
+    def test_rescheduling_frees_the_queue(self):
+        prefetcher = Prefetcher(workers=0, queue_size=3, per_user_limit=2)
+        self.assertEqual(prefetcher.schedule(1, [1, 2], "preview"), 2)
+        self.assertEqual(prefetcher.schedule(1, [3, 4], "preview"), 2)
+        self.assertEqual(prefetcher.schedule(2, [5, 6], "preview"), 1)
+        self.assertEqual(list(prefetcher._jobs), [(1, 3, "preview"), (1, 4, "preview"), (2, 5, "preview")])
+
+    @patch("WebUI.prefetch.ImageTinderDatabase", MagicMock(return_value=MagicMock(get_image=lambda image_id: image_id)))
+    def test_cancelled_jobs_are_skipped(self):
+        prefetcher = Prefetcher(workers=0, queue_size=10, per_user_limit=10)
+        prefetcher.schedule(1, [1, 2], "preview")
+        prefetcher.cancel(1)
+        prefetcher.schedule(1, [3], "preview")
+
+        rendered = []
+        done = threading.Event()
+
+        def render(image, size_class):
+            rendered.append((image, size_class))
+            done.set()
+
+        with patch("WebUI.prefetch.render_derivative", render):
+            prefetcher.workers = 1
+            prefetcher._start()
+            self.assertTrue(done.wait(5))
+        self.assertEqual(rendered, [(3, "preview")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from WebUI.database import ImageTinderDatabase
+from WebUI.database.review_queue import ReviewQueue
+
+
+class TestReviewQueue(unittest.TestCase):
+    """Class to test the write-behind queue of reviews."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.database_name = str(Path(tmp_dir.name, "test.sqlite"))
+        connection = sqlite3.connect(self.database_name)
+        connection.executescript(Path(Path(__file__).parent.parent, "Database", "schema.sql").read_text())
+        connection.close()
+
+        self.db = ImageTinderDatabase(database_name=self.database_name)
+        self.addCleanup(self.db.connections.close)
+        self.queue = ReviewQueue(self.db.connections, flush_interval=60)
+        self.db.review_queue = self.queue
+
+    def stored_reviews(self):
+        connection = sqlite3.connect(self.database_name)
+        reviews = connection.execute(
+            "SELECT user_id, image_id, rating, deleted FROM user_image ORDER BY image_id"
+        ).fetchall()
+        connection.close()
+        return reviews
+
+    def test_read_your_writes(self):
+        self.db.add_or_update_review(user_id=1, image_id=1, review=3.0)
+        self.db.add_or_update_review(user_id=1, image_id=2, review=1.0)
+        self.db.add_or_update_review(user_id=1, image_id=1, review=0, trash=True)
+        self.assertListEqual(self.stored_reviews(), [])
+        self.assertEqual(self.db.get_review(1, 2), 1.0)
+        self.assertDictEqual(self.db.get_reviews(1, [1, 2, 3]), {1: 0, 2: 1.0})
+        self.assertIsNone(self.db.get_review(2, 2))
+
+        self.queue.flush()
+        self.assertListEqual(self.stored_reviews(), [(1, 1, 0.0, 1), (1, 2, 1.0, 0)])
+        self.assertEqual(self.db.get_review(1, 2), 1.0)
+
+    def test_close_flushes(self):
+        self.db.add_or_update_review(user_id=1, image_id=1, review=3.0)
+        self.queue.close()
+        self.assertListEqual(self.stored_reviews(), [(1, 1, 3.0, 0)])
+
+    def test_failed_write_is_retried(self):
+        self.db.add_or_update_review(user_id=1, image_id=1, review=3.0)
+        with patch.object(self.db.connections, "writer", side_effect=sqlite3.OperationalError("database is locked")):
+            self.queue.flush()
+        self.assertEqual(self.db.get_review(1, 1), 3.0)
+        self.queue.flush()
+        self.assertListEqual(self.stored_reviews(), [(1, 1, 3.0, 0)])
+
+    def test_write_through(self):
+        self.db.review_queue = None
+        self.db.add_or_update_review(user_id=1, image_id=1, review=3.0)
+        self.db.add_or_update_review(user_id=1, image_id=1, review=4.0)
+        self.assertListEqual(self.stored_reviews(), [(1, 1, 4.0, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,319 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from nc_py_api import FsNode
+from PIL import Image
+
+from WebUI.caching import DiskCache
+from WebUI.database import ImageTinderDatabase
+from WebUI.derivatives import derivative_path
+from WebUI.Image import Custom_Image
+from WebUI.search_images import IngestPipeline
+
+
+class FakeFiles:
+    """Files API of a Nextcloud with a tree of directories, which counts the listed directories."""
+
+    def __init__(self):
+        """Create the API with an empty tree."""
+        self.tree = {}
+        self.listed = []
+        # Number of failing listings by directory
+        self.failures = {}
+
+    def set_tree(self, etags, files):
+        """Set the directories by their etag and the files as (path, file id, etag)."""
+        self.tree = {path: FsNode(f"files/user/{path}/", etag=etag, fileid=len(path)) for path, etag in etags.items()}
+        self.files = [FsNode(f"files/user/{path}", etag=etag, fileid=file_id) for path, file_id, etag in files]
+
+    def by_path(self, path):
+        return self.tree[path.strip("/")]
+
+    def listdir(self, path, depth=1):
+        if self.failures.get(path.strip("/")):
+            self.failures[path.strip("/")] -= 1
+            raise TimeoutError("listing timed out")
+        self.listed.append(path.strip("/"))
+        children = [node for name, node in self.tree.items() if str(Path(name).parent) == path.strip("/")]
+        children += [node for node in self.files if str(Path(node.user_path).parent) == path.strip("/")]
+        return children
+
+
+def read_metadata(image_path):
+    """Get the metadata of an image without reading it."""
+    return Custom_Image(image_id=0, path=image_path, location="Park", date=datetime(2024, 1, 1), width=4, height=3)
+
+
+@patch("WebUI.search_images.read_metadata", read_metadata)
+class TestSearchImages(unittest.TestCase):
+    """Class to test the incremental scan of the Nextcloud folder."""
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        database_name = str(Path(tmp_dir.name, "test.sqlite"))
+        connection = sqlite3.connect(database_name)
+        connection.executescript(Path(Path(__file__).parent.parent, "Database", "schema.sql").read_text())
+        connection.execute("INSERT INTO user (id, email, password) VALUES (1, 'user', 'x');")
+        connection.commit()
+        connection.close()
+
+        self.db = ImageTinderDatabase(database_name=database_name)
+        self.addCleanup(self.db.connections.close)
+        self.nextcloud = MagicMock()
+        self.nextcloud.files = FakeFiles()
+        patcher = patch("WebUI.search_images.invalidate_image")
+        self.invalidate_image = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sync(self, **kwargs):
+        self.nextcloud.files.listed = []
+        counts = IngestPipeline("/Photos/", self.nextcloud, self.db, retry_delay=0, **kwargs).run()
+        return {key: value for key, value in counts.items() if value}
+
+    def test_incremental_scan(self):
+        files = self.nextcloud.files
+        files.set_tree(
+            {"Photos": "r1", "Photos/a": "a1", "Photos/b": "b1", "Photos/d": "d1"},
+            [
+                ("Photos/a/x.jpg", 1, "x1"),
+                ("Photos/a/notes.txt", 2, "n1"),
+                ("Photos/b/y.jpg", 3, "y1"),
+                ("Photos/d/w.jpg", 5, "w1"),
+            ],
+        )
+        self.assertDictEqual(self.sync(), {"inserted": 3})
+        self.assertCountEqual(files.listed, ["Photos", "Photos/a", "Photos/b", "Photos/d"])
+        self.assertDictEqual(self.sync(), {})
+        self.assertListEqual(files.listed, [])
+
+        # The reviewed y.jpg is moved out of the deleted b, x.jpg is deleted and z.jpg is new, d is unchanged
+        image_id = self.db.get_image_id("Photos/b/y.jpg")
+        self.db.add_or_update_review(user_id=1, image_id=image_id, review=4.0)
+        files.set_tree(
+            {"Photos": "r2", "Photos/a": "a2", "Photos/c": "c1", "Photos/d": "d1"},
+            [("Photos/a/z.jpg", 4, "z1"), ("Photos/c/renamed.jpg", 3, "y1"), ("Photos/d/w.jpg", 5, "w1")],
+        )
+        self.assertDictEqual(self.sync(), {"inserted": 1, "moved": 1, "missing": 1})
+        self.assertCountEqual(files.listed, ["Photos", "Photos/a", "Photos/c"])
+        stored = self.db.get_image_files()
+        self.assertDictEqual(
+            {path: (file_id, etag) for path, (_, file_id, etag) in stored.items()},
+            {
+                "Photos/a/x.jpg": (1, "x1"),
+                "Photos/a/z.jpg": (4, "z1"),
+                "Photos/c/renamed.jpg": (3, "y1"),
+                "Photos/d/w.jpg": (5, "w1"),
+            },
+        )
+        self.assertEqual(stored["Photos/c/renamed.jpg"][0], image_id)
+        self.assertListEqual(self.db.get_missing_image_ids(), [stored["Photos/a/x.jpg"][0]])
+        self.assertEqual(self.db.get_review(1, image_id), 4.0)
+        self.assertDictEqual(
+            self.db.get_directory_etags(), {"Photos": "r2", "Photos/a": "a2", "Photos/c": "c1", "Photos/d": "d1"}
+        )
+
+        # The content of z.jpg changed, its metadata not
+        files.set_tree(
+            {"Photos": "r3", "Photos/a": "a3", "Photos/c": "c1", "Photos/d": "d1"},
+            [("Photos/a/z.jpg", 4, "z2"), ("Photos/c/renamed.jpg", 3, "y1"), ("Photos/d/w.jpg", 5, "w1")],
+        )
+        self.assertDictEqual(self.sync(), {"unchanged": 1})
+        self.assertEqual(self.db.get_image_files()["Photos/a/z.jpg"][1:], (4, "z2"))
+        self.invalidate_image.assert_called_with(self.db.get_image_id("Photos/a/z.jpg"))
+
+    def test_replaced_files(self):
+        files = self.nextcloud.files
+        files.set_tree({"Photos": "r1"}, [("Photos/a.jpg", 1, "a1"), ("Photos/b.jpg", 2, "b1")])
+        self.assertDictEqual(self.sync(), {"inserted": 2})
+        image_a, image_b = self.db.get_image_id("Photos/a.jpg"), self.db.get_image_id("Photos/b.jpg")
+        self.db.add_or_update_review(user_id=1, image_id=image_b, review=5.0)
+
+        # b.jpg is renamed to c.jpg, then a.jpg to b.jpg
+        files.set_tree({"Photos": "r2"}, [("Photos/b.jpg", 1, "a1"), ("Photos/c.jpg", 2, "b1")])
+        self.assertDictEqual(self.sync(), {"moved": 2})
+        self.assertDictEqual(
+            self.db.get_image_files(), {"Photos/b.jpg": (image_a, 1, "a1"), "Photos/c.jpg": (image_b, 2, "b1")}
+        )
+        self.assertEqual(self.db.get_review(1, image_b), 5.0)
+        self.invalidate_image.assert_not_called()
+
+        # A new file replaces c.jpg, the replaced image keeps its review until it is removed
+        files.set_tree({"Photos": "r3"}, [("Photos/b.jpg", 1, "a1"), ("Photos/c.jpg", 3, "c1")])
+        self.assertDictEqual(self.sync(), {"inserted": 1, "missing": 1})
+        self.assertEqual(self.db.get_image_files()["Photos/c.jpg"][1:], (3, "c1"))
+        self.assertIsNone(self.db.get_review(1, self.db.get_image_id("Photos/c.jpg")))
+        self.assertEqual(self.db.get_review(1, image_b), 5.0)
+
+        files.set_tree({"Photos": "r4"}, [("Photos/b.jpg", 1, "a1"), ("Photos/c.jpg", 3, "c1")])
+        with patch("WebUI.search_images.MISSING_GRACE_PERIOD", timedelta(0)):
+            self.assertDictEqual(self.sync(), {"removed": 1})
+        self.assertIsNone(self.db.get_review(1, image_b))
+        # The id of the removed image may be given to a new image
+        self.invalidate_image.assert_called_once_with(image_b)
+
+    def test_missing_files(self):
+        files = self.nextcloud.files
+        files.set_tree({"Photos": "r1", "Photos/a": "a1"}, [("Photos/a/x.jpg", 1, "x1"), ("Photos/y.jpg", 2, "y1")])
+        self.assertDictEqual(self.sync(), {"inserted": 2})
+        image_x = self.db.get_image_id("Photos/a/x.jpg")
+        self.db.add_or_update_review(user_id=1, image_id=image_x, review=4.0)
+
+        # E.g. a sync client which removes and uploads the directory again
+        files.set_tree({"Photos": "r2", "Photos/a": "a2"}, [("Photos/y.jpg", 2, "y1")])
+        self.assertDictEqual(self.sync(), {"missing": 1})
+        self.assertIsNone(self.db.get_image_id("Photos/a/x.jpg"))
+        files.set_tree({"Photos": "r3", "Photos/a": "a3"}, [("Photos/a/x.jpg", 1, "x1"), ("Photos/y.jpg", 2, "y1")])
+        self.assertDictEqual(self.sync(), {"restored": 1})
+        self.assertEqual(self.db.get_image_id("Photos/a/x.jpg"), image_x)
+        self.assertEqual(self.db.get_review(1, image_x), 4.0)
+        self.assertListEqual(self.db.get_missing_image_ids(), [])
+
+        # A full scan confirms that the file is gone
+        files.set_tree({"Photos": "r4", "Photos/a": "a4"}, [("Photos/y.jpg", 2, "y1")])
+        self.assertDictEqual(self.sync(full=True), {"unchanged": 1, "removed": 1})
+        self.assertIsNone(self.db.get_review(1, image_x))
+        self.assertNotIn("Photos/a/x.jpg", self.db.get_image_files())
+        self.invalidate_image.assert_called_once_with(image_x)
+
+    def test_small_queues(self):
+        directories = {"Photos": "r1", **{f"Photos/{i}": f"d{i}" for i in range(10)}}
+        files = [(f"Photos/{i}/{j}.jpg", 10 * i + j + 1, "e1") for i in range(10) for j in range(10)]
+        self.nextcloud.files.set_tree(directories, files)
+        pipeline = IngestPipeline(
+            "/Photos/", self.nextcloud, self.db, list_workers=3, fetch_workers=3, queue_size=1, batch_size=7
+        )
+        self.assertEqual(pipeline.run(progress_interval=0.01)["inserted"], 100)
+        stats = pipeline.stats()
+        self.assertEqual((stats["listed"], stats["fetched"], stats["written"]), (100, 100, 100))
+        self.assertEqual(stats["write_backlog"], 0)
+        self.assertEqual(len(self.db.get_image_files()), 100)
+        self.assertEqual(len(self.db.get_directory_etags()), 11)
+
+    def test_failed_fetch(self):
+        self.nextcloud.files.set_tree(
+            {"Photos": "r1", "Photos/a": "a1", "Photos/b": "b1"},
+            [("Photos/a/x.jpg", 1, "x1"), ("Photos/a/broken.jpg", 2, "b1"), ("Photos/b/flaky.jpg", 3, "f1")],
+        )
+        reads = []
+
+        def broken(image_path):
+            reads.append(image_path)
+            # The flaky file fails once and is read by the retry
+            if "broken" in image_path or reads.count(image_path) == 1 and "flaky" in image_path:
+                raise OSError("broken")
+            return read_metadata(image_path)
+
+        with patch("WebUI.search_images.read_metadata", broken):
+            self.assertDictEqual(self.sync(), {"inserted": 2, "failed": 1})
+            self.assertEqual(reads.count("Photos/a/broken.jpg"), 3)
+            errors = self.db.get_ingest_errors()
+            self.assertListEqual(
+                [(e["path"], e["attempts"], e["error"]) for e in errors],
+                [("Photos/a/broken.jpg", 1, "OSError: broken")],
+            )
+            # The directories above the failed file are listed again, the failed file waits for its retry
+            self.assertDictEqual(self.db.get_directory_etags(), {"Photos/b": "b1"})
+            self.assertDictEqual(self.sync(), {"deferred": 1})
+            self.assertCountEqual(self.nextcloud.files.listed, ["Photos", "Photos/a"])
+
+            # The retry is due
+            past = datetime.now() - timedelta(minutes=1)
+            self.db.set_ingest_errors([("Photos/a/broken.jpg", "b1", 1, "OSError: broken", past, past)])
+            self.assertDictEqual(self.sync(), {"failed": 1})
+            error = self.db.get_ingest_errors()[0]
+            self.assertEqual(error["attempts"], 2)
+            self.assertGreater(error["next_attempt"] - error["last_attempt"], timedelta(hours=1, minutes=59))
+
+        self.assertDictEqual(self.sync(full=True), {"inserted": 1, "unchanged": 2})
+        self.assertListEqual(self.db.get_ingest_errors(), [])
+        self.assertEqual(len(self.db.get_directory_etags()), 3)
+
+    def test_resume(self):
+        files = self.nextcloud.files
+        files.set_tree(
+            {"Photos": "r1", "Photos/a": "a1", "Photos/b": "b1"},
+            [("Photos/a/x.jpg", 1, "x1"), ("Photos/a/y.jpg", 2, "y1"), ("Photos/b/z.jpg", 3, "z1")],
+        )
+        # The listing of b times out more often than it is retried, the run is interrupted
+        files.failures = {"Photos/b": 3}
+        self.assertRaises(TimeoutError, self.sync, list_workers=1)
+        self.assertEqual(files.failures["Photos/b"], 0)
+        journal = self.db.get_ingest_journal()
+        self.assertEqual(journal["Photos/a"][0], "a1")
+        self.assertCountEqual([entry[0] for entry in journal["Photos/a"][1]], ["Photos/a/x.jpg", "Photos/a/y.jpg"])
+        self.assertDictEqual(self.db.get_directory_etags(), {})
+
+        # The next run lists only the directory which was not listed yet, images read before are kept
+        self.sync()
+        self.assertListEqual(files.listed, ["Photos/b"])
+        self.assertEqual(len(self.db.get_image_files()), 3)
+        self.assertDictEqual(self.db.get_ingest_journal(), {})
+        self.assertDictEqual(self.db.get_directory_etags(), {"Photos": "r1", "Photos/a": "a1", "Photos/b": "b1"})
+        self.assertEqual(self.db.get_image_files()["Photos/a/x.jpg"][1:], (1, "x1"))
+
+        # A journal whose directories changed since is not used
+        self.db.add_ingest_directories([("Photos", "r1", [("Photos/a", True, 10, "a1", 0, "2024-01-01 00:00:00")])])
+        files.set_tree(
+            {"Photos": "r2", "Photos/a": "a1", "Photos/b": "b1", "Photos/c": "c1"}, [("Photos/c/v.jpg", 4, "v1")]
+        )
+        self.assertDictEqual(self.sync(), {"inserted": 1})
+        self.assertCountEqual(files.listed, ["Photos", "Photos/c"])
+
+    def test_derivatives(self):
+        # The worker processes read the images from the working directory
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        test_image = Path(__file__).parent.joinpath("test.jpg").absolute()
+        os.chdir(tmp_dir.name)
+        Path("Photos/a").mkdir(parents=True)
+        Path("Derivatives").mkdir()
+        for name in ["new1", "new2", "new3", "old"]:
+            Path(f"Photos/a/{name}.jpg").symlink_to(test_image)
+        cache = DiskCache("Derivatives", budget_bytes=2**30)
+        patches = [
+            patch("WebUI.derivatives.DERIVATIVE_DIR", Path("Derivatives").absolute()),
+            patch("WebUI.search_images.disk_cache", cache),
+            patch("WebUI.search_images.DERIVATIVE_BUDGET_BYTES", 1),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        def dated(image_path):
+            # Only images of the last days get their derivatives
+            date = datetime(2020, 1, 1) if "old" in image_path else datetime.now()
+            return Custom_Image(image_id=0, path=image_path, location="Park", date=date, width=4, height=3)
+
+        files = [("Photos/a/new1.jpg", 1, "e1"), ("Photos/a/new2.jpg", 2, "e1"), ("Photos/a/old.jpg", 3, "e1")]
+        self.nextcloud.files.set_tree({"Photos": "r1", "Photos/a": "a1"}, files)
+        with patch("WebUI.search_images.read_metadata", dated):
+            # One render at a time, the budget is used up by the first image
+            counts = self.sync(derivatives=True, derivative_workers=1)
+            self.assertDictEqual(counts, {"inserted": 3, "derivatives": 1, "derivatives_skipped": 1})
+
+            patches[2].stop()
+            self.nextcloud.files.set_tree({"Photos": "r2", "Photos/a": "a2"}, [*files, ("Photos/a/new3.jpg", 4, "e1")])
+            self.assertDictEqual(self.sync(derivatives=True), {"inserted": 1, "derivatives": 1})
+
+        ids = self.db.get_image_paths()
+        new3 = [derivative_path(ids["Photos/a/new3.jpg"], size_class) for size_class in ["preview", "placeholder"]]
+        with Image.open(new3[0]) as preview, Image.open(new3[1]) as placeholder:
+            self.assertEqual(max(preview.size), 512)
+            self.assertEqual(max(placeholder.size), 32)
+            # test.jpg is stored in landscape with orientation 6
+            self.assertGreater(preview.height, preview.width)
+        self.assertTrue(derivative_path(ids["Photos/a/new3.jpg"], "view_1920").exists())
+        self.assertFalse(derivative_path(ids["Photos/a/old.jpg"], "preview").exists())
+        self.assertEqual(len(list(Path("Derivatives").iterdir())), 6)
+        self.assertEqual(cache.total_bytes, sum(path.stat().st_size for path in Path("Derivatives").iterdir()))
+
+
+if __name__ == "__main__":
+    unittest.main()